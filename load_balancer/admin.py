@@ -0,0 +1,67 @@
+import logging
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+class AdminServer:
+    # Diagnostics on a separate (by default local only) port:
+    #   GET /profile?seconds=10&sort=cumulative&limit=40 - cProfile of the event loop, as pstats text
+    #   GET /stages - count and mean time of every request stage of the traced requests
+    #   GET /traces - the slowest traced requests, stage by stage
+    def __init__(self, load_balancer, host='127.0.0.1', port=9091, max_profile_seconds=60):
+        self.load_balancer = load_balancer
+        self.enabled = False
+        self.host = host
+        self.port = port
+        self.max_profile_seconds = max_profile_seconds
+        self.runner = None
+
+    def configure(self, config):
+        # Apply the 'load_balancer.admin' section of config.yaml
+        if not config:
+            return
+        self.enabled = config.get('enabled', self.enabled)
+        self.host = config.get('host', self.host)
+        self.port = config.get('port', self.port)
+        self.max_profile_seconds = config.get('max_profile_seconds', self.max_profile_seconds)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/profile', self.handle_profile)
+        app.router.add_get('/stages', self.handle_stages)
+        app.router.add_get('/traces', self.handle_traces)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f"Admin server listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle_profile(self, request):
+        try:
+            seconds = float(request.query.get('seconds', 10))
+            limit = int(request.query.get('limit', 40))
+        except ValueError:
+            return web.Response(status=400, text="seconds and limit must be numbers\n")
+        sort = request.query.get('sort', 'cumulative')
+        if sort not in ('cumulative', 'tottime', 'ncalls', 'pcalls', 'filename', 'name'):
+            return web.Response(status=400, text=f"Unknown sort order: {sort}\n")
+        if not 0 < seconds <= self.max_profile_seconds:
+            return web.Response(status=400, text=f"seconds must be in (0, {self.max_profile_seconds}]\n")
+        profiler = self.load_balancer.profiler
+        if profiler.is_running():
+            return web.Response(status=409, text="A profile is already running\n")
+        logger.info(f"Profiling the event loop for {seconds}s")
+        return web.Response(text=await profiler.run(seconds, sort, limit))
+
+    async def handle_stages(self, request):
+        return web.json_response({'sample_rate': self.load_balancer.tracer.sample_rate,
+                                  'stages': self.load_balancer.metrics.get_stage_summary()})
+
+    async def handle_traces(self, request):
+        traces = self.load_balancer.tracer.slow_traces
+        return web.json_response(sorted(traces, key=lambda trace: trace['duration_ms'], reverse=True))
@@ -0,0 +1,191 @@
+import asyncio
+import collections
+import math
+import time
+
+
+class OverloadedError(Exception):
+    pass
+
+
+class AdaptiveLimit:
+    # Concurrency limit learned from the measured latency:
+    # aimd - +1 per limit-worth of successful requests, * backoff on a failure or when latency exceeds
+    #     tolerance * the long-term latency
+    # gradient - limit * (tolerance * long-term latency / latency) + sqrt(limit) headroom, smoothed
+    def __init__(self, initial=20, min_limit=1, max_limit=1000, algorithm='gradient', backoff=0.9,
+                 tolerance=2.0, smoothing=0.2, baseline_decay=0.01):
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.algorithm = algorithm
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        # Long-term latency, the no-load baseline the recent samples are compared with
+        self.baseline_decay = baseline_decay
+        self.baseline = None
+
+    def get(self):
+        return int(self.limit)
+
+    def on_sample(self, response_time, is_success, in_flight):
+        if self.baseline is None:
+            self.baseline = response_time
+        else:
+            self.baseline += (response_time - self.baseline) * self.baseline_decay
+        if not is_success:
+            limit = self.limit * self.backoff
+        elif self.algorithm == 'aimd':
+            if response_time > self.baseline * self.tolerance:
+                limit = self.limit * self.backoff
+            elif in_flight * 2 >= self.limit:
+                # Only grow while the limit is actually being used
+                limit = self.limit + 1 / self.limit
+            else:
+                return
+        else:
+            gradient = max(0.5, min(1.0, self.tolerance * self.baseline / max(response_time, 1e-9)))
+            if gradient == 1.0 and in_flight * 2 < self.limit:
+                return
+            new_limit = self.limit * gradient + math.sqrt(self.limit)
+            limit = self.limit * (1 - self.smoothing) + new_limit * self.smoothing
+        self.limit = min(max(limit, self.min_limit), self.max_limit)
+
+
+class AdmissionController:
+    def __init__(self, max_queue_size=1000, queue_timeout=1.0, priorities=('critical', 'high', 'normal', 'low'),
+                 default_priority='normal', priority_header='X-Priority'):
+        self.enabled = False
+        self.algorithm = 'gradient'
+        self.initial_limit = 20
+        self.min_limit = 1
+        # Upper bounds of the global and per-VPS limits, set from max_connections / max_connections_per_vps
+        self.max_limit = 1000
+        self.max_vps_limit = 1000
+        self.limit = AdaptiveLimit(self.initial_limit, self.min_limit, self.max_limit, self.algorithm)
+        self.vps_limits = {}
+        self.in_flight = 0
+        # Requests waiting for a slot, one FIFO per priority class, the first class is served first
+        self.max_queue_size = max_queue_size
+        self.queue_timeout = queue_timeout
+        self.priority_header = priority_header
+        self.set_priorities(priorities, default_priority)
+        self.shed_count = 0
+
+    def set_priorities(self, priorities, default_priority):
+        self.priorities = {name: rank for rank, name in enumerate(priorities)}
+        self.default_priority = self.priorities.get(default_priority, len(priorities) - 1)
+        self.queues = [collections.deque() for _ in priorities]
+        self.queued = 0
+
+    def configure(self, config, max_connections=None, max_connections_per_vps=None):
+        # Apply the 'load_balancer.admission' section of config.yaml
+        if max_connections:
+            self.max_limit = max_connections
+        self.max_vps_limit = max_connections_per_vps or self.max_limit
+        if config:
+            self.enabled = config.get('enabled', self.enabled)
+            self.algorithm = config.get('algorithm', self.algorithm)
+            self.initial_limit = config.get('initial_limit', self.initial_limit)
+            self.min_limit = config.get('min_limit', self.min_limit)
+            self.max_queue_size = config.get('max_queue_size', self.max_queue_size)
+            self.queue_timeout = config.get('queue_timeout', self.queue_timeout)
+            self.priority_header = config.get('priority_header', self.priority_header)
+            if 'priorities' in config and not self.queued:
+                self.set_priorities(config['priorities'], config.get('default_priority', 'normal'))
+        for limit, max_limit in [(self.limit, self.max_limit)] + [(vps_limit, self.max_vps_limit)
+                                                                  for vps_limit in self.vps_limits.values()]:
+            limit.algorithm = self.algorithm
+            limit.min_limit = self.min_limit
+            limit.max_limit = max_limit
+            limit.limit = min(max(limit.limit, self.min_limit), max_limit)
+
+    def get_priority(self, name=None):
+        return self.priorities.get(name, self.default_priority) if name is not None else self.default_priority
+
+    async def acquire(self, priority=None):
+        # Returns the admission time to hand back to release(), raises OverloadedError when shed
+        if not self.enabled:
+            return None
+        if self.in_flight < self.limit.get() and not self.queued:
+            self.in_flight += 1
+            return time.monotonic()
+        rank = self.get_priority(priority)
+        if self.queued >= self.max_queue_size:
+            # Full queue: the newest request of a lower class makes room, otherwise this one is shed
+            victims = next((queue for queue in reversed(self.queues[rank + 1:]) if queue), None)
+            if victims is None:
+                self.shed_count += 1
+                raise OverloadedError("Admission queue is full")
+            self.queued -= 1
+            self.shed_count += 1
+            victim = victims.pop()
+            if not victim.done():
+                victim.set_exception(OverloadedError("Shed for a higher priority request"))
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queues[rank].append(future)
+        self.queued += 1
+        timeout = loop.call_later(self.queue_timeout, self.expire, rank, future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # Granted a slot just as the request went away, hand it to the next one
+                self.in_flight -= 1
+                self.grant()
+            else:
+                self.remove(rank, future)
+            raise
+        finally:
+            timeout.cancel()
+        return time.monotonic()
+
+    def release(self, start_time, is_success):
+        if start_time is None:
+            return
+        self.in_flight -= 1
+        self.limit.on_sample(time.monotonic() - start_time, is_success, self.in_flight + 1)
+        self.grant()
+
+    def grant(self):
+        while self.queued and self.in_flight < self.limit.get():
+            queue = next(queue for queue in self.queues if queue)
+            future = queue.popleft()
+            self.queued -= 1
+            # Skips waiters cancelled since, they are no longer in the queue when they get to run
+            if not future.done():
+                self.in_flight += 1
+                future.set_result(None)
+
+    def expire(self, rank, future):
+        if self.remove(rank, future):
+            self.shed_count += 1
+            future.set_exception(OverloadedError(f"Waited {self.queue_timeout}s in the admission queue"))
+
+    def remove(self, rank, future):
+        try:
+            self.queues[rank].remove(future)
+        except ValueError:
+            return False
+        self.queued -= 1
+        return True
+
+    def get_vps_limit(self, vps):
+        limit = self.vps_limits.get(vps)
+        if limit is None:
+            limit = self.vps_limits[vps] = AdaptiveLimit(self.initial_limit, self.min_limit, self.max_vps_limit,
+                                                         self.algorithm)
+        return limit
+
+    def has_capacity(self, vps, active_connections):
+        return not self.enabled or active_connections < self.get_vps_limit(vps).get()
+
+    def record_vps(self, vps, response_time, is_success, active_connections):
+        if self.enabled:
+            self.get_vps_limit(vps).on_sample(response_time, is_success, active_connections)
+
+    def forget_vps(self, vps):
+        self.vps_limits.pop(vps, None)
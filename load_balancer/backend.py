@@ -0,0 +1,59 @@
+class Backend:
+    # Per-VPS record kept next to the routing structures, which stay keyed by the VPS URL
+    __slots__ = ('url', 'weight', 'zone', 'max_connections', 'health_path', 'tags',
+                 'cpu_usage', 'memory_usage', 'latency', 'updated_at')
+
+    # Inventory attributes, as accepted in the VPS list file and the 'load_balancer.backends' config section
+    attributes = ('weight', 'zone', 'max_connections', 'health_path', 'tags')
+    # Accepted values of the telemetry fields: usage in percent, latency in seconds
+    telemetry_ranges = {'cpu_usage': (0.0, 100.0), 'memory_usage': (0.0, 100.0), 'latency': (0.0, 3600.0)}
+
+    def __init__(self, url, weight=1, zone=None, max_connections=0, health_path=None, tags=()):
+        self.url = url
+        # Relative capacity, scaled by the load reported by the VPS
+        self.weight = weight
+        self.zone = zone
+        # Hard limit of requests in flight on this VPS (0 - no limit)
+        self.max_connections = max_connections
+        # Overrides the health_check.path of config.yaml
+        self.health_path = health_path
+        self.tags = frozenset(tags)
+        # Smoothed telemetry: CPU and memory usage in percent, latency in seconds, None until reported
+        self.cpu_usage = None
+        self.memory_usage = None
+        self.latency = None
+        self.updated_at = None
+
+    def __repr__(self):
+        return f'Backend({self.url!r}, weight={self.weight}, zone={self.zone!r})'
+
+    def update_inventory(self, other):
+        # Takes the configured attributes of a reloaded record, the telemetry is kept
+        for name in self.attributes:
+            setattr(self, name, getattr(other, name))
+
+    def observe(self, stats, smoothing, now):
+        # Returns the names of the reported fields that were ignored: not a number, or out of range
+        invalid = []
+        for name, (low, high) in self.telemetry_ranges.items():
+            value = stats.get(name)
+            if value is None:
+                continue
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                invalid.append(name)
+                continue
+            if not low <= value <= high:
+                # NaN fails the comparison as well
+                invalid.append(name)
+                continue
+            current = getattr(self, name)
+            setattr(self, name, value if current is None else current + (value - current) * smoothing)
+        self.updated_at = now
+        return invalid
+
+    def get_headroom(self):
+        # 1.0 for an idle machine, down to 0.0 as its busiest resource saturates
+        usage = max((usage for usage in (self.cpu_usage, self.memory_usage) if usage is not None), default=0.0)
+        return min(max(1 - usage / 100, 0.0), 1.0)
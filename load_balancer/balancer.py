@@ -1,30 +1,143 @@
 import itertools
 import asyncio
+import time
 import requests
 import aiohttp
+from aiohttp import web
+from multidict import CIMultiDict
 from load_balancer.vps_list import VPSList
 from load_balancer.health_checker import HealthChecker
 from load_balancer.logger import Logger
 from load_balancer.metrics import Metrics
 from load_balancer.configuration import Configuration
+from load_balancer.connection_pool import ConnectionPool
+from load_balancer.proxy import ProxyServer
+from load_balancer.tcp_proxy import TCPProxy
+from load_balancer.watcher import ConfigWatcher
+from load_balancer.retry import RetryPolicy, ClientStatusError
+from load_balancer.cache import ResponseCache, CachedResponse
+from load_balancer.admission import AdmissionController, OverloadedError
+from load_balancer.telemetry import TelemetryCollector
+from load_balancer.backend import Backend
+from load_balancer.sessions import StickySessions
+from load_balancer.transport import HTTP1Transport, HTTP2Transport
+from load_balancer.tracing import Tracer, Profiler, mark
+from load_balancer.admin import AdminServer
 
 
 class LoadBalancer:
+    balancing_algorithms = ('round_robin', 'weighted_round_robin', 'least_connections', 'p2c',
+                            'least_response_time', 'ip_hashing', 'random_weighted_probabilities')
+
     def __init__(self, balancing_algorithm='round_robin'):
         self.vps_manager = VPSManager()
         self.health_checker = HealthChecker()
-        self.request_handler = RequestHandler()
+        self.connection_pool = ConnectionPool()
+        self.request_handler = RequestHandler(self.connection_pool, self.health_checker)
+        self.retry_policy = RetryPolicy()
+        self.response_cache = ResponseCache()
+        self.admission_controller = AdmissionController()
+        self.telemetry_collector = TelemetryCollector(self.health_checker)
+        self.sticky_sessions = StickySessions()
         self.vps_list = []
         self.cycle_vps = None
         self.metrics = Metrics()
+        self.tracer = Tracer(self.metrics)
+        self.profiler = Profiler()
+        self.logger = Logger()
         self.configuration = Configuration()
         self.balancing_algorithm = balancing_algorithm
+        self.proxy_server = ProxyServer(self)
+        self.tcp_proxy = TCPProxy(self)
+        self.admin_server = AdminServer(self)
+        self.vps_list_file = None
+        self.watcher = ConfigWatcher(self)
+        self.watch_files = False
+        self.reload_lock = None
 
     def load_vps_list(self, filename):
+        self.vps_list_file = filename
         vps_list = self.vps_manager.load_from_file(filename)
         self.health_checker.set_vps_list(vps_list)
-        self.metrics.setup()
         self.configuration.load()
+        self.apply_configuration()
+        # Binds the metrics exporter, once the configured port is known
+        self.metrics.setup()
+        backends = self.get_configured_backends(self.configuration)
+        if backends is not None:
+            self.update_vps_list(backends)
+
+    def read_vps_list(self, filename):
+        # The VPS URLs load_vps_list ends up with, read without applying anything
+        configuration = Configuration(self.configuration.config_file)
+        configuration.load()
+        backends = self.get_configured_backends(configuration)
+        if backends is None:
+            return VPSList().load_from_file(filename)
+        return [backend.url for backend in backends]
+
+    def get_configured_backends(self, configuration):
+        # The 'load_balancer.backends' section of config.yaml, when present, replaces the VPS list file
+        entries = (configuration.get('load_balancer') or {}).get('backends')
+        return VPSList().load_from_config(entries) if entries is not None else None
+
+    def validate_configuration(self, configuration):
+        # Every section that can be rejected is checked before apply_configuration changes any component,
+        # so a bad file leaves the running configuration untouched
+        config = configuration.get('load_balancer') or {}
+        self.request_handler.validate(config.get('upstream'))
+        self.health_checker.slow_start.validate(config.get('slow_start'))
+
+    def apply_configuration(self):
+        config = self.configuration.get('load_balancer') or {}
+        self.connection_pool.configure(config)
+        self.request_handler.configure(config.get('upstream'))
+        self.health_checker.configure(config.get('health_check'))
+        self.health_checker.outlier_detector.configure(config.get('outlier_detection'))
+        self.health_checker.failure_handler.configure(config.get('failure_handler'))
+        self.health_checker.slow_start.configure(config.get('slow_start'))
+        self.health_checker.zone_router.configure(config.get('zone_routing'))
+        self.health_checker.refresh_zone_routing()
+        self.telemetry_collector.configure(config.get('telemetry'))
+        self.retry_policy.configure(config.get('retry'))
+        self.response_cache.configure(config.get('cache'))
+        self.sticky_sessions.configure(config.get('sticky_sessions'))
+        self.admission_controller.configure(config.get('admission'), self.connection_pool.max_connections,
+                                            self.connection_pool.max_connections_per_vps)
+        self.proxy_server.configure(config)
+        self.tcp_proxy.configure(config.get('tcp'))
+        self.metrics.configure(config.get('metrics'))
+        self.tracer.configure(config.get('tracing'))
+        if not self.connection_pool.trace_configs:
+            # Splits connecting from waiting for the response on traced requests. Installed even with
+            # sampling off, the sessions are built once and tracing can be turned on by a reload
+            self.connection_pool.trace_configs = [self.tracer.get_trace_config()]
+        self.admin_server.configure(config.get('admin'))
+        self.logger.configure(config.get('logging'))
+        reload_config = config.get('reload') or {}
+        self.watch_files = reload_config.get('watch', self.watch_files)
+        self.watcher.configure(reload_config)
+
+    async def reload(self):
+        # Everything that touches the disk or rehashes the ring runs in the executor,
+        # the new state is then published on the loop in one step
+        if self.reload_lock is None:
+            self.reload_lock = asyncio.Lock()
+        async with self.reload_lock:
+            loop = asyncio.get_running_loop()
+            configuration = Configuration(self.configuration.config_file)
+            await loop.run_in_executor(None, configuration.load)
+            vps_list = self.get_configured_backends(configuration)
+            if vps_list is None and self.vps_list_file is not None:
+                vps_list = await loop.run_in_executor(None, VPSList().load_backends, self.vps_list_file)
+            elif vps_list is None:
+                vps_list = self.vps_manager.vps_list
+            self.validate_configuration(configuration)
+            self.configuration = configuration
+            self.apply_configuration()
+            snapshot = await loop.run_in_executor(None, self.health_checker.build_routing_snapshot, vps_list)
+            self.vps_manager.update_vps_list(list(snapshot.vps_list))
+            self.health_checker.apply_routing_snapshot(snapshot)
 
     def add_vps(self, vps):
         self.vps_manager.add_vps(vps)
@@ -33,37 +146,156 @@ class LoadBalancer:
     def remove_vps(self, vps):
         self.vps_manager.remove_vps(vps)
         self.health_checker.remove_vps(vps)
+        self.admission_controller.forget_vps(vps)
+
+    async def distribute_load(self, client_ip=None, priority=None, session_id=None):
+        trace = self.tracer.start('distribute_load')
+        try:
+            admitted_at = await self.admission_controller.acquire(priority)
+        except OverloadedError as e:
+            self.logger.log_warning(f"Request shed: {e}")
+            self.tracer.finish(trace)
+            return
+        mark('admission')
+        is_success = False
+
+        def pick_vps(tried):
+            return self.get_session_vps(session_id, client_ip, tried)
 
-    async def distribute_load(self):
-        next_vps = self.get_next_vps()
+        async def fetch(headers):
+            return await self.retry_policy.execute(pick_vps, lambda vps: self.send_to_vps(vps, headers))
+
+        try:
+            if self.response_cache.enabled:
+                await self.response_cache.get('GET', '/', {}, fetch)
+            else:
+                await self.retry_policy.execute(pick_vps, self.send_to_vps)
+            is_success = True
+        except ClientStatusError:
+            # Answered, the request itself was refused
+            is_success = True
+        except requests.exceptions.RequestException:
+            # Every failed attempt has already been accounted for and logged by send_to_vps
+            pass
+        except OverloadedError as e:
+            self.logger.log_warning(f"Request shed: {e}")
+        finally:
+            self.admission_controller.release(admitted_at, is_success)
+            self.tracer.finish(trace)
+
+    async def send_to_vps(self, vps, headers=None):
+        # With headers (cache validators) the whole response is kept as a CachedResponse
+        self.health_checker.increase_connection_count(vps)
+        start_time = time.monotonic()
         try:
-            response = await self.request_handler.send_request(next_vps)
-            Logger.log_request_success(next_vps)
-            self.metrics.update_metrics(response)
+            if headers is None:
+                response = await self.request_handler.send_request(vps)
+                status, bytes_in = 200, len(response)
+            else:
+                response = await self.request_handler.fetch(vps, headers)
+                status, bytes_in = response.status, len(response.body)
+            response_time = time.monotonic() - start_time
+            self.health_checker.record_response_time(vps, response_time)
+            self.health_checker.record_result(vps, True)
+            self.admission_controller.record_vps(vps, response_time, True,
+                                                 self.health_checker.active_connections.get(vps, 0))
+            self.retry_policy.observe(response_time)
+            self.logger.log_request_success(vps)
+            self.metrics.record_request(vps, response_time, status, bytes_in=bytes_in)
+            mark('record')
+            return response
+        except ClientStatusError as e:
+            # The VPS works, the request is at fault: not retried and not held against the VPS
+            response_time = time.monotonic() - start_time
+            self.health_checker.record_response_time(vps, response_time)
+            self.health_checker.record_result(vps, True)
+            self.admission_controller.record_vps(vps, response_time, True,
+                                                 self.health_checker.active_connections.get(vps, 0))
+            self.logger.log_request_error(vps, str(e))
+            self.metrics.record_request(vps, response_time, e.status)
+            mark('record')
+            raise
         except requests.exceptions.RequestException as e:
-            Logger.log_request_error(next_vps, str(e))
+            # A failing VPS must not look fast, count the failure as a full timeout
+            self.health_checker.record_response_time(vps, self.connection_pool.timeout)
+            self.health_checker.record_result(vps, False)
+            self.admission_controller.record_vps(vps, time.monotonic() - start_time, False,
+                                                 self.health_checker.active_connections.get(vps, 0))
+            self.logger.log_request_error(vps, str(e))
+            self.metrics.record_request(vps, time.monotonic() - start_time)
+            mark('record')
+            raise
+        finally:
+            self.health_checker.decrease_connection_count(vps)
 
     async def distribute_load_concurrently(self, num_requests):
-        tasks = [self.distribute_load() for _ in range(num_requests)]
-        await asyncio.gather(*tasks)
+        # A fixed set of workers pulling from one counter instead of a task per request,
+        # never more requests in flight than the connection pool allows (0 - unlimited, one worker per request)
+        requests_left = iter(range(num_requests))
+        max_connections = self.connection_pool.max_connections
+        workers = min(num_requests, max_connections) if max_connections > 0 else num_requests
 
-    def get_next_vps(self):
+        async def worker():
+            for _ in requests_left:
+                await self.distribute_load()
+
+        await asyncio.gather(*(worker() for _ in range(workers)))
+
+    def get_next_vps(self, client_ip=None):
+        self.health_checker.refresh_slow_start()
         if self.balancing_algorithm == 'round_robin':
             return self.health_checker.get_next_available_vps()
         elif self.balancing_algorithm == 'weighted_round_robin':
             return self.health_checker.get_next_weighted_vps()
         elif self.balancing_algorithm == 'least_connections':
             return self.health_checker.get_least_connections_vps()
+        elif self.balancing_algorithm == 'p2c':
+            return self.health_checker.get_p2c_vps()
         elif self.balancing_algorithm == 'least_response_time':
             return self.health_checker.get_least_response_time_vps()
         elif self.balancing_algorithm == 'ip_hashing':
-            client_ip = self.request_handler.get_client_ip()
+            if client_ip is None:
+                client_ip = self.request_handler.get_client_ip()
             return self.health_checker.get_ip_hashing_vps(client_ip)
         elif self.balancing_algorithm == 'random_weighted_probabilities':
             return self.health_checker.get_random_weighted_vps()
         else:
             raise ValueError("Unsupported load balancing algorithm")
 
+    def get_next_vps_excluding(self, client_ip, excluded, max_tries=3):
+        # Retries and hedges go to a VPS that has not been tried yet and is below its concurrency limit
+        # if the algorithm offers one, deterministic algorithms such as ip_hashing may keep returning the same VPS
+        vps = self.get_next_vps(client_ip)
+        for _ in range(max_tries - 1):
+            if vps not in excluded and self.has_capacity(vps):
+                break
+            vps = self.get_next_vps(client_ip)
+        if not self.has_capacity(vps):
+            raise OverloadedError(f"VPS {vps} is at its concurrency limit")
+        return vps
+
+    def get_session_vps(self, session_key, client_ip, excluded):
+        # The VPS the session is pinned to, or the algorithm's choice when the pinned one is unhealthy,
+        # at its limit or already tried, the session then follows the new VPS
+        if not self.sticky_sessions.enabled or session_key is None:
+            vps = self.get_next_vps_excluding(client_ip, excluded)
+            mark('select')
+            return vps
+        vps = self.sticky_sessions.lookup(session_key, self.health_checker.routing)
+        if vps is None or vps in excluded or not self.health_checker.check_health(vps) \
+                or not self.has_capacity(vps):
+            vps = self.get_next_vps_excluding(client_ip, excluded)
+        self.sticky_sessions.bind(session_key, vps)
+        mark('select')
+        return vps
+
+    def has_capacity(self, vps):
+        active_connections = self.health_checker.active_connections.get(vps, 0)
+        backend = self.health_checker.backends.get(vps)
+        if backend is not None and backend.max_connections and active_connections >= backend.max_connections:
+            return False
+        return self.admission_controller.has_capacity(vps, active_connections)
+
     def update_vps_list(self, vps_list):
         self.vps_manager.update_vps_list(vps_list)
         self.health_checker.set_vps_list(vps_list)
@@ -71,9 +303,53 @@ class LoadBalancer:
     def update_configuration(self, configuration):
         self.configuration = configuration
         self.configuration.load()
+        self.apply_configuration()
+
+    def start(self):
+        # Start the background tasks, must be called from within the running event loop
+        self.logger.start()
+        self.health_checker.start()
+        self.telemetry_collector.start()
+        self.metrics.start(lambda: self.health_checker.total_connections)
+        if self.watch_files:
+            self.watcher.start()
+
+    async def serve(self):
+        # Reverse-proxy mode: accept client connections on the configured port until cancelled
+        self.start()
+        await self.proxy_server.start()
+        if self.tcp_proxy.enabled:
+            await self.tcp_proxy.start()
+        if self.admin_server.enabled:
+            await self.admin_server.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await self.close()
+
+    async def close(self):
+        await self.watcher.stop()
+        await self.proxy_server.stop()
+        await self.tcp_proxy.stop()
+        await self.admin_server.stop()
+        await self.response_cache.close()
+        await self.telemetry_collector.stop()
+        await self.health_checker.stop()
+        await self.metrics.stop()
+        self.logger.stop()
+        await self.request_handler.close()
+        await self.connection_pool.close()
+
+    async def _run(self, num_requests):
+        self.start()
+        try:
+            await self.distribute_load_concurrently(num_requests)
+        finally:
+            await self.close()
 
     def run(self, num_requests):
-        asyncio.run(self.distribute_load_concurrently(num_requests))
+        asyncio.run(self._run(num_requests))
+
 
 class VPSManager:
     def __init__(self):
@@ -81,10 +357,10 @@ class VPSManager:
         self.cycle_vps = None
 
     def load_from_file(self, filename):
-        vps_list = VPSList()
-        self.vps_list = vps_list.load_from_file(filename)
-        self.cycle_vps = itertools.cycle(self.vps_list)
-        return self.vps_list
+        # Returns the Backend records, vps_list keeps the URLs
+        backends = VPSList().load_backends(filename)
+        self.update_vps_list(backends)
+        return backends
 
     def add_vps(self, vps):
         self.vps_list.append(vps)
@@ -94,25 +370,152 @@ class VPSManager:
             self.vps_list.remove(vps)
 
     def update_vps_list(self, vps_list):
-        self.vps_list = vps_list
-        self.cycle_vps = itertools.cycle(vps_list)
+        self.vps_list = [vps.url if isinstance(vps, Backend) else vps for vps in vps_list]
+        self.cycle_vps = itertools.cycle(self.vps_list)
 
 
 class RequestHandler:
-    def get_client_ip(self):
-        # Get the client's IP address from the request
-        # Implement the logic to extract the client IP based on your application's architecture
-        # For example, if you are using a web framework like Flask, you can retrieve the client's IP using request.remote_addr
-        pass
+    def __init__(self, connection_pool=None, health_checker=None):
+        self.connection_pool = connection_pool or ConnectionPool()
+        self.health_checker = health_checker
+        # How requests reach the VPSes, replaced by configure() according to upstream.protocol
+        self.transport = HTTP1Transport(self.connection_pool)
+        self.closing_transports = set()
+
+    # Connection-level headers that must not be forwarded by a proxy (RFC 7230, section 6.1)
+    hop_by_hop_headers = frozenset(['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+                                    'te', 'trailers', 'transfer-encoding', 'upgrade'])
+
+    def get_client_ip(self, request=None):
+        # Get the client's IP address from the request, the left-most X-Forwarded-For entry wins
+        if request is None:
+            return None
+        forwarded_for = request.headers.get('X-Forwarded-For')
+        if forwarded_for:
+            return forwarded_for.split(',')[0].strip()
+        return request.remote
+
+    def get_forward_headers(self, request):
+        headers = CIMultiDict((name, value) for name, value in request.headers.items()
+                              if name.lower() not in self.hop_by_hop_headers and name.lower() != 'host')
+        forwarded_for = request.headers.get('X-Forwarded-For')
+        headers['X-Forwarded-For'] = f'{forwarded_for}, {request.remote}' if forwarded_for else request.remote
+        headers['X-Forwarded-Host'] = request.host
+        headers['X-Forwarded-Proto'] = request.scheme
+        return headers
+
+    def validate(self, config):
+        # Raises ValueError if the 'load_balancer.upstream' section cannot be applied
+        protocol = (config or {}).get('protocol', self.transport.protocol)
+        if protocol not in (HTTP1Transport.protocol, HTTP2Transport.protocol):
+            raise ValueError(f"Unknown upstream protocol: {protocol}")
+
+    def configure(self, config):
+        # Apply the 'load_balancer.upstream' section of config.yaml
+        if not config:
+            return
+        self.validate(config)
+        protocol = config.get('protocol', self.transport.protocol)
+        if protocol != self.transport.protocol:
+            transport, self.transport = self.transport, (
+                HTTP2Transport(self.connection_pool, self.health_checker) if protocol == HTTP2Transport.protocol
+                else HTTP1Transport(self.connection_pool))
+            if self.health_checker is not None:
+                for vps in list(self.health_checker.stream_limits):
+                    self.health_checker.set_stream_limit(vps, None)
+            # Requests in flight finish on the old transport's connections
+            self.close_transport(transport)
+        if protocol == HTTP2Transport.protocol:
+            transport = self.transport
+            transport.connections_per_vps = config.get('connections_per_vps', transport.connections_per_vps)
+            transport.max_streams = config.get('max_streams', transport.max_streams)
+            transport.window_size = config.get('window_size', transport.window_size)
+        if self.health_checker is not None:
+            # Until a VPS reports its own limit in its SETTINGS, least_connections assumes the configured one
+            self.health_checker.set_default_stream_limit(
+                self.transport.max_streams * self.transport.connections_per_vps
+                if protocol == HTTP2Transport.protocol else None)
+
+    def close_transport(self, transport):
+        if not getattr(transport, 'connections', None):
+            return
+        task = asyncio.ensure_future(transport.close())
+        self.closing_transports.add(task)
+        task.add_done_callback(self.closing_transports.discard)
+
+    async def close(self):
+        await self.transport.close()
+        if self.closing_transports:
+            await asyncio.gather(*self.closing_transports, return_exceptions=True)
+
+    async def open_upstream(self, vps, request, headers=None):
+        # Send the request to the VPS and return once the response headers have arrived,
+        # the response body is left unread for relay_response
+        url = vps.rstrip('/') + str(request.rel_url)
+        data = request.content if request.body_exists else None
+        if headers is None:
+            headers = self.get_forward_headers(request)
+        try:
+            upstream = await self.transport.request(request.method, url, headers=headers, data=data, proxy=True)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise requests.exceptions.RequestException(str(e))
+        mark('ttfb')
+        return upstream
+
+    async def relay_response(self, vps, upstream, request, extra_headers=()):
+        # Stream the upstream response to the client chunk by chunk, nothing is buffered whole
+        response = web.StreamResponse(status=upstream.status, reason=upstream.reason)
+        for name, value in upstream.headers.items():
+            if name.lower() not in self.hop_by_hop_headers:
+                response.headers.add(name, value)
+        for name, value in extra_headers:
+            response.headers.add(name, value)
+        try:
+            await response.prepare(request)
+            async for chunk in upstream.content.iter_any():
+                await response.write(chunk)
+            await response.write_eof()
+            mark('body')
+            return response
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # The status line is already out, the only way to signal the failure is to drop the connection
+            raise ConnectionResetError(f"Upstream {vps} failed mid-response: {e}")
+        finally:
+            upstream.release()
+
+    async def forward_request(self, vps, request):
+        upstream = await self.open_upstream(vps, request)
+        return await self.relay_response(vps, upstream, request)
 
     async def send_request(self, vps):
+        # Sockets (or HTTP/2 streams) are reused across requests through the transport
+        try:
+            async with await self.transport.request('GET', vps) as response:
+                mark('ttfb')
+                if response.status == 200:
+                    text = await response.text()
+                    mark('body')
+                    return text
+                elif 400 <= response.status < 500:
+                    raise ClientStatusError(f"Request to {vps} was answered with status code {response.status}",
+                                            response.status)
+                else:
+                    raise requests.exceptions.RequestException(
+                        f"Request to {vps} failed with status code {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise requests.exceptions.RequestException(str(e))
+
+    async def fetch(self, vps, headers=None):
+        # Like send_request, but keeps the status and headers so the response can be cached
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(vps, timeout=5) as response:
-                    if response.status == 200:
-                        return await response.text()
-                    else:
-                        raise requests.exceptions.RequestException(
-                            f"Request to {vps} failed with status code {response.status}")
-        except aiohttp.ClientError as e:
+            async with await self.transport.request('GET', vps, headers=headers) as response:
+                # A 4xx is a final answer, some of them (404, 410) can be cached
+                if response.status >= 500:
+                    raise requests.exceptions.RequestException(
+                        f"Request to {vps} failed with status code {response.status}")
+                mark('ttfb')
+                body = await response.read()
+                mark('body')
+                return CachedResponse(response.status, response.headers, body)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
             raise requests.exceptions.RequestException(str(e))
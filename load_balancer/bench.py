@@ -0,0 +1,244 @@
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from aiohttp import web
+from load_balancer.balancer import LoadBalancer
+
+
+def get_free_ports(count):
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sockets.append(sock)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def sample_latency(distribution, mean):
+    if mean <= 0:
+        return 0
+    if distribution == 'exponential':
+        return random.expovariate(1 / mean)
+    if distribution == 'lognormal':
+        # sigma 1, scaled so the mean stays at the requested value
+        return random.lognormvariate(0, 1) * mean / 1.6487
+    return mean
+
+
+def run_backends(ports, args, ready):
+    # Stand-in VPS fleet, in its own process so its CPU time does not count against the balancer
+    async def serve():
+        runners = []
+        for i, port in enumerate(ports):
+            slow = i < args.slow_backends
+            mean = args.latency * (args.slow_factor if slow else 1)
+
+            async def handle(request, mean=mean):
+                await asyncio.sleep(sample_latency(args.latency_distribution, mean))
+                if random.random() < args.error_rate:
+                    return web.Response(status=500, text='error')
+                return web.Response(text='ok')
+
+            async def stats(request, mean=mean, slow=slow):
+                # Stand-in telemetry, slow backends report a busy machine
+                return web.json_response({'cpu_usage': (85 if slow else 30) + random.uniform(-5, 5),
+                                          'memory_usage': 50, 'latency': mean})
+
+            app = web.Application()
+            app.router.add_get('/stats', stats)
+            app.router.add_route('*', '/{path:.*}', handle)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, '127.0.0.1', port).start()
+            runners.append(runner)
+        ready.set()
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def bench_algorithm(algorithm, vps_list, args):
+    load_balancer = LoadBalancer(balancing_algorithm=algorithm)
+    load_balancer.connection_pool.max_connections = args.concurrency * 2
+    load_balancer.health_checker.set_vps_list(list(vps_list))
+    if args.trace:
+        load_balancer.tracer.sample_rate = 1.0
+        load_balancer.connection_pool.trace_configs = [load_balancer.tracer.get_trace_config()]
+    if args.telemetry:
+        load_balancer.telemetry_collector.enabled = True
+        load_balancer.telemetry_collector.interval = 0.5
+        await load_balancer.telemetry_collector.collect()
+        load_balancer.telemetry_collector.start()
+    client_ips = [f'10.{i // 65536}.{i // 256 % 256}.{i % 256}' for i in range(args.clients)]
+    try:
+        load_balancer.get_next_vps(client_ips[0])
+    except Exception as e:
+        await load_balancer.close()
+        return {'algorithm': algorithm, 'error': f'{type(e).__name__}: {e}'}
+
+    latencies = []
+    deadline = time.monotonic() + args.duration
+
+    async def client():
+        while time.monotonic() < deadline:
+            start_time = time.perf_counter()
+            await load_balancer.distribute_load(random.choice(client_ips))
+            latencies.append(time.perf_counter() - start_time)
+
+    cpu_start = os.times()
+    wall_start = time.monotonic()
+    try:
+        await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    finally:
+        await load_balancer.close()
+    wall_time = time.monotonic() - wall_start
+    cpu_end = os.times()
+
+    load_balancer.metrics.flush()
+    totals = load_balancer.metrics.vps_metrics.totals
+    counts = [totals[vps].requests if vps in totals else 0 for vps in vps_list]
+    errors = sum(stats.statuses.get('error', 0) for stats in totals.values())
+    latencies.sort()
+    requests = len(latencies)
+    cpu_time = (cpu_end.user - cpu_start.user) + (cpu_end.system - cpu_start.system)
+    mean_count = statistics.mean(counts) if counts else 0
+    stages = {stage: summary['mean_ms'] for stage, summary in load_balancer.metrics.get_stage_summary().items()}
+    return {
+        'algorithm': algorithm,
+        'requests': requests,
+        'errors': errors,
+        'throughput': requests / wall_time,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'cpu_us_per_request': cpu_time / requests * 1e6 if requests else 0.0,
+        # Coefficient of variation of the per-backend request counts, 0 means a perfectly even spread
+        'skew': statistics.pstdev(counts) / mean_count if mean_count else 0.0,
+        'distribution': counts,
+        'stages_ms': stages,
+    }
+
+
+def measure_import_time(module, runs):
+    # Cold start: each run imports the module in a fresh interpreter, so nothing is cached in sys.modules
+    script = (f"import sys, time; start = time.perf_counter(); import {module}; "
+              f"elapsed = time.perf_counter() - start; print(elapsed, len(sys.modules), "
+              f"' '.join(sorted(name for name in ('requests', 'yaml', 'dotenv', 'prometheus_client') "
+              f"if name in sys.modules)))")
+    times = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+        elapsed, module_count, *heavy = output.split()
+        times.append(float(elapsed) * 1000)
+    times.sort()
+    return {'module': module, 'median_ms': statistics.median(times), 'min_ms': times[0], 'max_ms': times[-1],
+            'modules_loaded': int(module_count), 'heavy_dependencies': heavy}
+
+
+def print_import_report(results, budget):
+    print(f"{'module':<30} {'median ms':>10} {'min ms':>8} {'max ms':>8} {'modules':>8}  heavy dependencies")
+    for result in results:
+        over = '  over budget' if budget and result['median_ms'] > budget else ''
+        print(f"{result['module']:<30} {result['median_ms']:>10.1f} {result['min_ms']:>8.1f} "
+              f"{result['max_ms']:>8.1f} {result['modules_loaded']:>8}  "
+              f"{' '.join(result['heavy_dependencies']) or '-'}{over}")
+
+
+def print_report(results):
+    print(f"{'algorithm':<30} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'cpu us/req':>10} {'skew':>6} {'errors':>7}  distribution")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['algorithm']:<30} failed: {result['error']}")
+            continue
+        print(f"{result['algorithm']:<30} {result['throughput']:>9.0f} {result['p50_ms']:>8.2f} "
+              f"{result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['cpu_us_per_request']:>10.1f} "
+              f"{result['skew']:>6.3f} {result['errors']:>7}  {result['distribution']}")
+        if result['stages_ms']:
+            print(' ' * 31 + 'stages (mean ms): ' + ' '.join(f'{stage}={mean_ms:.3f}'
+                                                              for stage, mean_ms in result['stages_ms'].items()))
+
+
+async def run(args):
+    ports = get_free_ports(args.backends)
+    vps_list = [f'http://127.0.0.1:{port}' for port in ports]
+    ready = multiprocessing.Event()
+    backends = multiprocessing.Process(target=run_backends, args=(ports, args, ready), daemon=True)
+    backends.start()
+    try:
+        if not ready.wait(10):
+            raise RuntimeError("Stand-in backends did not start")
+        return [await bench_algorithm(algorithm, vps_list, args) for algorithm in args.algorithms]
+    finally:
+        backends.terminate()
+        backends.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m load_balancer.bench',
+                                     description='Benchmark the balancing algorithms against local stand-in VPSes')
+    parser.add_argument('--algorithms', nargs='+', default=list(LoadBalancer.balancing_algorithms),
+                        choices=LoadBalancer.balancing_algorithms)
+    parser.add_argument('--backends', type=int, default=4, help='number of stand-in VPSes')
+    parser.add_argument('--concurrency', type=int, default=32, help='concurrent client loops')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per algorithm')
+    parser.add_argument('--clients', type=int, default=1000, help='distinct client IPs (for ip_hashing)')
+    parser.add_argument('--latency', type=float, default=0.005, help='mean backend latency in seconds')
+    parser.add_argument('--latency-distribution', default='exponential',
+                        choices=['constant', 'exponential', 'lognormal'])
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 500')
+    parser.add_argument('--slow-backends', type=int, default=0, help='how many VPSes are slower than the rest')
+    parser.add_argument('--slow-factor', type=float, default=5.0, help='latency multiplier of slow VPSes')
+    parser.add_argument('--telemetry', action='store_true',
+                        help='weight the VPSes by the load they report on /stats')
+    parser.add_argument('--import-time', nargs='*', metavar='MODULE',
+                        help='measure the cold import time of the modules instead '
+                             '(default: load_balancer.balancer)')
+    parser.add_argument('--import-runs', type=int, default=5, help='fresh interpreters per module')
+    parser.add_argument('--import-budget', type=float, default=0,
+                        help='fail if the median import time of a module exceeds this many ms')
+    parser.add_argument('--trace', action='store_true', help='time every request stage by stage')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    if args.import_time is not None:
+        results = [measure_import_time(module, args.import_runs)
+                   for module in args.import_time or ['load_balancer.balancer']]
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            print_import_report(results, args.import_budget)
+        if args.import_budget and any(result['median_ms'] > args.import_budget for result in results):
+            raise SystemExit(1)
+        return results
+
+    # Per-request log lines would dominate the measurement
+    logging.getLogger('load_balancer').setLevel(logging.CRITICAL)
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+    return results
+
+
+if __name__ == '__main__':
+    main()
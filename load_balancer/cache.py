@@ -0,0 +1,280 @@
+import asyncio
+import time
+import logging
+from collections import OrderedDict
+from multidict import CIMultiDict, CIMultiDictProxy
+from load_balancer.tracing import ensure_future_untraced
+
+logger = logging.getLogger(__name__)
+
+
+def parse_cache_control(value):
+    # 'public, max-age=60, stale-while-revalidate=30' -> {'public': None, 'max-age': '60', ...}
+    directives = {}
+    if not value:
+        return directives
+    for directive in value.split(','):
+        name, _, argument = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = argument.strip('"') if argument else None
+    return directives
+
+
+def parse_seconds(value, default=0):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return default
+
+
+class CachedResponse:
+    __slots__ = ('status', 'headers', 'body', 'size', 'stored_at', 'expires_at', 'stale_until')
+
+    # Stored separately or recomputed when the response is served from the cache
+    excluded_headers = frozenset(['connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te',
+                                  'trailers', 'transfer-encoding', 'upgrade', 'content-length', 'age'])
+
+    def __init__(self, status, headers, body=b''):
+        self.status = status
+        self.headers = CIMultiDictProxy(CIMultiDict((name, value) for name, value in headers.items()
+                                                    if name.lower() not in self.excluded_headers))
+        self.body = body
+        self.size = len(body) + sum(len(name) + len(value) for name, value in self.headers.items()) + 200
+        self.stored_at = 0.0
+        self.expires_at = 0.0
+        self.stale_until = 0.0
+
+    @property
+    def etag(self):
+        return self.headers.get('ETag')
+
+    @property
+    def last_modified(self):
+        return self.headers.get('Last-Modified')
+
+    def get_age(self, now=None):
+        now = time.monotonic() if now is None else now
+        return int(now - self.stored_at)
+
+    def matches(self, if_none_match):
+        # Weak comparison, as required for If-None-Match (RFC 7232, section 3.2)
+        etag = self.etag
+        if not etag or not if_none_match:
+            return False
+        if if_none_match.strip() == '*':
+            return True
+        etag = etag[2:] if etag.startswith('W/') else etag
+        for candidate in if_none_match.split(','):
+            candidate = candidate.strip()
+            if (candidate[2:] if candidate.startswith('W/') else candidate) == etag:
+                return True
+        return False
+
+
+class ResponseCache:
+    cacheable_statuses = frozenset([200, 203, 300, 301, 404, 410])
+    # Client validators are answered from the cache, the upstream only sees the cache's own
+    conditional_headers = ('If-None-Match', 'If-Modified-Since')
+
+    def __init__(self, max_size=64 * 1024 * 1024, max_entry_size=1024 * 1024, default_ttl=0,
+                 stale_while_revalidate=0):
+        self.enabled = False
+        # Total bytes of bodies and headers kept, least recently used entries are evicted first
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        # Freshness of responses without max-age / s-maxage (0 - such responses are not cached)
+        self.default_ttl = default_ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.entries = OrderedDict()
+        self.size = 0
+        # Request headers named by the Vary header of the last response, per (method, url)
+        self.vary = {}
+        # Single-flight: one upstream fetch per key, concurrent misses wait for its result
+        self.inflight = {}
+        self.revalidations = set()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, config):
+        # Apply the 'load_balancer.cache' section of config.yaml
+        if not config:
+            return
+        self.enabled = config.get('enabled', self.enabled)
+        self.max_size = config.get('max_size', self.max_size)
+        self.max_entry_size = config.get('max_entry_size', self.max_entry_size)
+        self.default_ttl = config.get('default_ttl', self.default_ttl)
+        self.stale_while_revalidate = config.get('stale_while_revalidate', self.stale_while_revalidate)
+        self.evict()
+
+    def is_cacheable_request(self, method, headers):
+        if method != 'GET' or 'Authorization' in headers:
+            return False
+        return 'no-store' not in parse_cache_control(headers.get('Cache-Control'))
+
+    def get_freshness(self, status, headers):
+        # (ttl, stale_while_revalidate) in seconds, or None if the response must not be stored
+        if status not in self.cacheable_statuses or 'Set-Cookie' in headers:
+            return None
+        if headers.get('Vary', '').strip() == '*':
+            return None
+        cache_control = parse_cache_control(headers.get('Cache-Control'))
+        if 'no-store' in cache_control or 'private' in cache_control:
+            return None
+        stale_while_revalidate = parse_seconds(cache_control.get('stale-while-revalidate'),
+                                               self.stale_while_revalidate)
+        if 'no-cache' in cache_control:
+            # Stored, but revalidated with the VPS before every use
+            ttl, stale_while_revalidate = 0, 0
+        elif 's-maxage' in cache_control:
+            ttl = parse_seconds(cache_control['s-maxage'])
+        elif 'max-age' in cache_control:
+            ttl = parse_seconds(cache_control['max-age'])
+        else:
+            ttl = self.default_ttl
+        if ttl <= 0 and 'ETag' not in headers and 'Last-Modified' not in headers:
+            return None
+        return ttl, stale_while_revalidate
+
+    def is_storable(self, status, headers, content_length):
+        # Checked on the response headers, before the body is read
+        return (content_length is not None and content_length <= self.max_entry_size
+                and self.get_freshness(status, headers) is not None)
+
+    def get_key(self, method, url, headers):
+        return (method, url) + tuple(headers.get(name, '') for name in self.vary.get((method, url), ()))
+
+    def get_conditional_headers(self, entry):
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        return headers
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def store(self, method, url, request_headers, response, now=None):
+        freshness = self.get_freshness(response.status, response.headers)
+        if freshness is None or response.size > self.max_entry_size:
+            return False
+        now = time.monotonic() if now is None else now
+        ttl, stale_while_revalidate = freshness
+        response.stored_at = now
+        response.expires_at = now + ttl
+        response.stale_until = response.expires_at + stale_while_revalidate
+        vary = tuple(name.strip() for name in response.headers.get('Vary', '').split(',') if name.strip())
+        if vary:
+            self.vary[(method, url)] = vary
+        else:
+            self.vary.pop((method, url), None)
+        key = self.get_key(method, url, request_headers)
+        self.discard(key)
+        self.entries[key] = response
+        self.size += response.size
+        self.evict()
+        return True
+
+    def refresh(self, method, url, request_headers, entry, not_modified, now=None):
+        # A 304 confirms the stored body, its headers update the stored ones (RFC 7234, section 4.3.4)
+        headers = CIMultiDict(entry.headers)
+        headers.update(not_modified.headers)
+        response = CachedResponse(entry.status, headers, entry.body)
+        if not self.store(method, url, request_headers, response, now):
+            self.discard(self.get_key(method, url, request_headers))
+        return response
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def evict(self):
+        while self.size > self.max_size and self.entries:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+
+    def clear(self):
+        self.entries.clear()
+        self.vary.clear()
+        self.size = 0
+
+    async def get(self, method, url, request_headers, fetch, release=None):
+        # fetch(conditional_headers) -> coroutine returning a CachedResponse, which is stored if cacheable,
+        # or any other object (e.g. a response being streamed), which is returned as is and never shared.
+        # release(response) disposes of such an object when a background revalidation got it.
+        # Returns (response, cache_status), cache_status is one of HIT, STALE, REVALIDATED, MISS
+        now = time.monotonic()
+        key = self.get_key(method, url, request_headers)
+        entry = self.lookup(key)
+        if entry is not None:
+            if now < entry.expires_at:
+                self.hits += 1
+                return entry, 'HIT'
+            if now < entry.stale_until:
+                # Serve the stale copy right away and bring it up to date in the background
+                self.hits += 1
+                if key not in self.inflight:
+                    task = ensure_future_untraced(self.revalidate(key, method, url, request_headers, entry, fetch,
+                                                                  release))
+                    self.revalidations.add(task)
+                    task.add_done_callback(self.finish_revalidation)
+                return entry, 'STALE'
+
+        future = self.inflight.get(key)
+        if future is not None:
+            response, response_key = await asyncio.shield(future)
+            if response is not None:
+                if self.get_key(method, url, request_headers) == response_key:
+                    self.hits += 1
+                    return response, 'HIT'
+                # The response named a Vary header this request differs in, look up its own variant
+                return await self.get(method, url, request_headers, fetch, release)
+            # The shared fetch failed or its response cannot be shared, fetch on our own
+            self.misses += 1
+            return await fetch({}), 'MISS'
+        return await self.fetch(key, method, url, request_headers, entry, fetch)
+
+    async def fetch(self, key, method, url, request_headers, entry, fetch):
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = future
+        shared = None
+        shared_key = None
+        try:
+            response = await fetch(self.get_conditional_headers(entry))
+            if not isinstance(response, CachedResponse):
+                return response, 'MISS'
+            if response.status == 304 and entry is not None:
+                shared = self.refresh(method, url, request_headers, entry, response)
+                shared_key = self.get_key(method, url, request_headers)
+                return shared, 'REVALIDATED'
+            if self.store(method, url, request_headers, response):
+                shared = response
+                shared_key = self.get_key(method, url, request_headers)
+            return response, 'MISS'
+        finally:
+            del self.inflight[key]
+            # Waiters only take the response if it is the variant they asked for, see get
+            future.set_result((shared, shared_key))
+
+    async def revalidate(self, key, method, url, request_headers, entry, fetch, release):
+        response, _ = await self.fetch(key, method, url, request_headers, entry, fetch)
+        if not isinstance(response, CachedResponse) and release is not None:
+            # The VPS answered with something that cannot be stored, nobody is waiting for it
+            release(response)
+
+    def finish_revalidation(self, task):
+        self.revalidations.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"Cache revalidation failed: {task.exception()}")
+
+    async def close(self):
+        for task in list(self.revalidations):
+            task.cancel()
+        if self.revalidations:
+            await asyncio.gather(*self.revalidations, return_exceptions=True)
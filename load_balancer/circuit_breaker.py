@@ -0,0 +1,163 @@
+import time
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, consecutive_errors=5, error_rate=0.5, window=10.0, min_requests=20, buckets=10):
+        self.consecutive_errors = consecutive_errors
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.bucket_width = window / buckets
+        # Rolling error-rate window: per bucket [epoch, requests, failures]
+        self.buckets = [[-1, 0, 0] for _ in range(buckets)]
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.ejections = 0
+        self.trials = 0
+        self.trial_successes = 0
+
+    def record(self, is_success, now):
+        epoch = int(now / self.bucket_width)
+        bucket = self.buckets[epoch % len(self.buckets)]
+        if bucket[0] != epoch:
+            bucket[0], bucket[1], bucket[2] = epoch, 0, 0
+        bucket[1] += 1
+        if is_success:
+            self.consecutive_failures = 0
+        else:
+            bucket[2] += 1
+            self.consecutive_failures += 1
+
+    def should_trip(self, now):
+        if self.consecutive_failures >= self.consecutive_errors:
+            return True
+        oldest_epoch = int(now / self.bucket_width) - len(self.buckets) + 1
+        requests = failures = 0
+        for epoch, bucket_requests, bucket_failures in self.buckets:
+            if epoch >= oldest_epoch:
+                requests += bucket_requests
+                failures += bucket_failures
+        return requests >= self.min_requests and failures >= requests * self.error_rate
+
+    def open(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.ejections += 1
+        self.trials = 0
+        self.trial_successes = 0
+
+    def close(self):
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.ejections = 0
+        for bucket in self.buckets:
+            bucket[0], bucket[1], bucket[2] = -1, 0, 0
+
+
+class OutlierDetector:
+    # Passive outlier ejection driven by the results of live traffic:
+    # closed -> open (ejected for ejection_time * number of consecutive ejections, up to max_ejection_time)
+    # -> half_open (only half_open_requests trial requests at a time) -> closed after that many successes
+    def __init__(self, consecutive_errors=5, error_rate=0.5, window=10.0, min_requests=20, ejection_time=30.0,
+                 max_ejection_time=300.0, max_ejection_percent=50, half_open_requests=1):
+        self.consecutive_errors = consecutive_errors
+        self.error_rate = error_rate
+        self.window = window
+        self.min_requests = min_requests
+        self.ejection_time = ejection_time
+        self.max_ejection_time = max_ejection_time
+        self.max_ejection_percent = max_ejection_percent
+        self.half_open_requests = half_open_requests
+        self.breakers = {}
+        self.ejected_count = 0
+
+    def configure(self, config):
+        # Apply the 'load_balancer.outlier_detection' section of config.yaml
+        if not config:
+            return
+        self.consecutive_errors = config.get('consecutive_errors', self.consecutive_errors)
+        self.error_rate = config.get('error_rate', self.error_rate)
+        self.window = config.get('window', self.window)
+        self.min_requests = config.get('min_requests', self.min_requests)
+        self.ejection_time = config.get('ejection_time', self.ejection_time)
+        self.max_ejection_time = config.get('max_ejection_time', self.max_ejection_time)
+        self.max_ejection_percent = config.get('max_ejection_percent', self.max_ejection_percent)
+        self.half_open_requests = config.get('half_open_requests', self.half_open_requests)
+
+    def get_breaker(self, vps):
+        breaker = self.breakers.get(vps)
+        if breaker is None:
+            breaker = self.breakers[vps] = CircuitBreaker(self.consecutive_errors, self.error_rate,
+                                                          self.window, self.min_requests)
+        return breaker
+
+    def get_state(self, vps):
+        breaker = self.breakers.get(vps)
+        return breaker.state if breaker is not None else CircuitBreaker.CLOSED
+
+    def get_ejection_time(self, vps):
+        return min(self.ejection_time * self.get_breaker(vps).ejections, self.max_ejection_time)
+
+    def is_ejected(self, vps):
+        breaker = self.breakers.get(vps)
+        if breaker is None or breaker.state == CircuitBreaker.CLOSED:
+            return False
+        if breaker.state == CircuitBreaker.OPEN:
+            return True
+        return breaker.trials >= self.half_open_requests
+
+    def on_request(self, vps):
+        # Returns True when the VPS has to leave the rotation because its trial slots are used up
+        breaker = self.breakers.get(vps)
+        if breaker is None or breaker.state != CircuitBreaker.HALF_OPEN:
+            return False
+        breaker.trials += 1
+        return breaker.trials >= self.half_open_requests
+
+    def record(self, vps, is_success, pool_size, now=None):
+        # Returns True when the ejection state of the VPS changed
+        now = time.monotonic() if now is None else now
+        breaker = self.get_breaker(vps)
+        if breaker.state == CircuitBreaker.HALF_OPEN:
+            breaker.trials = max(breaker.trials - 1, 0)
+            if not is_success:
+                if (self.ejected_count + 1) * 100 > pool_size * self.max_ejection_percent:
+                    # Stays half-open, the freed trial slot may bring it back into rotation
+                    breaker.trial_successes = 0
+                    return True
+                breaker.open(now)
+                self.ejected_count += 1
+                return True
+            breaker.trial_successes += 1
+            if breaker.trial_successes >= self.half_open_requests:
+                breaker.close()
+            return True
+        if breaker.state == CircuitBreaker.OPEN:
+            # Late results of requests sent before the ejection
+            return False
+        breaker.record(is_success, now)
+        if not is_success and breaker.should_trip(now):
+            if (self.ejected_count + 1) * 100 > pool_size * self.max_ejection_percent:
+                # Never eject more than max_ejection_percent of the pool, a struggling VPS beats no VPS
+                return False
+            breaker.open(now)
+            self.ejected_count += 1
+            return True
+        return False
+
+    def half_open(self, vps):
+        breaker = self.breakers.get(vps)
+        if breaker is not None and breaker.state == CircuitBreaker.OPEN:
+            breaker.state = CircuitBreaker.HALF_OPEN
+            self.ejected_count -= 1
+            return True
+        return False
+
+    def forget(self, vps):
+        breaker = self.breakers.pop(vps, None)
+        if breaker is not None and breaker.state == CircuitBreaker.OPEN:
+            self.ejected_count -= 1
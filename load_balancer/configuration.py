@@ -1,7 +1,5 @@
-import yaml
 import json
 import os
-import dotenv
 
 
 class Configuration:
@@ -24,6 +22,7 @@ class Configuration:
         self.last_modified = os.path.getmtime(self.config_file)
 
     def load_from_yaml(self):
+        import yaml
         with open(self.config_file, 'r') as file:
             self.config = yaml.safe_load(file)
 
@@ -34,6 +33,7 @@ class Configuration:
     def save(self):
         file_extension = self.get_file_extension()
         if file_extension == 'yaml':
+            import yaml
             with open(self.config_file, 'w') as file:
                 yaml.safe_dump(self.config, file)
         elif file_extension == 'json':
@@ -63,6 +63,7 @@ class Configuration:
         return self.config_file.rsplit('.', 1)[-1]
 
     def load_from_environment_variables(self, prefix=''):
+        import dotenv
         dotenv.load_dotenv()
         for key, value in os.environ.items():
             if key.startswith(prefix):
@@ -0,0 +1,53 @@
+import aiohttp
+
+
+class ConnectionPool:
+    def __init__(self, max_connections=100, max_connections_per_vps=0, timeout=5, keepalive_timeout=15):
+        # max_connections is the global socket limit, max_connections_per_vps limits each backend (0 - no limit)
+        self.max_connections = max_connections
+        self.max_connections_per_vps = max_connections_per_vps
+        self.timeout = timeout
+        # Idle keep-alive sockets are evicted after keepalive_timeout seconds
+        self.keepalive_timeout = keepalive_timeout
+        # aiohttp.TraceConfig hooks of both sessions, see load_balancer.tracing
+        self.trace_configs = []
+        self.session = None
+        self.proxy_session = None
+
+    def configure(self, config):
+        # Apply the 'load_balancer' section of config.yaml
+        if not config:
+            return
+        self.max_connections = config.get('max_connections', self.max_connections)
+        self.max_connections_per_vps = config.get('max_connections_per_vps', self.max_connections_per_vps)
+        self.timeout = config.get('timeout', self.timeout)
+        self.keepalive_timeout = config.get('keepalive_timeout', self.keepalive_timeout)
+
+    def get_session(self):
+        # The session is created lazily because it has to be bound to the running event loop
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections,
+                                             limit_per_host=self.max_connections_per_vps,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(connector=connector,
+                                                 timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                                 trace_configs=self.trace_configs or None)
+        return self.session
+
+    def get_proxy_session(self):
+        # Shares the pooled sockets but leaves bodies compressed, so they can be relayed untouched
+        if self.proxy_session is None or self.proxy_session.closed:
+            self.proxy_session = aiohttp.ClientSession(connector=self.get_session().connector,
+                                                       connector_owner=False,
+                                                       auto_decompress=False,
+                                                       timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                                       trace_configs=self.trace_configs or None)
+        return self.proxy_session
+
+    async def close(self):
+        if self.proxy_session is not None and not self.proxy_session.closed:
+            await self.proxy_session.close()
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        self.proxy_session = None
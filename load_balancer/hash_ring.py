@@ -0,0 +1,90 @@
+import bisect
+import hashlib
+import heapq
+import math
+
+
+def stable_hash(key):
+    # Unlike the builtin hash(), this is identical in every process and across restarts
+    return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+
+class ConsistentHashRing:
+    def __init__(self, vps_list=(), replicas=160, load_factor=1.25):
+        # replicas - virtual nodes per VPS, load_factor - the "bounded loads" c: no VPS takes
+        # more than ceil(c * average load) while another candidate is below that bound
+        self.replicas = replicas
+        self.load_factor = load_factor
+        self.points = []
+        self.owners = {}
+        self.nodes = set()
+        self.add_all(vps_list)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def copy(self):
+        # Copies the ring without rehashing anything
+        hash_ring = ConsistentHashRing(replicas=self.replicas, load_factor=self.load_factor)
+        hash_ring.points = list(self.points)
+        hash_ring.owners = dict(self.owners)
+        hash_ring.nodes = set(self.nodes)
+        return hash_ring
+
+    def add(self, vps):
+        self.add_all((vps,))
+
+    def add_all(self, vps_list):
+        # The new points are sorted once and merged into the ring in a single pass, a point two VPSes
+        # hash to stays with the one added first
+        points = []
+        for vps in vps_list:
+            if vps in self.nodes:
+                continue
+            self.nodes.add(vps)
+            for i in range(self.replicas):
+                point = stable_hash(f'{vps}#{i}')
+                if point not in self.owners:
+                    self.owners[point] = vps
+                    points.append(point)
+        if points:
+            points.sort()
+            self.points = list(heapq.merge(self.points, points)) if self.points else points
+
+    def remove(self, vps):
+        if vps not in self.nodes:
+            return
+        self.nodes.discard(vps)
+        removed = set()
+        for i in range(self.replicas):
+            point = stable_hash(f'{vps}#{i}')
+            if self.owners.get(point) == vps:
+                del self.owners[point]
+                removed.add(point)
+        self.points = [point for point in self.points if point not in removed]
+
+    def get(self, key, loads=None, total_load=0, is_available=None, available_count=None):
+        if not self.points:
+            return None
+
+        capacity = None
+        if loads is not None:
+            available_count = available_count or len(self.nodes)
+            capacity = math.ceil(self.load_factor * (total_load + 1) / available_count)
+
+        # Walk clockwise from the key until a VPS is available and below the load bound
+        start = bisect.bisect(self.points, stable_hash(key))
+        visited = set()
+        fallback = None
+        for i in range(len(self.points)):
+            vps = self.owners[self.points[(start + i) % len(self.points)]]
+            if vps in visited:
+                continue
+            visited.add(vps)
+            if is_available is None or is_available(vps):
+                if capacity is None or loads.get(vps, 0) < capacity:
+                    return vps
+                fallback = fallback or vps
+            if len(visited) == len(self.nodes):
+                break
+        return fallback
@@ -1,63 +1,350 @@
 import random
-import requests
-from datetime import datetime
-import subprocess
+import asyncio
+import itertools
+from urllib.parse import urlsplit
 import logging
-from functools import lru_cache
+import aiohttp
+from load_balancer.connection_pool import ConnectionPool
+from load_balancer.selection import WeightedRoundRobin, AliasTable, LazyMinHeap
+from load_balancer.routing import RoutingSnapshot
+from load_balancer.latency import PeakEWMA
+from load_balancer.circuit_breaker import OutlierDetector, CircuitBreaker
+from load_balancer.backend import Backend
+from load_balancer.zones import ZoneRouter
+from load_balancer.remediation import FailureHandler
+from load_balancer.slow_start import SlowStart
 
 
 class HealthChecker:
-    def __init__(self):
-        self.vps_list = []
+    def __init__(self, check_type='http', path='/', interval=5, timeout=2, rise=2, fall=3,
+                 response_time_decay=10.0, default_response_time=0.1):
+        # Backends and ip_hashing ring, replaced as a whole on every membership change
+        self.routing = RoutingSnapshot()
         self.active_connections = {}
-        self.cache = {}
+        self.total_connections = 0
+        # Backends currently in rotation: not failing the health checks and not ejected as outliers
+        self.healthy_vps = set()
+        # Backends failing the active health checks
+        self.down_vps = set()
+        # Passive circuit breakers fed by the results of live traffic
+        self.outlier_detector = OutlierDetector()
+        # Consecutive probe successes (positive) or failures (negative) per VPS
+        self.health_counters = {}
+        self.check_type = check_type
+        self.path = path
+        self.interval = interval
+        self.timeout = timeout
+        self.rise = rise
+        self.fall = fall
+        # Runs the failure script for backends marked as down
+        self.failure_handler = FailureHandler(self)
+        # Weight ramp of the backends that just joined the rotation
+        self.slow_start = SlowStart()
+        self.connection_pool = None
+        self.health_check_task = None
+        # Multi-process mode: state shared with the other workers, see load_balancer.workers
+        self.shared_state = None
+        self.worker_index = 0
+        self.shared_sync_interval = 0.5
+        self.shared_sync_task = None
+        # Active connections of the other workers, refreshed from the shared state
+        self.remote_connections = {}
+        # Per-VPS records: inventory attributes and the reported telemetry, see load_balancer.telemetry
+        self.backends = {}
+        # Zone-aware routing, only backends of the local zone are in rotation unless it spills over
+        self.zone_router = ZoneRouter()
+        # get_weight of an idle VPS with weight 1
+        self.weight_scale = 100
+        # Lowest reported latency among the backends in rotation, slower ones get proportionally less weight
+        self.fastest_latency = None
+        # Weighted selection state. Marked stale when membership, health or weights change, the next weighted
+        # pick then updates the scheduler for the backends whose weight moved, the alias table is rebuilt
+        self.weights = {}
+        self.weights_stale = True
+        # Every backend in rotation reports full load and all got weight 1
+        self.even_weights = False
+        self.weighted_round_robin = WeightedRoundRobin()
+        self.alias_table = None
+        # Healthy backends as a tuple for O(1) random picks, with the running total of their slow start factors
+        self.available_vps = None
+        self.available_factors = None
+        # Healthy backends keyed by active connections for least_connections
+        self.connections_index = LazyMinHeap()
+        # Concurrent HTTP/2 streams each VPS accepts, see load_balancer.transport. least_connections
+        # then compares the share of its streams in use rather than the raw count
+        self.stream_limits = {}
+        # Stream capacity assumed while a VPS has not reported its own, None unless HTTP/2 is in use
+        self.default_stream_limit = None
+        # Peak-EWMA of the response times measured on live traffic, in seconds
+        self.response_times = {}
+        self.response_time_decay = response_time_decay
+        self.default_response_time = default_response_time
+        # Healthy backends keyed by response time * (active connections + 1) for least_response_time
+        self.response_time_index = LazyMinHeap()
+
+    def configure(self, config):
+        # Apply the 'load_balancer.health_check' section of config.yaml
+        if not config:
+            return
+        self.check_type = config.get('type', self.check_type)
+        self.path = config.get('path', self.path)
+        self.interval = config.get('interval', self.interval)
+        self.timeout = config.get('timeout', self.timeout)
+        self.rise = config.get('rise', self.rise)
+        self.fall = config.get('fall', self.fall)
+        self.response_time_decay = config.get('response_time_decay', self.response_time_decay)
+        self.default_response_time = config.get('default_response_time', self.default_response_time)
+        replicas = config.get('hash_replicas', self.hash_ring.replicas)
+        load_factor = config.get('hash_load_factor', self.hash_ring.load_factor)
+        if replicas != self.hash_ring.replicas or load_factor != self.hash_ring.load_factor:
+            self.routing = RoutingSnapshot(self.vps_list, replicas=replicas, load_factor=load_factor,
+                                           backends=self.routing.backends)
+
+    @property
+    def vps_list(self):
+        return self.routing.vps_list
+
+    @property
+    def hash_ring(self):
+        # ip_hashing ring, contains every VPS so health flaps do not remap other clients
+        return self.routing.hash_ring
+
+    def build_routing_snapshot(self, vps_list):
+        # Pure function of its input, safe to run in an executor while the loop keeps serving
+        return RoutingSnapshot(vps_list, replicas=self.hash_ring.replicas, load_factor=self.hash_ring.load_factor)
+
+    def apply_routing_snapshot(self, snapshot):
+        # Unchanged backends keep their health, latency and connection state
+        for vps in self.routing.vps_list:
+            if vps not in snapshot:
+                self.forget_vps(vps)
+        for url, backend in snapshot.backends.items():
+            if url in self.backends:
+                self.backends[url].update_inventory(backend)
+            else:
+                self.backends[url] = backend
+        routing, self.routing = self.routing, snapshot
+        # Backends of the initial list are all equally cold, only ones joining a serving pool ramp up
+        is_serving = bool(self.healthy_vps)
+        for vps in snapshot.vps_list:
+            # New backends start in rotation until the health checks prove otherwise,
+            # a changed zone may move known ones in or out
+            if vps not in routing and is_serving:
+                self.begin_slow_start(vps)
+            if vps not in routing or self.zone_router.zone is not None:
+                self.publish_availability(vps)
+        self.update_zone_routing()
+        self.invalidate_selection_tables()
 
     def set_vps_list(self, vps_list):
-        self.vps_list = vps_list
+        self.apply_routing_snapshot(self.build_routing_snapshot(vps_list))
 
     def add_vps(self, vps):
-        if vps not in self.vps_list:
-            self.vps_list.append(vps)
+        if (vps.url if isinstance(vps, Backend) else vps) not in self.routing:
+            self.apply_routing_snapshot(self.routing.with_vps(vps))
 
     def remove_vps(self, vps):
-        if vps in self.vps_list:
-            self.vps_list.remove(vps)
-            if vps in self.active_connections:
-                del self.active_connections[vps]
-            self.cache.clear()  # Clear the cache when a VPS is removed
+        if vps in self.routing:
+            self.apply_routing_snapshot(self.routing.without_vps(vps))
+
+    def forget_vps(self, vps):
+        if vps in self.active_connections:
+            self.total_connections -= self.active_connections.pop(vps)
+        self.healthy_vps.discard(vps)
+        self.down_vps.discard(vps)
+        self.outlier_detector.forget(vps)
+        self.health_counters.pop(vps, None)
+        self.response_times.pop(vps, None)
+        self.backends.pop(vps, None)
+        self.stream_limits.pop(vps, None)
+        self.failure_handler.forget_vps(vps)
+        self.slow_start.forget(vps)
+        self.remove_from_indexes(vps)
+
+    def refresh_availability(self, vps):
+        # Publish whether the VPS should be in rotation after its health or ejection state changed
+        self.publish_availability(vps)
+        self.update_zone_routing()
+
+    def is_up(self, vps):
+        return vps in self.routing and vps not in self.down_vps and not self.outlier_detector.is_ejected(vps)
+
+    def publish_availability(self, vps):
+        available = self.is_up(vps) and self.zone_router.allows(self.backends.get(vps))
+        if available and vps not in self.healthy_vps:
+            self.healthy_vps.add(vps)
+            self.add_to_indexes(vps)
+            self.invalidate_selection_tables()
+        elif not available and vps in self.healthy_vps:
+            self.healthy_vps.discard(vps)
+            self.remove_from_indexes(vps)
+            self.invalidate_selection_tables()
+
+    def record_result(self, vps, is_success):
+        # Outcome of a live request, drives the per-VPS circuit breaker
+        if not self.outlier_detector.record(vps, is_success, len(self.routing)):
+            return
+        self.refresh_availability(vps)
+        state = self.outlier_detector.get_state(vps)
+        if state == CircuitBreaker.OPEN:
+            ejection_time = self.outlier_detector.get_ejection_time(vps)
+            logging.warning(f"VPS ejected for {ejection_time}s: {vps}")
+            asyncio.get_running_loop().call_later(ejection_time, self.readmit_vps, vps)
+        elif state == CircuitBreaker.CLOSED:
+            logging.info(f"VPS circuit closed: {vps}")
+
+    def update_zone_routing(self):
+        # Recomputes the local zone's health and capacity, moves the other zones in or out of rotation
+        zone_router = self.zone_router
+        if zone_router.zone is None:
+            return
+        local_vps = [vps for vps in self.vps_list if zone_router.is_local(self.backends.get(vps))]
+        healthy_backends = [self.backends[vps] for vps in local_vps if self.is_up(vps)]
+        local_connections = sum(self.active_connections.get(vps, 0) for vps in local_vps)
+        if zone_router.update(len(local_vps), healthy_backends, local_connections):
+            for vps in self.vps_list:
+                self.publish_availability(vps)
+
+    def refresh_zone_routing(self):
+        # After a configuration change, re-evaluate which backends are in rotation if the zone changed
+        self.update_zone_routing()
+        if self.zone_router.applied_zone != self.zone_router.zone:
+            self.zone_router.applied_zone = self.zone_router.zone
+            for vps in self.vps_list:
+                self.publish_availability(vps)
+
+    def readmit_vps(self, vps):
+        # Ejection time is over, let trial requests through (half-open)
+        if self.outlier_detector.half_open(vps):
+            self.refresh_availability(vps)
+
+    def add_to_indexes(self, vps):
+        self.connections_index.update(vps, self.get_connections_score(vps))
+        self.response_time_index.update(vps, self.get_response_time_score(vps))
+
+    def remove_from_indexes(self, vps):
+        self.connections_index.remove(vps)
+        self.response_time_index.remove(vps)
+
+    def begin_slow_start(self, vps):
+        if self.slow_start.begin(vps):
+            logging.info(f"VPS in slow start for {self.slow_start.window}s: {vps}")
+            self.refresh_slow_start_weight(vps)
+
+    def refresh_slow_start(self):
+        # Called before every pick, a no-op unless a backend is ramping up and the interval is over
+        if not self.slow_start:
+            return
+        for vps in self.slow_start.update():
+            if vps not in self.slow_start:
+                logging.info(f"VPS finished slow start: {vps}")
+            self.refresh_slow_start_weight(vps)
+
+    def refresh_slow_start_weight(self, vps):
+        self.available_factors = None
+        if vps in self.connections_index:
+            self.add_to_indexes(vps)
+        if vps in self.weights:
+            self.update_selection_weight(vps)
+
+    def update_selection_weight(self, vps):
+        # A single backend's weight moved (slow start tick): adjusted in place rather than recomputing them all,
+        # unless that changes whether the fleet is balanced evenly
+        if self.weights_stale:
+            return
+        weight = self.slow_start.scale_weight(vps, self.get_shared_weight(vps))
+        if weight <= 0 or self.even_weights:
+            self.invalidate_selection_tables()
+        elif weight != self.weights[vps]:
+            self.weights[vps] = weight
+            self.weighted_round_robin.set_weight(vps, weight)
+            self.alias_table = None
+
+    def invalidate_selection_tables(self):
+        self.weights_stale = True
+        self.available_vps = None
+        self.available_factors = None
+
+    def get_available_vps(self):
+        if self.available_vps is None:
+            self.available_vps = tuple(vps for vps in self.vps_list if self.check_health(vps))
+        return self.available_vps
+
+    def update_selection_tables(self):
+        weights = {}
+        for vps in self.vps_list:
+            if self.check_health(vps):
+                weight = self.slow_start.scale_weight(vps, self.get_shared_weight(vps))
+                if weight > 0:
+                    weights[vps] = weight
+        self.even_weights = not weights
+        if not weights:
+            # Every VPS in rotation reports full load, spread the traffic evenly rather than refuse it
+            weights = {vps: 1 for vps in self.vps_list if self.check_health(vps)}
+        if weights != self.weights:
+            for vps in self.weights:
+                if vps not in weights:
+                    self.weighted_round_robin.remove(vps)
+            for vps, weight in weights.items():
+                self.weighted_round_robin.set_weight(vps, weight)
+            self.weights = weights
+            self.alias_table = None
+        self.weights_stale = False
+
+    def refresh_weights(self, threshold=0):
+        # Rebuild the weighted tables if any backend weight moved by more than threshold (relative)
+        # since the last build, small fluctuations of the telemetry keep the current tables
+        latencies = [self.backends[vps].latency for vps in self.healthy_vps
+                     if vps in self.backends and self.backends[vps].latency]
+        self.fastest_latency = min(latencies) if latencies else None
+        for vps in self.vps_list:
+            if not self.check_health(vps):
+                continue
+            current_weight = self.weights.get(vps, 0)
+            weight = self.slow_start.scale_weight(vps, self.get_weight(vps))
+            if (weight == 0) != (current_weight == 0) or abs(weight - current_weight) > current_weight * threshold:
+                self.invalidate_selection_tables()
+                return
 
     def get_next_available_vps(self):
-        available_vps = [vps for vps in self.vps_list if self.check_health(vps)]
+        available_vps = self.get_available_vps()
 
         if not available_vps:
             raise Exception("No VPS available for load balancing")
+        if self.slow_start:
+            if self.available_factors is None:
+                self.available_factors = list(itertools.accumulate(self.slow_start.get_factor(vps)
+                                                                   for vps in available_vps))
+            return random.choices(available_vps, cum_weights=self.available_factors)[0]
 
         return random.choice(available_vps)
 
     def get_least_connections_vps(self):
-        min_connections_vps = None
-        min_connections = float('inf')
-
-        for vps in self.vps_list:
-            connections = self.active_connections.get(vps, 0)
-            if connections < min_connections and self.check_health(vps):
-                min_connections = connections
-                min_connections_vps = vps
+        min_connections_vps = self.connections_index.peek()
 
         if min_connections_vps is None:
             raise Exception("No VPS available for load balancing")
 
         return min_connections_vps
 
-    def get_least_response_time_vps(self):
-        min_response_time_vps = None
-        min_response_time = float('inf')
+    def get_p2c_vps(self):
+        # Power of two random choices: the less loaded of two random healthy backends
+        available_vps = self.get_available_vps()
 
-        for vps in self.vps_list:
-            response_time = self.get_response_time(vps)
-            if response_time < min_response_time and self.check_health(vps):
-                min_response_time = response_time
-                min_response_time_vps = vps
+        if not available_vps:
+            raise Exception("No VPS available for load balancing")
+        if len(available_vps) == 1:
+            return available_vps[0]
+
+        first, second = random.sample(available_vps, 2)
+        slow_start = self.slow_start
+        if slow_start.scale_load(second, self.get_active_connections(second)) \
+                < slow_start.scale_load(first, self.get_active_connections(first)):
+            return second
+        return first
+
+    def get_least_response_time_vps(self):
+        min_response_time_vps = self.response_time_index.peek()
 
         if min_response_time_vps is None:
             raise Exception("No VPS available for load balancing")
@@ -65,110 +352,297 @@ class HealthChecker:
         return min_response_time_vps
 
     def get_next_weighted_vps(self):
-        weighted_vps = []
-
-        for vps in self.vps_list:
-            weight = self.get_weight(vps)
-            if weight > 0 and self.check_health(vps):
-                weighted_vps.extend([vps] * weight)
+        if self.weights_stale:
+            self.update_selection_tables()
 
-        if not weighted_vps:
+        if not self.weighted_round_robin:
             raise Exception("No VPS available for load balancing")
 
-        return random.choice(weighted_vps)
+        return self.weighted_round_robin.next()
 
     def get_ip_hashing_vps(self, client_ip):
-        # IP Hashing
-        ip_hash = hash(client_ip) % len(self.vps_list)
-        return self.vps_list[ip_hash]
+        # Consistent hashing with bounded loads, adding or removing a VPS only remaps its own clients
+        is_available = self.check_health
+        if self.slow_start:
+            # A backend in slow start takes over a growing, stable share of the clients it owns on the ring
+            def is_available(vps):
+                return self.check_health(vps) and self.slow_start.admits(vps, client_ip)
+        vps = self.hash_ring.get(client_ip, self.active_connections, self.total_connections,
+                                 is_available, len(self.healthy_vps))
+        if vps is None and self.slow_start:
+            vps = self.hash_ring.get(client_ip, self.active_connections, self.total_connections,
+                                     self.check_health, len(self.healthy_vps))
+
+        if vps is None:
+            raise Exception("No VPS available for load balancing")
 
-    def get_random_weighted_vps(self):
-        weighted_vps = []
+        return vps
 
-        for vps in self.vps_list:
-            weight = self.get_weight(vps)
-            if weight > 0 and self.check_health(vps):
-                weighted_vps.extend([vps] * weight)
+    def get_random_weighted_vps(self):
+        if self.weights_stale:
+            self.update_selection_tables()
 
-        if not weighted_vps:
+        if not self.weights:
             raise Exception("No VPS available for load balancing")
+        if self.alias_table is None:
+            self.alias_table = AliasTable(self.weights)
 
-        return random.choice(weighted_vps)
+        return self.alias_table.next()
 
-    @lru_cache(maxsize=None)  # Caching the check_health results
     def check_health(self, vps):
-        # Checking the status of the VPS, such as checking the availability of ports
-        # Return True if VPS is up, False otherwise
+        # Return True if VPS is up, False otherwise. The state is maintained by run_health_checks,
+        # so this never blocks the request path
+        return vps in self.healthy_vps
+
+    def attach_shared_state(self, shared_state, worker_index, sync_interval=0.5):
+        # Only the first worker probes the backends, the others follow the published health state
+        self.shared_state = shared_state
+        self.worker_index = worker_index
+        self.shared_sync_interval = sync_interval
+
+    def owns_health_checks(self):
+        return self.shared_state is None or self.worker_index == 0
+
+    def start(self):
+        if self.health_check_task is None and self.owns_health_checks():
+            self.health_check_task = asyncio.ensure_future(self.run_health_checks())
+        if self.shared_sync_task is None and self.shared_state is not None:
+            self.shared_sync_task = asyncio.ensure_future(self.run_shared_state_sync())
+
+    async def stop(self):
+        for task in (self.health_check_task, self.shared_sync_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.health_check_task = None
+        self.shared_sync_task = None
+        await self.failure_handler.stop()
+        if self.connection_pool is not None:
+            await self.connection_pool.close()
+
+    async def run_health_checks(self):
+        while True:
+            await self.check_all()
+            await asyncio.sleep(self.interval)
+
+    async def run_shared_state_sync(self):
+        while True:
+            self.sync_shared_state()
+            self.refresh_response_times()
+            await asyncio.sleep(self.shared_sync_interval)
+
+    def sync_shared_state(self):
+        shared_state = self.shared_state
+        for vps in self.vps_list:
+            if vps not in shared_state:
+                continue
+            if not self.owns_health_checks():
+                is_up = shared_state.is_healthy(vps)
+                if is_up == (vps in self.down_vps):
+                    if is_up:
+                        self.down_vps.discard(vps)
+                        self.begin_slow_start(vps)
+                    else:
+                        self.down_vps.add(vps)
+                    self.refresh_availability(vps)
+                weight = self.slow_start.scale_weight(vps, shared_state.get_weight(vps))
+                if not self.weights_stale and vps in self.healthy_vps and weight >= 0 \
+                        and weight != self.weights.get(vps, 0):
+                    self.invalidate_selection_tables()
+            remote_connections = shared_state.get_connections(vps, exclude_worker=self.worker_index)
+            if remote_connections != self.remote_connections.get(vps, 0):
+                self.remote_connections[vps] = remote_connections
+                if vps in self.connections_index:
+                    self.add_to_indexes(vps)
+
+    def get_shared_weight(self, vps):
+        if self.shared_state is None or vps not in self.shared_state:
+            return self.get_weight(vps)
+        if self.owns_health_checks():
+            weight = self.get_weight(vps)
+            self.shared_state.set_weight(vps, weight)
+            return weight
+        weight = self.shared_state.get_weight(vps)
+        return weight if weight >= 0 else self.get_weight(vps)
+
+    async def check_all(self):
+        vps_list = list(self.vps_list)
+        results = await asyncio.gather(*(self.probe(vps) for vps in vps_list))
+        for vps, is_up in zip(vps_list, results):
+            self.update_health(vps, is_up)
+        self.refresh_response_times()
+
+    async def probe(self, vps):
         try:
-            # Example: ICMP ping to check VPS health
-            ping_cmd = ['ping', '-c', '1', '-W', '1', vps]
-            result = subprocess.run(ping_cmd, capture_output=True, text=True)
-            if result.returncode == 0:
-                # VPS is up, check if it was previously marked as down
-                if vps in self.cache and not self.cache[vps]:
-                    # VPS was previously marked as down, enable it for load balancing again
-                    self.cache[vps] = True
-                    logging.info(f"VPS is available again: {vps}")
-                return True
-            else:
-                self.remove_vps(vps)  # Remove an unhealthy VPS from the list
-                self.handle_failure(vps)  # Handling a VPS Issue
-                return False
-        except subprocess.CalledProcessError:
-            self.remove_vps(vps)  # Remove an unhealthy VPS from the list
-            self.handle_failure(vps)  # Handling a VPS Issue
+            if self.check_type == 'tcp':
+                return await self.probe_tcp(vps)
+            return await self.probe_http(vps)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
             return False
 
+    async def probe_http(self, vps):
+        if self.connection_pool is None:
+            # Probes use their own pool so they do not compete with client traffic for connections
+            self.connection_pool = ConnectionPool(max_connections=0, timeout=self.timeout)
+        session = self.connection_pool.get_session()
+        backend = self.backends.get(vps)
+        path = backend.health_path if backend is not None and backend.health_path else self.path
+        async with session.get(vps.rstrip('/') + path) as response:
+            return response.status < 500
+
+    async def probe_tcp(self, vps):
+        url = urlsplit(vps if '//' in vps else f'//{vps}')
+        port = url.port or (443 if url.scheme == 'https' else 80)
+        _, writer = await asyncio.wait_for(asyncio.open_connection(url.hostname, port), self.timeout)
+        writer.close()
+        return True
+
+    def update_health(self, vps, is_up):
+        if vps not in self.routing:
+            return
+        counter = self.health_counters.get(vps, 0)
+        if is_up:
+            counter = counter + 1 if counter > 0 else 1
+            if counter >= self.rise and vps in self.down_vps:
+                # VPS was previously marked as down, enable it for load balancing again, ramping up.
+                # The response times measured while it was failing say nothing about it any more
+                self.down_vps.discard(vps)
+                self.response_times.pop(vps, None)
+                self.begin_slow_start(vps)
+                self.refresh_availability(vps)
+                logging.info(f"VPS is available again: {vps}")
+        else:
+            counter = counter - 1 if counter < 0 else -1
+            if -counter >= self.fall and vps not in self.down_vps:
+                self.down_vps.add(vps)
+                self.refresh_availability(vps)
+                logging.error(f"VPS is down: {vps}")
+                self.handle_failure(vps)
+        self.health_counters[vps] = counter
+        if self.shared_state is not None and vps in self.shared_state:
+            self.shared_state.set_health(vps, vps not in self.down_vps)
+
     def get_response_time(self, vps):
-        # Get response time from VPS
+        # Get response time from VPS, measured passively on real traffic
         # Return response time in milliseconds
-        try:
-            start_time = datetime.now()
-            response = requests.head(vps)
-            end_time = datetime.now()
-            response_time = (end_time - start_time).total_seconds() * 1000
-            return response_time
-        except requests.exceptions.RequestException:
-            return float('inf')
+        response_time = self.response_times.get(vps)
+        if response_time is None:
+            return self.default_response_time * 1000
+        return response_time.get() * 1000
+
+    def refresh_response_times(self):
+        # Re-scores least_response_time with the decayed estimates, live traffic only updates the VPSes it hits
+        for vps in self.response_times:
+            if vps in self.response_time_index:
+                self.response_time_index.update(vps, self.get_response_time_score(vps))
+
+    def record_response_time(self, vps, response_time):
+        # response_time in seconds, as measured around RequestHandler.send_request
+        if vps not in self.response_times:
+            self.response_times[vps] = PeakEWMA(self.response_time_decay, self.default_response_time)
+        self.response_times[vps].observe(response_time)
+        if vps in self.response_time_index:
+            self.response_time_index.update(vps, self.get_response_time_score(vps))
+
+    def get_response_time_score(self, vps):
+        # Expected wait on this VPS: its latency scaled by the requests already queued on it
+        active_connections = self.slow_start.scale_load(vps, self.get_active_connections(vps))
+        return self.get_response_time(vps) * (active_connections + 1)
+
+    def get_backend(self, vps):
+        backend = self.backends.get(vps)
+        if backend is None:
+            backend = self.backends[vps] = Backend(vps)
+        return backend
 
     def get_weight(self, vps):
-        # Example: Assigning weights based on VPS attributes or performance metrics
-        if vps.cpu_usage < 80 and vps.memory_usage < 80:
-            # If CPU usage and memory usage are below 80%, assign weight 2
-            return 2
-        elif vps.cpu_usage < 90 or vps.memory_usage < 90:
-            # If either CPU usage or memory usage is below 90%, assign weight 1
-            return 1
-        else:
-            # If both CPU usage and memory usage are above 90%, assign weight 0
-            return 0
+        # Continuous weight from the VPS telemetry: its configured weight scaled by the headroom of its
+        # busiest resource (CPU or memory) and by how much slower it answers than the fastest VPS.
+        # A saturated VPS gets weight 0 and drops out of the weighted algorithms
+        backend = self.backends.get(vps)
+        if backend is None:
+            return self.weight_scale
+        factor = backend.get_headroom()
+        if backend.latency and self.fastest_latency:
+            factor *= min(self.fastest_latency / backend.latency, 1.0)
+        return int(round(backend.weight * self.weight_scale * factor))
 
     def increase_connection_count(self, vps):
+        self.total_connections += 1
         if vps in self.active_connections:
             self.active_connections[vps] += 1
         else:
             self.active_connections[vps] = 1
+        if self.outlier_detector.on_request(vps):
+            self.refresh_availability(vps)
+        self.publish_connection_count(vps)
+        if vps in self.connections_index:
+            self.add_to_indexes(vps)
+        zone_router = self.zone_router
+        if zone_router.zone is not None and zone_router.is_local(self.backends.get(vps)):
+            zone_router.local_connections += 1
+            if not zone_router.spilling_over and zone_router.is_overloaded():
+                self.update_zone_routing()
 
     def decrease_connection_count(self, vps):
         if vps in self.active_connections:
             if self.active_connections[vps] > 0:
                 self.active_connections[vps] -= 1
+                self.total_connections -= 1
+                self.publish_connection_count(vps)
+                if vps in self.connections_index:
+                    self.add_to_indexes(vps)
+                zone_router = self.zone_router
+                if zone_router.zone is not None and zone_router.is_local(self.backends.get(vps)):
+                    zone_router.local_connections -= 1
+                    if zone_router.spilling_over and not zone_router.short_of_backends \
+                            and not zone_router.is_overloaded():
+                        self.update_zone_routing()
+
+    def publish_connection_count(self, vps):
+        if self.shared_state is not None and vps in self.shared_state:
+            self.shared_state.set_connections(self.worker_index, vps, self.active_connections[vps])
+
+    def get_connections_score(self, vps):
+        stream_limit = self.stream_limits.get(vps, self.default_stream_limit)
+        active_connections = self.slow_start.scale_load(vps, self.get_active_connections(vps))
+        return active_connections / stream_limit if stream_limit else active_connections
+
+    def set_stream_limit(self, vps, stream_limit):
+        # None - the VPS is not reached over HTTP/2 (any more)
+        if self.stream_limits.get(vps) == stream_limit or (stream_limit is not None and vps not in self.routing):
+            return
+        if stream_limit is None:
+            self.stream_limits.pop(vps, None)
+        else:
+            self.stream_limits[vps] = stream_limit
+        if vps in self.connections_index:
+            self.add_to_indexes(vps)
+
+    def set_default_stream_limit(self, stream_limit):
+        if stream_limit == self.default_stream_limit:
+            return
+        self.default_stream_limit = stream_limit
+        for vps in self.healthy_vps:
+            if vps not in self.stream_limits and vps in self.connections_index:
+                self.add_to_indexes(vps)
 
     def get_active_connections(self, vps):
-        return self.active_connections.get(vps, 0)
+        # Includes the connections other workers have open to this VPS in multi-process mode
+        return self.active_connections.get(vps, 0) + self.remote_connections.get(vps, 0)
 
     def handle_failure(self, vps):
-        # Handling an issue with the VPS, such as a reboot or scaling
-        # This example just prints an error message
-        logging.error(f"Problem with VPS: {vps}. Error handling in progress...")
-
-        command = f"handle_vps_failure.sh {vps}"
-        try:
-            subprocess.run(command, shell=True, check=True)
-            logging.info(f"VPS error handling done: {vps}")
-        except subprocess.CalledProcessError as e:
-            logging.error(f"Error processing VPS error: {vps}, return code: {e.returncode}")
-
-        # If the VPS is marked as down, update the cache
-        if vps not in self.cache or not self.cache[vps]:
-            self.cache[vps] = False
+        # Handling an issue with the VPS, such as a reboot or scaling, runs in the background
+        self.failure_handler.submit(vps)
+
+    async def handle_failure_result(self, vps, is_success):
+        # A successful failure script counts as a passed check, one more passing probe brings the VPS back
+        # right away instead of after the next health check round. A failed one leaves it down
+        if vps not in self.routing or vps not in self.down_vps or not is_success:
+            return
+        self.health_counters[vps] = max(self.health_counters.get(vps, 0), self.rise - 1)
+        is_up = await self.probe(vps)
+        self.update_health(vps, is_up)
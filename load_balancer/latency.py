@@ -0,0 +1,54 @@
+import math
+import time
+
+
+class PeakEWMA:
+    def __init__(self, decay=10.0, initial=0.1):
+        # decay - time constant in seconds, initial - assumed response time before the first sample
+        self.decay = decay
+        self.initial = initial
+        self.value = initial
+        self.timestamp = time.monotonic()
+
+    def observe(self, response_time, now=None):
+        now = time.monotonic() if now is None else now
+        if response_time > self.value:
+            # Latency spikes are taken immediately, improvements are averaged in over time
+            self.value = response_time
+        else:
+            weight = math.exp(-max(now - self.timestamp, 0) / self.decay)
+            self.value = self.value * weight + response_time * (1 - weight)
+        self.timestamp = now
+        return self.value
+
+    def get(self, now=None):
+        # Without new samples the estimate falls back to the initial one at the same pace, so a VPS
+        # that got no traffic after a slow response is tried again instead of being avoided for good
+        now = time.monotonic() if now is None else now
+        weight = math.exp(-max(now - self.timestamp, 0) / self.decay)
+        return self.value * weight + self.initial * (1 - weight)
+
+
+class LatencyQuantile:
+    def __init__(self, quantile=0.95, size=1024, min_samples=20):
+        # Quantile of the last size samples, re-sorted every size // 8 samples rather than on every read
+        self.quantile = quantile
+        self.samples = [0.0] * size
+        self.count = 0
+        self.min_samples = min_samples
+        self.value = None
+
+    def observe(self, response_time):
+        self.samples[self.count % len(self.samples)] = response_time
+        self.count += 1
+        refresh_every = len(self.samples) // 8
+        if self.count < refresh_every or self.count % refresh_every == 0:
+            self.value = None
+
+    def get(self):
+        if self.count < self.min_samples:
+            return None
+        if self.value is None:
+            samples = sorted(self.samples[:min(self.count, len(self.samples))])
+            self.value = samples[min(int(len(samples) * self.quantile), len(samples) - 1)]
+        return self.value
@@ -1,42 +1,161 @@
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+import random
+import threading
+from logging.handlers import RotatingFileHandler, QueueHandler
 from logging import StreamHandler
 import sys
 
 
+class BatchFlushMixin:
+    # StreamHandler.emit flushes after every record, here the writer thread flushes once per batch
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class BatchRotatingFileHandler(BatchFlushMixin, RotatingFileHandler):
+    pass
+
+
+class BatchStreamHandler(BatchFlushMixin, StreamHandler):
+    pass
+
+
+class LogWriter:
+    # Drains the log queue on a background thread, so disk and console I/O never run on the event loop
+    def __init__(self, log_queue, handlers, batch_size=512):
+        self.queue = log_queue
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='load_balancer-log-writer', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is None:
+                    continue
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            for handler in self.handlers:
+                handler.flush_batch()
+            if None in batch:
+                return
+
+
 class Logger:
-    def __init__(self, log_file='log.txt', log_level=logging.INFO):
+    def __init__(self, log_file='log.txt', log_level=logging.INFO, rotation_size=10 * 1024 * 1024, backup_count=5,
+                 error_file='error.log', success_sample_rate=1.0, console=True):
         self.logger = logging.getLogger('load_balancer')
-        self.logger.setLevel(log_level)
+        self.log_file = log_file
+        self.log_level = log_level
+        self.rotation_size = rotation_size
+        self.backup_count = backup_count
+        self.error_file = error_file
+        # Share of successful requests that are logged, errors are always logged
+        self.success_sample_rate = success_sample_rate
+        self.console = console
+        self.queue_handler = None
+        self.writer = None
+        self.error_file_handler = None
+
+    def configure(self, config):
+        # Apply the 'load_balancer.logging' section of config.yaml
+        if not config:
+            return
+        self.log_level = config.get('level', self.log_level)
+        self.log_file = config.get('file', self.log_file)
+        self.rotation_size = config.get('rotation_size', self.rotation_size)
+        self.backup_count = config.get('backup_count', self.backup_count)
+        self.error_file = config.get('error_file', self.error_file)
+        self.success_sample_rate = config.get('success_sample_rate', self.success_sample_rate)
+        self.console = config.get('console', self.console)
+
+    def start(self):
+        if self.writer is not None:
+            return
+        self.logger.setLevel(self.log_level)
 
         # Log entry format
         log_format = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+        handlers = []
 
         # Handler for writing to a file with rotation
-        file_handler = RotatingFileHandler(log_file, maxBytes=1024, backupCount=5)
+        file_handler = BatchRotatingFileHandler(self.log_file, maxBytes=self.rotation_size,
+                                                backupCount=self.backup_count, delay=True)
         file_handler.setFormatter(log_format)
-        self.logger.addHandler(file_handler)
+        handlers.append(file_handler)
 
         # Handler for writing to the console
-        console_handler = StreamHandler(sys.stdout)
-        console_handler.setFormatter(log_format)
-        self.logger.addHandler(console_handler)
+        if self.console:
+            console_handler = BatchStreamHandler(sys.stdout)
+            console_handler.setFormatter(log_format)
+            handlers.append(console_handler)
 
         # Separate file handlers for different log levels
-        self.error_file_handler = RotatingFileHandler('error.log', maxBytes=1024, backupCount=5)
+        self.error_file_handler = BatchRotatingFileHandler(self.error_file, maxBytes=self.rotation_size,
+                                                           backupCount=self.backup_count, delay=True)
         self.error_file_handler.setLevel(logging.ERROR)
         self.error_file_handler.setFormatter(log_format)
-        self.logger.addHandler(self.error_file_handler)
+        handlers.append(self.error_file_handler)
+
+        log_queue = queue.SimpleQueue()
+        self.writer = LogWriter(log_queue, handlers)
+        self.writer.start()
+        self.queue_handler = QueueHandler(log_queue)
+        self.logger.addHandler(self.queue_handler)
+
+    def stop(self):
+        if self.writer is None:
+            return
+        self.logger.removeHandler(self.queue_handler)
+        self.writer.stop()
+        for handler in self.writer.handlers:
+            handler.close()
+        self.queue_handler = None
+        self.writer = None
 
     def set_log_level(self, log_level):
         self.logger.setLevel(log_level)
 
+    def sampled(self):
+        return self.success_sample_rate >= 1.0 or random.random() < self.success_sample_rate
+
     def log_request_success(self, vps):
-        self.logger.info(f"The request was successfully processed on the VPS: {vps}")
+        if self.sampled():
+            self.logger.info("The request was successfully processed on the VPS: %s", vps)
 
     def log_request_error(self, vps, error):
-        self.logger.error(f"An error occurred on the VPS: {vps}")
-        self.logger.error(f"Error: {error}")
+        self.logger.error("An error occurred on the VPS: %s, error: %s", vps, error)
+
+    def log_access(self, client_ip, method, path, vps, status, response_time, bytes_sent):
+        # Compact key=value access record, sampled unless the request failed
+        if status is not None and status < 500 and not self.sampled():
+            return
+        level = logging.INFO if status is not None and status < 500 else logging.ERROR
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, "access client=%s method=%s path=%s vps=%s status=%s time_ms=%.1f bytes=%d",
+                            client_ip, method, path, vps, status if status is not None else '-',
+                            response_time * 1000, bytes_sent)
 
     def log_debug(self, message):
         self.logger.debug(message)
@@ -49,14 +168,6 @@ class Logger:
 
     def log_error(self, message):
         self.logger.error(message)
-        self.error_file_handler.emit(logging.makeLogRecord({
-            'levelname': 'ERROR',
-            'message': message
-        }))
 
     def log_critical(self, message):
         self.logger.critical(message)
-        self.error_file_handler.emit(logging.makeLogRecord({
-            'levelname': 'CRITICAL',
-            'message': message
-        }))
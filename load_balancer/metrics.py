@@ -1,38 +1,41 @@
-import random
-from prometheus_client import Counter, Histogram, Gauge, CollectorRegistry, start_http_server
+import os
+import time
+import pickle
+import asyncio
+import bisect
 import logging
 
 logger = logging.getLogger(__name__)
 
+# prometheus_client is imported where it is first used, importing this module has no side effects
+# and does not pay for it. Same as prometheus_client.Histogram.DEFAULT_BUCKETS without +Inf
+DEFAULT_BUCKETS = [.005, .01, .025, .05, .075, .1, .25, .5, .75, 1.0, 2.5, 5.0, 7.5, 10.0]
+# Stages of a request are often well below a millisecond
+STAGE_BUCKETS = [.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0]
+
 
 class RequestMetrics:
     def __init__(self, registry):
+        from prometheus_client import Counter
         self.request_counter = Counter('load_balancer_requests_total', 'Total Requests', registry=registry)
 
-    def increment(self):
-        self.request_counter.inc()
-
-
-class ResponseTimeMetrics:
-    def __init__(self, registry):
-        self.response_time_histogram = Histogram('load_balancer_response_time_seconds', 'Response time per second',
-                                                 registry=registry)
-
-    def observe(self, response_time):
-        self.response_time_histogram.observe(response_time)
+    def increment(self, amount=1):
+        self.request_counter.inc(amount)
 
 
 class ConnectionMetrics:
     def __init__(self, registry):
+        from prometheus_client import Counter
         self.connections_counter = Counter('load_balancer_active_connections_total',
                                            'Total number of active connections', registry=registry)
 
-    def increment(self):
-        self.connections_counter.inc()
+    def increment(self, amount=1):
+        self.connections_counter.inc(amount)
 
 
 class ThroughputMetrics:
     def __init__(self, registry):
+        from prometheus_client import Gauge
         self.throughput_gauge = Gauge('load_balancer_throughput_bytes', 'Data transfer bandwidth in bytes',
                                       registry=registry)
 
@@ -42,6 +45,7 @@ class ThroughputMetrics:
 
 class ResourceUsageMetrics:
     def __init__(self, registry):
+        from prometheus_client import Gauge
         self.resource_usage_gauge = Gauge('load_balancer_resource_usage_percent',
                                           'Percentage of System Resource Usage', registry=registry)
 
@@ -51,6 +55,7 @@ class ResourceUsageMetrics:
 
 class AnomalyMetrics:
     def __init__(self, registry):
+        from prometheus_client import Counter
         self.anomaly_counter = Counter('load_balancer_anomalies_total', 'Total number of detected anomalies',
                                        registry=registry)
 
@@ -58,62 +63,314 @@ class AnomalyMetrics:
         self.anomaly_counter.inc()
 
 
-class VPSMetrics:
-    def __init__(self, vps):
-        self.vps = vps
-        self.response_time_histogram = Histogram('vps_response_time_seconds',
-                                                 'Response time per second for VPS',
-                                                 ['vps'])
+class BackendStats:
+    __slots__ = ('requests', 'statuses', 'response_time_sum', 'buckets', 'bytes_in', 'bytes_out')
+
+    def __init__(self, bucket_count):
+        self.requests = 0
+        self.statuses = {}
+        self.response_time_sum = 0.0
+        self.buckets = [0] * bucket_count
+        self.bytes_in = 0
+        self.bytes_out = 0
 
-    def observe(self, response_time):
-        self.response_time_histogram.labels(self.vps).observe(response_time)
+    def merge(self, other):
+        self.requests += other.requests
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.response_time_sum += other.response_time_sum
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+
+
+class VPSMetrics:
+    # Custom collector: per-VPS totals are published by Metrics.flush and read on scrape,
+    # so nothing is registered per backend and the request path never touches prometheus_client
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.totals = {}
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, HistogramMetricFamily
+        totals = self.totals
+        requests = CounterMetricFamily('vps_requests', 'Requests per VPS and status', labels=['vps', 'status'])
+        bytes_in = CounterMetricFamily('vps_received_bytes', 'Bytes received from the VPS', labels=['vps'])
+        bytes_out = CounterMetricFamily('vps_sent_bytes', 'Bytes sent to the VPS', labels=['vps'])
+        response_time = HistogramMetricFamily('vps_response_time_seconds', 'Response time per second for VPS',
+                                              labels=['vps'])
+        overall = BackendStats(len(self.buckets) + 1)
+        for vps, stats in totals.items():
+            for status, count in stats.statuses.items():
+                requests.add_metric([vps, status], count)
+            bytes_in.add_metric([vps], stats.bytes_in)
+            bytes_out.add_metric([vps], stats.bytes_out)
+            response_time.add_metric([vps], self.cumulative_buckets(stats), stats.response_time_sum)
+            overall.merge(stats)
+        total_response_time = HistogramMetricFamily('load_balancer_response_time_seconds',
+                                                    'Response time per second')
+        total_response_time.add_metric([], self.cumulative_buckets(overall), overall.response_time_sum)
+        return [requests, bytes_in, bytes_out, response_time, total_response_time]
+
+    def cumulative_buckets(self, stats):
+        buckets = []
+        count = 0
+        for bound, bucket_count in zip(self.buckets + [float('inf')], stats.buckets):
+            count += bucket_count
+            buckets.append(('+Inf' if bound == float('inf') else str(bound), count))
+        return buckets
+
+
+class StageMetrics(VPSMetrics):
+    # Custom collector for the per-stage timings of traced requests, see load_balancer.tracing
+    def collect(self):
+        from prometheus_client.core import HistogramMetricFamily
+        stage_seconds = HistogramMetricFamily('load_balancer_stage_seconds', 'Time spent per request stage',
+                                              labels=['stage'])
+        for stage, stats in self.totals.items():
+            stage_seconds.add_metric([stage], self.cumulative_buckets(stats), stats.response_time_sum)
+        return [stage_seconds]
+
+
+class WorkerMetrics:
+    # Custom collector of the parent process in multi-worker mode, see load_balancer.workers: every worker
+    # writes a snapshot of its totals to directory when it flushes, a scrape merges the latest ones
+    def __init__(self, directory, buckets, stage_buckets):
+        self.directory = directory
+        self.buckets = buckets
+        self.stage_buckets = stage_buckets
+
+    def read_snapshots(self):
+        snapshots = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith('.pickle'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), 'rb') as file:
+                    snapshots.append(pickle.load(file))
+            except (OSError, EOFError, pickle.UnpicklingError) as e:
+                logger.warning(f"Worker metrics not readable from {name}: {e}")
+        return snapshots
+
+    def merge(self, totals, other):
+        for key, stats in other.items():
+            merged = totals.get(key)
+            if merged is None:
+                merged = totals[key] = BackendStats(len(stats.buckets))
+            merged.merge(stats)
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+        snapshots = self.read_snapshots()
+        vps_metrics = VPSMetrics(self.buckets)
+        stage_metrics = StageMetrics(self.stage_buckets)
+        for snapshot in snapshots:
+            self.merge(vps_metrics.totals, snapshot['vps'])
+            self.merge(stage_metrics.totals, snapshot['stages'])
+
+        def total(name):
+            return sum(snapshot[name] for snapshot in snapshots)
+
+        families = [
+            CounterMetricFamily('load_balancer_requests', 'Total Requests', value=total('requests')),
+            CounterMetricFamily('load_balancer_active_connections', 'Total number of active connections',
+                                value=total('connections')),
+            GaugeMetricFamily('load_balancer_throughput_bytes', 'Data transfer bandwidth in bytes',
+                              value=total('throughput')),
+            GaugeMetricFamily('load_balancer_resource_usage_percent', 'Percentage of System Resource Usage',
+                              value=total('resource_usage')),
+            CounterMetricFamily('load_balancer_anomalies', 'Total number of detected anomalies',
+                                value=total('anomalies')),
+        ]
+        return families + vps_metrics.collect() + stage_metrics.collect()
 
 
 class Metrics:
-    def __init__(self):
+    def __init__(self, flush_interval=1.0, address='0.0.0.0', port=9090):
+        from prometheus_client import CollectorRegistry
+        self.enabled = True
+        # Prometheus exporter, bound once by setup() on the configured address and port
+        self.address = address
+        self.port = port
+        self.exporter_started = False
+        # Multi-worker mode: file the totals are written to on every flush, the parent process exports them
+        self.export_path = None
         self.registry = CollectorRegistry()
         self.request_metrics = RequestMetrics(self.registry)
-        self.response_time_metrics = ResponseTimeMetrics(self.registry)
         self.connection_metrics = ConnectionMetrics(self.registry)
         self.throughput_metrics = ThroughputMetrics(self.registry)
         self.resource_usage_metrics = ResourceUsageMetrics(self.registry)
         self.anomaly_metrics = AnomalyMetrics(self.registry)
-        self.vps_metrics = {}
+        self.response_time_buckets = list(DEFAULT_BUCKETS)
+        self.vps_metrics = VPSMetrics(self.response_time_buckets)
+        self.registry.register(self.vps_metrics)
+        self.stage_metrics = StageMetrics(list(STAGE_BUCKETS))
+        self.registry.register(self.stage_metrics)
+        self.pending_stages = {}
+        # Requests recorded since the last flush, only ever touched from the event loop thread
+        self.pending = {}
+        self.flush_interval = flush_interval
+        self.flush_task = None
+        self.active_connections = None
+        self.last_flush_time = time.monotonic()
+        self.last_cpu_time = self.get_cpu_time()
+        self.window_requests = 0
+        self.window_response_time = None
 
     def setup(self):
-        # Initializing the metric collection system (for example, connecting to Prometheus or Graphite)
-        start_http_server(8000)
-
-    def update_metrics(self, response):
-        self._update_request_metrics()
-        self._update_response_time_metrics()
-        self._update_connection_metrics()
-        self._update_throughput_metrics()
-        self._update_resource_usage_metrics()
-        self.analyze_metrics()
-
-    def _update_request_metrics(self):
-        self.request_metrics.increment()
-
-    def _update_response_time_metrics(self):
-        response_time = random.uniform(0.1, 0.5)
-        self.response_time_metrics.observe(response_time)
-
-    def _update_connection_metrics(self):
-        self.connection_metrics.increment()
-
-    def _update_throughput_metrics(self):
-        data_throughput = random.uniform(100, 1000)
-        self.throughput_metrics.set(data_throughput)
-
-    def _update_resource_usage_metrics(self):
-        resource_usage = random.uniform(0, 100)
-        self.resource_usage_metrics.set(resource_usage)
+        # Initializing the metric collection system (for example, connecting to Prometheus or Graphite).
+        # Part of the startup sequence, after configure(), later calls keep the exporter already bound
+        if not self.enabled or self.exporter_started or self.export_path is not None:
+            return
+        from prometheus_client import start_http_server
+        try:
+            start_http_server(self.port, addr=self.address, registry=self.registry)
+            self.exporter_started = True
+        except OSError as e:
+            logger.warning(f"Metrics server not started on {self.address}:{self.port}: {e}")
+
+    def export_to(self, path):
+        # Worker process: leaves the exporter to the parent and hands it the totals through path
+        self.export_path = path
+
+    def setup_workers(self, directory):
+        # Parent process: the exporter serves the merged totals the workers write to directory
+        # instead of the metrics of this process, which serves no traffic
+        from prometheus_client import CollectorRegistry
+        self.registry = CollectorRegistry()
+        self.registry.register(WorkerMetrics(directory, self.response_time_buckets, self.stage_metrics.buckets))
+        self.setup()
+
+    def export(self):
+        snapshot = {
+            'vps': self.vps_metrics.totals,
+            'stages': self.stage_metrics.totals,
+            'requests': self.request_metrics.request_counter._value.get(),
+            'connections': self.connection_metrics.connections_counter._value.get(),
+            'throughput': self.throughput_metrics.throughput_gauge._value.get(),
+            'resource_usage': self.resource_usage_metrics.resource_usage_gauge._value.get(),
+            'anomalies': self.anomaly_metrics.anomaly_counter._value.get(),
+        }
+        # Replaced in one step, the parent never reads a partly written snapshot
+        temporary_path = self.export_path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            pickle.dump(snapshot, file)
+        os.replace(temporary_path, self.export_path)
+
+    def configure(self, config):
+        # Apply the 'load_balancer.metrics' section of config.yaml
+        if not config:
+            return
+        self.enabled = config.get('enabled', self.enabled)
+        self.flush_interval = config.get('flush_interval', self.flush_interval)
+        if not self.exporter_started:
+            self.address = config.get('address', self.address)
+            self.port = config.get('port', self.port)
+
+    def record_request(self, vps, response_time, status=None, bytes_in=0, bytes_out=0):
+        # Hot path: a few integer updates, prometheus_client is only touched by flush()
+        stats = self.pending.get(vps)
+        if stats is None:
+            stats = self.pending[vps] = BackendStats(len(self.response_time_buckets) + 1)
+        stats.requests += 1
+        status = 'error' if status is None else str(status)
+        stats.statuses[status] = stats.statuses.get(status, 0) + 1
+        stats.response_time_sum += response_time
+        stats.buckets[bisect.bisect_left(self.response_time_buckets, response_time)] += 1
+        stats.bytes_in += bytes_in
+        stats.bytes_out += bytes_out
+
+    def record_stage(self, stage, seconds):
+        stats = self.pending_stages.get(stage)
+        if stats is None:
+            stats = self.pending_stages[stage] = BackendStats(len(self.stage_metrics.buckets) + 1)
+        stats.requests += 1
+        stats.response_time_sum += seconds
+        stats.buckets[bisect.bisect_left(self.stage_metrics.buckets, seconds)] += 1
+
+    def get_stage_summary(self):
+        # {stage: {'count': ..., 'mean_ms': ...}}, including the samples not flushed yet
+        summary = {}
+        for stages in (self.stage_metrics.totals, self.pending_stages):
+            for stage, stats in stages.items():
+                count, total = summary.get(stage, (0, 0.0))
+                summary[stage] = (count + stats.requests, total + stats.response_time_sum)
+        return {stage: {'count': count, 'mean_ms': total / count * 1000}
+                for stage, (count, total) in summary.items() if count}
+
+    def start(self, active_connections=None):
+        # active_connections: callable returning the number of requests currently in flight
+        self.active_connections = active_connections
+        if self.flush_task is None:
+            self.flush_task = asyncio.ensure_future(self.run_flush())
+
+    async def stop(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            try:
+                await self.flush_task
+            except asyncio.CancelledError:
+                pass
+            self.flush_task = None
+        self.flush()
+
+    async def run_flush(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+            self.analyze_metrics()
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        now = time.monotonic()
+        elapsed = max(now - self.last_flush_time, 1e-9)
+        cpu_time = self.get_cpu_time()
+
+        totals = dict(self.vps_metrics.totals)
+        window = BackendStats(len(self.response_time_buckets) + 1)
+        for vps, stats in pending.items():
+            window.merge(stats)
+            merged = BackendStats(len(self.response_time_buckets) + 1)
+            if vps in totals:
+                merged.merge(totals[vps])
+            merged.merge(stats)
+            totals[vps] = merged
+        # Swapping the dict is atomic, a concurrent scrape sees either the old or the new totals
+        self.vps_metrics.totals = totals
+        if self.pending_stages:
+            pending_stages, self.pending_stages = self.pending_stages, {}
+            stage_totals = dict(self.stage_metrics.totals)
+            for stage, stats in pending_stages.items():
+                merged = BackendStats(len(self.stage_metrics.buckets) + 1)
+                if stage in stage_totals:
+                    merged.merge(stage_totals[stage])
+                merged.merge(stats)
+                stage_totals[stage] = merged
+            self.stage_metrics.totals = stage_totals
+
+        self.request_metrics.increment(window.requests)
+        self.connection_metrics.increment(window.requests)
+        self.throughput_metrics.set((window.bytes_in + window.bytes_out) / elapsed)
+        self.resource_usage_metrics.set((cpu_time - self.last_cpu_time) / elapsed * 100)
+        self.window_requests = window.requests
+        self.window_response_time = window.response_time_sum / window.requests if window.requests else None
+        self.last_flush_time = now
+        self.last_cpu_time = cpu_time
+        if self.export_path is not None:
+            try:
+                self.export()
+            except OSError as e:
+                logger.warning(f"Metrics not exported to {self.export_path}: {e}")
+
+    def get_cpu_time(self):
+        times = os.times()
+        return times.user + times.system
 
     def analyze_metrics(self):
-        average_response_time = self.response_time_metrics.observe(0)
-        active_connections = self.connection_metrics.connections_counter._value.get()
-        data_throughput = self.throughput_metrics.throughput_gauge._value.get()
+        # Runs off the request path, on the window of requests covered by the last flush
+        average_response_time = self.window_response_time
+        active_connections = self.active_connections() if self.active_connections is not None else 0
+        data_throughput = self.throughput_metrics.throughput_gauge._value.get() if self.window_requests else None
         resource_usage = self.resource_usage_metrics.resource_usage_gauge._value.get()
 
         self._analyze_response_time(average_response_time)
@@ -142,8 +399,3 @@ class Metrics:
 
     def send_notification(self, message):
         logger.info(f"Notification: {message}")
-
-
-metrics = Metrics()
-metrics.setup()
-metrics.update_metrics(None)
\ No newline at end of file
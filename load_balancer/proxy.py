@@ -0,0 +1,229 @@
+import asyncio
+import time
+import logging
+import aiohttp
+import requests
+from aiohttp import web
+from multidict import CIMultiDict
+from load_balancer.cache import CachedResponse
+from load_balancer.admission import OverloadedError
+from load_balancer.tracing import mark
+
+logger = logging.getLogger(__name__)
+
+
+class ProxyServer:
+    def __init__(self, load_balancer, host='0.0.0.0', port=8080):
+        self.load_balancer = load_balancer
+        self.host = host
+        self.port = port
+        # Set in multi-process mode so every worker can bind the same port
+        self.reuse_port = False
+        self.runner = None
+
+    def configure(self, config):
+        # Apply the 'load_balancer' section of config.yaml
+        if not config:
+            return
+        self.host = config.get('host', self.host)
+        self.port = config.get('port', self.port)
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_route('*', '/{path:.*}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port, reuse_port=self.reuse_port)
+        await site.start()
+        logger.info(f"Load balancer listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle(self, request):
+        admission_controller = self.load_balancer.admission_controller
+        client_ip = self.load_balancer.request_handler.get_client_ip(request)
+        start_time = time.monotonic()
+        priority = request.headers.get(admission_controller.priority_header)
+        tracer = self.load_balancer.tracer
+        trace = tracer.start('proxy')
+        try:
+            admitted_at = await admission_controller.acquire(priority)
+        except OverloadedError as e:
+            tracer.finish(trace)
+            return self.get_error_response(request, client_ip, start_time, e)
+        mark('admission')
+        is_success = False
+        try:
+            response = await self.dispatch(request, client_ip, start_time)
+            is_success = response.status < 500
+            return response
+        finally:
+            admission_controller.release(admitted_at, is_success)
+            tracer.finish(trace)
+
+    async def dispatch(self, request, client_ip, start_time):
+        load_balancer = self.load_balancer
+        session_key = load_balancer.sticky_sessions.get_key(request)
+        if load_balancer.response_cache.enabled and \
+                load_balancer.response_cache.is_cacheable_request(request.method, request.headers):
+            return await self.handle_cached(request, client_ip, start_time, session_key)
+        try:
+            vps, upstream = await self.forward(request, client_ip, start_time, session_key=session_key)
+        except Exception as e:
+            return self.get_error_response(request, client_ip, start_time, e)
+        extra_headers = self.get_session_headers(session_key, vps)
+        return await self.relay(request, client_ip, start_time, vps, upstream, extra_headers)
+
+    def get_session_headers(self, session_key, vps):
+        # Pins the session to the VPS that answered, with the Set-Cookie header to send if the cookie changed
+        sticky_sessions = self.load_balancer.sticky_sessions
+        if not sticky_sessions.enabled:
+            return ()
+        cookie = sticky_sessions.bind(session_key, vps)
+        return (('Set-Cookie', cookie),) if cookie is not None else ()
+
+    async def handle_cached(self, request, client_ip, start_time, session_key=None):
+        load_balancer = self.load_balancer
+        cache = load_balancer.response_cache
+        # Built up front, a background revalidation can outlive the client connection
+        forward_headers = load_balancer.request_handler.get_forward_headers(request)
+        for name in cache.conditional_headers:
+            forward_headers.popall(name, None)
+        # VPS this request's own fetch went to, answers from the cache leave the session where it is
+        served_by = []
+
+        async def fetch(conditional_headers):
+            headers = CIMultiDict(forward_headers)
+            headers.update(conditional_headers)
+            vps, upstream = await self.forward(request, client_ip, start_time, headers, session_key=session_key)
+            served_by.append(vps)
+            if upstream.status != 304 and \
+                    not cache.is_storable(upstream.status, upstream.headers, upstream.content_length):
+                # Streamed to this client only
+                return vps, upstream
+            body = b''
+            try:
+                body = await upstream.read()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise requests.exceptions.RequestException(str(e))
+            finally:
+                upstream.release()
+                self.finish(request, client_ip, start_time, vps, upstream.status, len(body))
+            return CachedResponse(upstream.status, upstream.headers, body)
+
+        def release(result):
+            vps, upstream = result
+            upstream.release()
+            self.finish(request, client_ip, start_time, vps, upstream.status, 0)
+
+        url = f'{request.host}{request.rel_url}'
+        try:
+            response, cache_status = await cache.get(request.method, url, request.headers, fetch, release)
+        except Exception as e:
+            return self.get_error_response(request, client_ip, start_time, e)
+        if not isinstance(response, CachedResponse):
+            vps, upstream = response
+            return await self.relay(request, client_ip, start_time, vps, upstream,
+                                    self.get_session_headers(session_key, vps))
+
+        headers = CIMultiDict(response.headers)
+        headers['Age'] = str(response.get_age())
+        headers['X-Cache'] = cache_status
+        if cache_status in ('MISS', 'REVALIDATED') and served_by:
+            headers.extend(self.get_session_headers(session_key, served_by[-1]))
+        if response.status == 200 and response.matches(request.headers.get('If-None-Match')):
+            result = web.Response(status=304, headers=headers)
+        else:
+            result = web.Response(status=response.status, headers=headers, body=response.body)
+        if cache_status != 'MISS':
+            load_balancer.logger.log_access(client_ip, request.method, request.path, 'cache', result.status,
+                                            time.monotonic() - start_time, len(response.body))
+        return result
+
+    async def forward(self, request, client_ip, start_time, headers=None, session_key=None):
+        # Returns (vps, upstream) once the response headers have arrived, retrying and hedging as configured
+        load_balancer = self.load_balancer
+        health_checker = load_balancer.health_checker
+        metrics = load_balancer.metrics
+        retry_policy = load_balancer.retry_policy
+        # A streamed request body can only be sent once, so only bodyless idempotent requests are retried
+        retryable = retry_policy.is_retryable(request.method) and not request.body_exists
+
+        async def attempt(vps):
+            health_checker.increase_connection_count(vps)
+            attempt_start = time.monotonic()
+            try:
+                upstream = await load_balancer.request_handler.open_upstream(vps, request, headers)
+            except requests.exceptions.RequestException as e:
+                health_checker.decrease_connection_count(vps)
+                health_checker.record_response_time(vps, load_balancer.connection_pool.timeout)
+                health_checker.record_result(vps, False)
+                load_balancer.admission_controller.record_vps(vps, time.monotonic() - attempt_start, False,
+                                                              health_checker.active_connections.get(vps, 0))
+                load_balancer.logger.log_request_error(vps, str(e))
+                metrics.record_request(vps, time.monotonic() - attempt_start)
+                raise
+            except asyncio.CancelledError:
+                # Lost a hedging race or ran out of deadline
+                health_checker.decrease_connection_count(vps)
+                raise
+            # Time to response headers is the latency the balancing algorithms care about
+            response_time = time.monotonic() - attempt_start
+            health_checker.record_response_time(vps, response_time)
+            health_checker.record_result(vps, upstream.status < 500)
+            load_balancer.admission_controller.record_vps(vps, response_time, upstream.status < 500,
+                                                          health_checker.active_connections.get(vps, 0))
+            if upstream.status < 500:
+                retry_policy.observe(response_time)
+            return vps, upstream
+
+        def should_retry(result):
+            return result[1].status in retry_policy.retry_on_status
+
+        def release(result):
+            vps, upstream = result
+            upstream.release()
+            health_checker.decrease_connection_count(vps)
+            metrics.record_request(vps, time.monotonic() - start_time, upstream.status)
+
+        def pick_vps(tried):
+            return load_balancer.get_session_vps(session_key, client_ip, tried)
+
+        return await retry_policy.execute(pick_vps, attempt, retryable, should_retry, release)
+
+    async def relay(self, request, client_ip, start_time, vps, upstream, extra_headers=()):
+        bytes_in = 0
+        try:
+            response = await self.load_balancer.request_handler.relay_response(vps, upstream, request,
+                                                                               extra_headers)
+            bytes_in = response.body_length
+            return response
+        finally:
+            self.finish(request, client_ip, start_time, vps, upstream.status, bytes_in)
+
+    def finish(self, request, client_ip, start_time, vps, status, bytes_in):
+        load_balancer = self.load_balancer
+        load_balancer.health_checker.decrease_connection_count(vps)
+        response_time = time.monotonic() - start_time
+        load_balancer.metrics.record_request(vps, response_time, status, bytes_in, request.content.total_bytes)
+        load_balancer.logger.log_access(client_ip, request.method, request.path, vps, status,
+                                        response_time, bytes_in)
+        mark('record')
+
+    def get_error_response(self, request, client_ip, start_time, error):
+        if isinstance(error, OverloadedError):
+            # Shed early and cheaply, the client is told when to come back
+            self.load_balancer.logger.log_access(client_ip, request.method, request.path, None, 503,
+                                                 time.monotonic() - start_time, 0)
+            return web.Response(status=503, text="Service Overloaded\n", headers={'Retry-After': '1'})
+        if isinstance(error, requests.exceptions.RequestException):
+            status = 504 if isinstance(error, requests.exceptions.Timeout) else 502
+            self.load_balancer.logger.log_access(client_ip, request.method, request.path, None, status,
+                                                 time.monotonic() - start_time, 0)
+            return web.Response(status=status, text="Gateway Timeout\n" if status == 504 else "Bad Gateway\n")
+        # Selection failed, no VPS is available
+        self.load_balancer.logger.log_access(client_ip, request.method, request.path, None, 503, 0, 0)
+        return web.Response(status=503, text="No VPS available\n")
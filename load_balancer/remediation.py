@@ -0,0 +1,113 @@
+import asyncio
+import shlex
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class FailureHandler:
+    # Runs the failure script (e.g. a restart or scaling hook) for backends the health checks mark as down.
+    # The script is started without a shell, with the VPS URL as its last argument, and never blocks the loop:
+    # - a VPS has at most one job queued or running, repeated failures of a flapping VPS are ignored
+    # - after a job the VPS is left alone for cooldown seconds
+    # - at most max_concurrent scripts run at once, each is killed after timeout seconds
+    def __init__(self, health_checker, command=('handle_vps_failure.sh',), timeout=60, cooldown=300,
+                 max_concurrent=2):
+        self.health_checker = health_checker
+        self.enabled = True
+        self.command = list(command)
+        self.timeout = timeout
+        self.cooldown = cooldown
+        self.max_concurrent = max_concurrent
+        self.semaphore = None
+        # VPS -> task of its queued or running job
+        self.jobs = {}
+        # VPS -> monotonic time the last job finished, and whether the script succeeded
+        self.finished_at = {}
+        self.results = {}
+
+    def configure(self, config):
+        # Apply the 'load_balancer.failure_handler' section of config.yaml
+        if not config:
+            return
+        self.enabled = config.get('enabled', self.enabled)
+        command = config.get('command', self.command)
+        self.command = shlex.split(command) if isinstance(command, str) else list(command)
+        self.timeout = config.get('timeout', self.timeout)
+        self.cooldown = config.get('cooldown', self.cooldown)
+        max_concurrent = config.get('max_concurrent', self.max_concurrent)
+        if max_concurrent != self.max_concurrent and not self.jobs:
+            self.max_concurrent = max_concurrent
+            self.semaphore = None
+
+    def submit(self, vps, now=None):
+        # Returns True if a job was scheduled
+        if not self.enabled or not self.command or vps in self.jobs:
+            return False
+        now = time.monotonic() if now is None else now
+        finished_at = self.finished_at.get(vps)
+        if finished_at is not None and now - finished_at < self.cooldown:
+            logger.info(f"VPS failure handling skipped, cooling down: {vps}")
+            return False
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+        task = asyncio.ensure_future(self.run(vps))
+        self.jobs[vps] = task
+        task.add_done_callback(lambda task: self.jobs.pop(vps, None))
+        return True
+
+    async def run(self, vps):
+        async with self.semaphore:
+            # The VPS may have recovered or left the list while the job was queued
+            if vps not in self.health_checker.down_vps:
+                return None
+            logger.error(f"Problem with VPS: {vps}. Error handling in progress...")
+            is_success = await self.execute(vps)
+            self.finished_at[vps] = time.monotonic()
+            self.results[vps] = is_success
+        await self.health_checker.handle_failure_result(vps, is_success)
+        return is_success
+
+    async def execute(self, vps):
+        try:
+            process = await asyncio.create_subprocess_exec(*self.command, vps, stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.STDOUT)
+        except OSError as e:
+            logger.error(f"Error processing VPS error: {vps}, cannot run {self.command[0]}: {e}")
+            return False
+        try:
+            output, _ = await asyncio.wait_for(process.communicate(), self.timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Error processing VPS error: {vps}, killed after {self.timeout}s")
+            await self.kill(process)
+            return False
+        except asyncio.CancelledError:
+            await self.kill(process)
+            raise
+        if output:
+            logger.debug(f"Failure handler output for {vps}: {output.decode(errors='replace').strip()}")
+        if process.returncode != 0:
+            logger.error(f"Error processing VPS error: {vps}, return code: {process.returncode}")
+            return False
+        logger.info(f"VPS error handling done: {vps}")
+        return True
+
+    async def kill(self, process):
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            await process.wait()
+
+    def forget_vps(self, vps):
+        self.finished_at.pop(vps, None)
+        self.results.pop(vps, None)
+
+    async def stop(self):
+        tasks = list(self.jobs.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
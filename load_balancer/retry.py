@@ -0,0 +1,170 @@
+import asyncio
+import requests
+from load_balancer.latency import LatencyQuantile
+from load_balancer.tracing import current_trace
+
+
+class ClientStatusError(requests.exceptions.HTTPError):
+    # The VPS answered with a 4xx: a final answer about the request, another VPS would give the same one.
+    # Never retried, and not a failure of the VPS
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+class RetryPolicy:
+    idempotent_methods = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'])
+
+    def __init__(self, retries=2, deadline=10.0, retry_on_status=(502, 503, 504), hedge=False,
+                 hedge_quantile=0.95, min_hedge_delay=0.005, max_hedges=1):
+        # retries - extra attempts after the first one, deadline - budget in seconds for all attempts together
+        self.retries = retries
+        self.deadline = deadline
+        self.retry_on_status = frozenset(retry_on_status)
+        # Hedging: when the first attempt is slower than the observed hedge_quantile latency,
+        # send the same request to another VPS and take whichever answers first
+        self.hedge = hedge
+        self.min_hedge_delay = min_hedge_delay
+        self.max_hedges = max_hedges
+        self.latency = LatencyQuantile(hedge_quantile)
+
+    def configure(self, config):
+        # Apply the 'load_balancer.retry' section of config.yaml
+        if not config:
+            return
+        self.retries = config.get('retries', self.retries)
+        self.deadline = config.get('deadline', self.deadline)
+        self.retry_on_status = frozenset(config.get('retry_on_status', self.retry_on_status))
+        self.hedge = config.get('hedge', self.hedge)
+        self.min_hedge_delay = config.get('min_hedge_delay', self.min_hedge_delay)
+        self.max_hedges = config.get('max_hedges', self.max_hedges)
+        self.latency.quantile = config.get('hedge_quantile', self.latency.quantile)
+
+    def is_retryable(self, method):
+        return method.upper() in self.idempotent_methods
+
+    def observe(self, response_time):
+        self.latency.observe(response_time)
+
+    def get_hedge_delay(self):
+        delay = self.latency.get()
+        return None if delay is None else max(delay, self.min_hedge_delay)
+
+    async def execute(self, pick_vps, attempt, retryable=True, should_retry=None, release=None):
+        # pick_vps(tried) -> VPS to use next, preferably not one of tried
+        # attempt(vps) -> coroutine with the result, raises RequestException on failure, ClientStatusError
+        #     is raised as is
+        # should_retry(result) -> True for a result worth another VPS (e.g. a 503), kept as the answer
+        #     of last resort in case no other attempt does better
+        # release(result) -> frees a result that is not returned (hedging loser, retried response)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.deadline
+        max_attempts = 1 + self.retries if retryable else 1
+        max_hedges = self.max_hedges if self.hedge and retryable else 0
+        tried = []
+        pending = set()
+        hedges = 0
+        last_error = None
+        fallback = None
+        fallback_task = None
+        # A traced request gives every attempt a trace of its own, only the ones waited for are booked
+        trace = current_trace.get()
+        attempt_traces = {}
+
+        def launch():
+            attempt_trace = None
+            if trace is not None:
+                attempt_trace = trace.fork()
+                if pending:
+                    # Waited for the pending attempts before hedging
+                    attempt_trace.mark('hedge')
+                token = current_trace.set(attempt_trace)
+            try:
+                try:
+                    vps = pick_vps(tried)
+                except Exception:
+                    if not tried:
+                        raise
+                    # Nothing left to retry on, settle with what the earlier attempts returned
+                    return False
+                tried.append(vps)
+                task = asyncio.ensure_future(attempt(vps))
+            finally:
+                if trace is not None:
+                    current_trace.reset(token)
+            pending.add(task)
+            if attempt_trace is not None:
+                attempt_traces[task] = attempt_trace
+            return True
+
+        def book(task):
+            attempt_trace = attempt_traces.pop(task, None)
+            if attempt_trace is not None:
+                trace.join(attempt_trace)
+
+        launch()
+        try:
+            while pending:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    if fallback is not None:
+                        break
+                    raise requests.exceptions.Timeout(f"Deadline of {self.deadline}s exceeded after "
+                                                      f"{len(tried)} attempts")
+                timeout = remaining
+                hedge_delay = self.get_hedge_delay() if hedges < max_hedges and len(tried) < max_attempts else None
+                if hedge_delay is not None:
+                    timeout = min(timeout, hedge_delay)
+
+                done, still_pending = await asyncio.wait(pending, timeout=timeout,
+                                                         return_when=asyncio.FIRST_COMPLETED)
+                pending.intersection_update(still_pending)
+                if not done:
+                    if hedge_delay is not None:
+                        hedges += 1
+                        if not launch():
+                            hedges = max_hedges
+                    continue
+
+                client_error = next((task for task in done
+                                     if isinstance(task.exception(), ClientStatusError)), None)
+                if client_error is not None:
+                    # Final, whatever else has completed is not returned
+                    if release is not None:
+                        for task in done:
+                            if task.exception() is None:
+                                release(task.result())
+                        if fallback is not None:
+                            release(fallback)
+                    book(client_error)
+                    raise client_error.exception()
+
+                winner = None
+                for task in done:
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        continue
+                    result = task.result()
+                    if winner is None and not (should_retry is not None and should_retry(result)):
+                        winner, winner_task = result, task
+                    elif winner is None and fallback is None:
+                        fallback, fallback_task = result, task
+                    elif release is not None:
+                        release(result)
+                if winner is not None:
+                    book(winner_task)
+                    if fallback is not None and release is not None:
+                        release(fallback)
+                    return winner
+                if not pending and len(done) == 1:
+                    # Nothing ran alongside, the next attempt starts after this one
+                    book(done.pop())
+                if not pending and len(tried) < max_attempts:
+                    launch()
+            if fallback is not None:
+                book(fallback_task)
+                return fallback
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
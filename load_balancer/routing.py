@@ -0,0 +1,42 @@
+from load_balancer.hash_ring import ConsistentHashRing
+from load_balancer.backend import Backend
+
+
+class RoutingSnapshot:
+    # Immutable view of the backend set. It is built aside (possibly on an executor thread) and
+    # published with a single attribute assignment, so selectors never see a half-applied change
+    __slots__ = ('vps_list', 'vps_set', 'hash_ring', 'backends')
+
+    def __init__(self, vps_list=(), hash_ring=None, replicas=160, load_factor=1.25, backends=None):
+        # vps_list holds URLs or Backend records, the records are kept aside in backends by URL.
+        # Duplicates and blank entries are dropped, the order of first appearance is kept
+        if backends is None:
+            backends = {vps.url: vps for vps in vps_list if isinstance(vps, Backend)}
+            vps_list = (vps.url if isinstance(vps, Backend) else vps for vps in vps_list)
+        self.backends = backends
+        self.vps_list = tuple(dict.fromkeys(vps for vps in vps_list if vps))
+        self.vps_set = frozenset(self.vps_list)
+        if hash_ring is None:
+            hash_ring = ConsistentHashRing(self.vps_list, replicas, load_factor)
+        self.hash_ring = hash_ring
+
+    def __contains__(self, vps):
+        return vps in self.vps_set
+
+    def __len__(self):
+        return len(self.vps_list)
+
+    def with_vps(self, vps):
+        backends = dict(self.backends)
+        if isinstance(vps, Backend):
+            backends[vps.url] = vps
+            vps = vps.url
+        hash_ring = self.hash_ring.copy()
+        hash_ring.add(vps)
+        return RoutingSnapshot(self.vps_list + (vps,), hash_ring, backends=backends)
+
+    def without_vps(self, vps):
+        hash_ring = self.hash_ring.copy()
+        hash_ring.remove(vps)
+        backends = {url: backend for url, backend in self.backends.items() if url != vps}
+        return RoutingSnapshot(tuple(item for item in self.vps_list if item != vps), hash_ring, backends=backends)
@@ -0,0 +1,153 @@
+import heapq
+import random
+
+
+class WeightedRoundRobin:
+    def __init__(self, weights=None):
+        # Earliest deadline first: a backend of weight w is due every 1 / w of virtual time and the pick is
+        # the one due first, which interleaves the backends as smoothly as nginx does. Heap of
+        # (deadline, sequence, vps), stale entries are dropped when they reach the top as in LazyMinHeap,
+        # so picks and weight changes of a single backend are O(log n) and nothing is ever rebuilt
+        self.heap = []
+        # vps -> (weight, deadline, sequence)
+        self.entries = {}
+        self.now = 0.0
+        self.sequence = 0
+        for vps, weight in (weights or {}).items():
+            self.set_weight(vps, weight)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, vps):
+        return vps in self.entries
+
+    def set_weight(self, vps, weight):
+        # weight: positive number. A new backend is first due half an interval from now, a changed one is due
+        # an interval of its new weight after its last pick
+        entry = self.entries.get(vps)
+        if entry is None:
+            deadline = self.now + 0.5 / weight
+        elif entry[0] == weight:
+            return
+        else:
+            deadline = max(entry[1] - 1.0 / entry[0] + 1.0 / weight, self.now)
+        self.push(vps, weight, deadline)
+
+    def remove(self, vps):
+        self.entries.pop(vps, None)
+
+    def push(self, vps, weight, deadline):
+        self.sequence += 1
+        self.entries[vps] = (weight, deadline, self.sequence)
+        heapq.heappush(self.heap, (deadline, self.sequence, vps))
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.compact()
+
+    def compact(self):
+        self.heap = [(deadline, sequence, vps) for vps, (_, deadline, sequence) in self.entries.items()]
+        heapq.heapify(self.heap)
+
+    def next(self):
+        heap = self.heap
+        while True:
+            deadline, sequence, vps = heap[0]
+            entry = self.entries.get(vps)
+            if entry is not None and entry[2] == sequence:
+                break
+            heapq.heappop(heap)
+        self.now = deadline
+        weight = entry[0]
+        self.sequence += 1
+        self.entries[vps] = (weight, deadline + 1.0 / weight, self.sequence)
+        heapq.heapreplace(heap, (deadline + 1.0 / weight, self.sequence, vps))
+        return vps
+
+
+class AliasTable:
+    def __init__(self, weights):
+        # Vose's alias method: O(n) construction, O(1) weighted random pick
+        self.vps_list = list(weights)
+        size = len(self.vps_list)
+        self.probabilities = [0.0] * size
+        self.aliases = [0] * size
+        if not size:
+            return
+
+        total_weight = sum(weights.values())
+        scaled = [weights[vps] * size / total_weight for vps in self.vps_list]
+        small = [i for i, probability in enumerate(scaled) if probability < 1.0]
+        large = [i for i, probability in enumerate(scaled) if probability >= 1.0]
+
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1.0
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+
+        # Whatever is left is 1.0 up to rounding errors
+        for i in large + small:
+            self.probabilities[i] = 1.0
+
+    def __len__(self):
+        return len(self.vps_list)
+
+    def next(self):
+        column = random.randrange(len(self.vps_list))
+        if random.random() < self.probabilities[column]:
+            return self.vps_list[column]
+        return self.vps_list[self.aliases[column]]
+
+
+class LazyMinHeap:
+    def __init__(self):
+        # Heap of (score, sequence, vps). Only the entry with the latest sequence of a VPS is live,
+        # older ones are dropped when they reach the top, so every update is a single O(log n) push
+        self.heap = []
+        self.entries = {}
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, vps):
+        return vps in self.entries
+
+    def score(self, vps):
+        return self.entries[vps][0]
+
+    def update(self, vps, score):
+        entry = self.entries.get(vps)
+        if entry is not None and entry[0] == score:
+            return
+        self.sequence += 1
+        self.entries[vps] = (score, self.sequence)
+        heapq.heappush(self.heap, (score, self.sequence, vps))
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.compact()
+
+    def remove(self, vps):
+        self.entries.pop(vps, None)
+
+    def clear(self):
+        self.heap = []
+        self.entries = {}
+
+    def compact(self):
+        self.heap = [(score, sequence, vps) for vps, (score, sequence) in self.entries.items()]
+        heapq.heapify(self.heap)
+
+    def peek(self):
+        heap = self.heap
+        while heap:
+            _, sequence, vps = heap[0]
+            entry = self.entries.get(vps)
+            if entry is not None and entry[1] == sequence:
+                return vps
+            heapq.heappop(heap)
+        return None
@@ -0,0 +1,120 @@
+import time
+from collections import OrderedDict
+from load_balancer.hash_ring import stable_hash
+
+
+class SessionTable:
+    # Session id (a fixed-size hash, see StickySessions.get_session_id) -> VPS. Every access renews the TTL
+    # and moves the entry to the end, so the least recently used entries are also the first to expire and
+    # both are evicted from the front
+    def __init__(self, max_entries=100000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, session_id, now=None):
+        now = time.monotonic() if now is None else now
+        self.expire(now)
+        entry = self.entries.get(session_id)
+        if entry is None:
+            return None
+        self.entries.move_to_end(session_id)
+        entry[1] = now + self.ttl
+        return entry[0]
+
+    def set(self, session_id, vps, now=None):
+        now = time.monotonic() if now is None else now
+        entry = self.entries.get(session_id)
+        if entry is None:
+            self.entries[session_id] = [vps, now + self.ttl]
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            entry[0], entry[1] = vps, now + self.ttl
+            self.entries.move_to_end(session_id)
+
+    def discard(self, session_id):
+        self.entries.pop(session_id, None)
+
+    def expire(self, now):
+        entries = self.entries
+        while entries:
+            session_id, entry = next(iter(entries.items()))
+            if entry[1] > now:
+                return
+            del entries[session_id]
+
+
+class StickySessions:
+    # cookie - the balancer sets a cookie naming the VPS (by a hash, the URL is not revealed), no state is kept
+    # header - the client sends a session id in a header, the session table pins it to a VPS
+    def __init__(self, mode='cookie', cookie_name='lb_vps', header_name='X-Session-Id', cookie_max_age=0,
+                 max_entries=100000, ttl=3600):
+        self.enabled = False
+        self.mode = mode
+        self.cookie_name = cookie_name
+        self.header_name = header_name
+        # 0 - session cookie, dropped when the browser closes
+        self.cookie_max_age = cookie_max_age
+        self.table = SessionTable(max_entries, ttl)
+        # Cookie value -> VPS, rebuilt when the routing snapshot changes
+        self.tokens = {}
+        self.tokens_routing = None
+
+    def configure(self, config):
+        # Apply the 'load_balancer.sticky_sessions' section of config.yaml
+        if not config:
+            return
+        self.enabled = config.get('enabled', self.enabled)
+        self.mode = config.get('mode', self.mode)
+        self.cookie_name = config.get('cookie_name', self.cookie_name)
+        self.header_name = config.get('header_name', self.header_name)
+        self.cookie_max_age = config.get('cookie_max_age', self.cookie_max_age)
+        self.table.max_entries = config.get('max_entries', self.table.max_entries)
+        self.table.ttl = config.get('ttl', self.table.ttl)
+
+    def get_token(self, vps):
+        return format(stable_hash(vps), '016x')
+
+    def get_session_id(self, key):
+        # The table keeps a 64-bit hash rather than the client supplied header, so max_entries bounds its memory
+        return stable_hash(key)
+
+    def get_key(self, request):
+        # Session key carried by the request, None if it has none or stickiness is off
+        if not self.enabled:
+            return None
+        if self.mode == 'cookie':
+            return request.cookies.get(self.cookie_name)
+        return request.headers.get(self.header_name)
+
+    def lookup(self, key, routing):
+        # The VPS the session is pinned to, None if unknown or no longer in the routing
+        if self.mode == 'cookie':
+            if self.tokens_routing is not routing:
+                self.tokens = {self.get_token(vps): vps for vps in routing.vps_list}
+                self.tokens_routing = routing
+            return self.tokens.get(key)
+        session_id = self.get_session_id(key)
+        vps = self.table.get(session_id)
+        if vps is not None and vps not in routing:
+            self.table.discard(session_id)
+            return None
+        return vps
+
+    def bind(self, key, vps):
+        # Pins the session to the VPS that served it, returns a Set-Cookie value when the cookie has to change
+        if self.mode == 'cookie':
+            token = self.get_token(vps)
+            if key == token:
+                return None
+            cookie = f'{self.cookie_name}={token}; Path=/; HttpOnly; SameSite=Lax'
+            if self.cookie_max_age:
+                cookie += f'; Max-Age={self.cookie_max_age}'
+            return cookie
+        if key is not None:
+            self.table.set(self.get_session_id(key), vps)
+        return None
@@ -0,0 +1,110 @@
+import time
+from load_balancer.hash_ring import stable_hash
+
+
+class SlowStart:
+    # Ramps the effective weight of a backend that just joined the rotation (added while others already
+    # serve, or back after failing the health checks) from min_weight to its full weight over window
+    # seconds, so a cold VPS is not handed its full share at once. The factors are recomputed every
+    # interval seconds, the selection tables and indexes are only touched then
+    def __init__(self, window=0, min_weight=0.1, curve='linear', interval=1.0):
+        # 0 - disabled, backends get their full weight right away
+        self.window = window
+        self.min_weight = min_weight
+        # linear, or exponential: min_weight doubles at a steady pace, the bulk of the ramp comes last
+        self.curve = curve
+        self.interval = interval
+        self.started = {}
+        # Current factor of every backend in slow start, the others have 1
+        self.factors = {}
+        self.next_update = 0
+
+    def validate(self, config):
+        # Raises ValueError if the 'load_balancer.slow_start' section cannot be applied
+        if not config:
+            return
+        min_weight = config.get('min_weight', self.min_weight)
+        if not 0 < min_weight <= 1:
+            # A factor of 0 would take the VPS out of rotation and divide the least-loaded scores by zero
+            raise ValueError(f"Slow start min_weight must be in (0, 1]: {min_weight}")
+        curve = config.get('curve', self.curve)
+        if curve not in ('linear', 'exponential'):
+            raise ValueError(f"Unsupported slow start curve: {curve}")
+
+    def configure(self, config):
+        # Apply the 'load_balancer.slow_start' section of config.yaml
+        if not config:
+            return
+        self.validate(config)
+        self.window = config.get('window', self.window)
+        self.min_weight = config.get('min_weight', self.min_weight)
+        self.curve = config.get('curve', self.curve)
+        self.interval = config.get('interval', self.interval)
+
+    def __contains__(self, vps):
+        return vps in self.factors
+
+    def __bool__(self):
+        return bool(self.factors)
+
+    def begin(self, vps, now=None):
+        # Returns True if the VPS is now in slow start
+        if self.window <= 0:
+            return False
+        now = time.monotonic() if now is None else now
+        self.started[vps] = now
+        self.factors[vps] = self.get_ramp_factor(0)
+        if len(self.factors) == 1:
+            self.next_update = now + self.interval
+        return True
+
+    def forget(self, vps):
+        self.started.pop(vps, None)
+        self.factors.pop(vps, None)
+
+    def get_ramp_factor(self, elapsed):
+        progress = min(max(elapsed / self.window, 0.0), 1.0)
+        if self.curve == 'exponential':
+            return self.min_weight ** (1 - progress)
+        return self.min_weight + (1 - self.min_weight) * progress
+
+    def update(self, now=None):
+        # Recomputes the factors once per interval. Returns the backends whose factor changed,
+        # the ones that finished the ramp included
+        now = time.monotonic() if now is None else now
+        if not self.factors or now < self.next_update:
+            return []
+        self.next_update = now + self.interval
+        changed = list(self.factors)
+        for vps in changed:
+            elapsed = now - self.started[vps]
+            if elapsed >= self.window:
+                self.forget(vps)
+            else:
+                self.factors[vps] = self.get_ramp_factor(elapsed)
+        return changed
+
+    def get_factor(self, vps):
+        return self.factors.get(vps, 1.0)
+
+    def scale_weight(self, vps, weight):
+        factor = self.factors.get(vps)
+        if factor is None or weight <= 0:
+            return weight
+        return max(int(round(weight * factor)), 1)
+
+    def scale_load(self, vps, load):
+        # Load a backend in slow start looks like to the least-loaded algorithms: with factor f it counts as
+        # (load + 1) / f - 1, so an idle one only wins once the others have 1 / f - 1 requests in flight
+        factor = self.factors.get(vps)
+        if factor is None:
+            return load
+        return (load + 1) / factor - 1
+
+    def admits(self, vps, key):
+        # Stable share of the keys (client IPs) a backend in slow start takes, growing with its factor.
+        # A client admitted once stays admitted for the rest of the ramp
+        factor = self.factors.get(vps)
+        if factor is None:
+            return True
+        return stable_hash(f'{key}#{vps}') < factor * 2 ** 64
@@ -0,0 +1,224 @@
+import asyncio
+import socket
+import time
+import logging
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class BufferPool:
+    # Preallocated receive buffers, reused across connections. Relayed bytes are received straight into
+    # a buffer and sent from a memoryview slice of it, nothing is copied or allocated per chunk
+    def __init__(self, buffer_size=65536, max_free=256):
+        self.buffer_size = buffer_size
+        self.max_free = max_free
+        self.free = []
+
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        return memoryview(bytearray(self.buffer_size))
+
+    def release(self, buffer):
+        if len(buffer) == self.buffer_size and len(self.free) < self.max_free:
+            self.free.append(buffer)
+
+    def resize(self, buffer_size):
+        if buffer_size != self.buffer_size:
+            self.buffer_size = buffer_size
+            self.free = []
+
+
+class TCPProxy:
+    # Layer-4 passthrough: every accepted connection is relayed byte for byte to a VPS picked by the
+    # balancing algorithm, without looking at the traffic (databases, TLS the balancer does not terminate)
+    def __init__(self, load_balancer, host='0.0.0.0', port=9000, backend_port=0, buffer_size=65536,
+                 connect_timeout=5, backlog=1024):
+        self.load_balancer = load_balancer
+        self.enabled = False
+        self.host = host
+        self.port = port
+        # Port of the VPSes, 0 - the port of the VPS URL
+        self.backend_port = backend_port
+        self.buffers = BufferPool(buffer_size)
+        self.connect_timeout = connect_timeout
+        self.backlog = backlog
+        # Set in multi-process mode so every worker can bind the same port
+        self.reuse_port = False
+        self.socket = None
+        self.accept_task = None
+        self.connections = set()
+
+    def configure(self, config):
+        # Apply the 'load_balancer.tcp' section of config.yaml
+        if not config:
+            return
+        self.enabled = config.get('enabled', self.enabled)
+        self.host = config.get('host', self.host)
+        self.port = config.get('port', self.port)
+        self.backend_port = config.get('backend_port', self.backend_port)
+        self.buffers.resize(config.get('buffer_size', self.buffers.buffer_size))
+        self.connect_timeout = config.get('connect_timeout', self.connect_timeout)
+        self.backlog = config.get('backlog', self.backlog)
+
+    def get_address(self, vps):
+        url = urlsplit(vps if '//' in vps else f'//{vps}')
+        return url.hostname, self.backend_port or url.port or (443 if url.scheme == 'https' else 80)
+
+    async def start(self):
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((self.host, self.port))
+            sock.listen(self.backlog)
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        self.socket = sock
+        self.accept_task = asyncio.ensure_future(self.accept())
+        logger.info(f"TCP passthrough listening on {self.host}:{sock.getsockname()[1]}")
+
+    async def stop(self):
+        if self.accept_task is not None:
+            self.accept_task.cancel()
+            try:
+                await self.accept_task
+            except asyncio.CancelledError:
+                pass
+            self.accept_task = None
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        for task in list(self.connections):
+            task.cancel()
+        if self.connections:
+            await asyncio.gather(*self.connections, return_exceptions=True)
+
+    async def accept(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                client, address = await loop.sock_accept(self.socket)
+            except OSError as e:
+                # E.g. out of file descriptors, keep accepting once some are released
+                logger.error(f"TCP passthrough accept failed: {e}")
+                await asyncio.sleep(0.1)
+                continue
+            self.prepare_socket(client)
+            task = asyncio.ensure_future(self.handle(client, address[0]))
+            self.connections.add(task)
+            task.add_done_callback(self.connections.discard)
+
+    def prepare_socket(self, sock):
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    async def handle(self, client, client_ip):
+        load_balancer = self.load_balancer
+        start_time = time.monotonic()
+        try:
+            vps, upstream = await self.connect(client_ip)
+        except asyncio.CancelledError:
+            client.close()
+            raise
+        except Exception as e:
+            client.close()
+            status = 502 if isinstance(e, (OSError, asyncio.TimeoutError)) else 503
+            load_balancer.logger.log_access(client_ip, 'TCP', f':{self.port}', None, status,
+                                            time.monotonic() - start_time, 0)
+            return
+        # Bytes relayed [to the VPS, to the client], counted by the pumps even when they are cancelled
+        transferred = [0, 0]
+        upload = asyncio.ensure_future(self.pump(client, upstream, transferred, 0))
+        download = asyncio.ensure_future(self.pump(upstream, client, transferred, 1))
+        try:
+            # A reset in either direction ends the whole connection
+            await asyncio.wait([upload, download], return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            upload.cancel()
+            download.cancel()
+            await asyncio.gather(upload, download, return_exceptions=True)
+            bytes_out, bytes_in = transferred
+            client.close()
+            upstream.close()
+            load_balancer.health_checker.decrease_connection_count(vps)
+            response_time = time.monotonic() - start_time
+            load_balancer.metrics.record_request(vps, response_time, 200, bytes_in, bytes_out)
+            load_balancer.logger.log_access(client_ip, 'TCP', f':{self.port}', vps, 200, response_time, bytes_in)
+
+    async def connect(self, client_ip):
+        # Returns (vps, socket), a VPS refusing the connection is reported to its circuit breaker and
+        # the next one is tried, as many times as the retry policy allows
+        load_balancer = self.load_balancer
+        health_checker = load_balancer.health_checker
+        tried = []
+        error = None
+        for _ in range(load_balancer.retry_policy.retries + 1):
+            try:
+                vps = load_balancer.get_next_vps_excluding(client_ip, tried)
+            except Exception:
+                if error is not None:
+                    raise error
+                raise
+            if vps in tried:
+                break
+            tried.append(vps)
+            health_checker.increase_connection_count(vps)
+            connect_start = time.monotonic()
+            try:
+                upstream = await self.open_connection(vps)
+            except (OSError, asyncio.TimeoutError) as e:
+                health_checker.decrease_connection_count(vps)
+                health_checker.record_result(vps, False)
+                load_balancer.logger.log_request_error(vps, str(e) or type(e).__name__)
+                error = e
+                continue
+            except asyncio.CancelledError:
+                health_checker.decrease_connection_count(vps)
+                raise
+            # Connect time is the latency least_response_time compares
+            health_checker.record_response_time(vps, time.monotonic() - connect_start)
+            health_checker.record_result(vps, True)
+            return vps, upstream
+        raise error
+
+    async def open_connection(self, vps):
+        loop = asyncio.get_running_loop()
+        host, port = self.get_address(vps)
+        addresses = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        family, socket_type, proto, _, address = addresses[0]
+        sock = socket.socket(family, socket_type, proto)
+        try:
+            self.prepare_socket(sock)
+            await asyncio.wait_for(loop.sock_connect(sock, address), self.connect_timeout)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    async def pump(self, source, destination, transferred, direction):
+        # Relays one direction until EOF, then half-closes the other side so the peer sees it too.
+        # The bytes relayed are stored in transferred[direction]
+        loop = asyncio.get_running_loop()
+        buffer = self.buffers.acquire()
+        total = 0
+        try:
+            while True:
+                count = await loop.sock_recv_into(source, buffer)
+                if not count:
+                    break
+                await loop.sock_sendall(destination, buffer[:count])
+                total += count
+            try:
+                destination.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+        finally:
+            transferred[direction] = total
+            self.buffers.release(buffer)
@@ -0,0 +1,84 @@
+import asyncio
+import time
+import logging
+import aiohttp
+from load_balancer.connection_pool import ConnectionPool
+
+logger = logging.getLogger(__name__)
+
+
+class TelemetryCollector:
+    # Scrapes a JSON stats endpoint on every VPS, e.g. {"cpu_usage": 42.5, "memory_usage": 61, "latency": 0.012}
+    # (percent, percent, seconds), and turns it into selection weights
+    def __init__(self, health_checker, path='/stats', interval=5, timeout=2, smoothing=0.3, weight_change=0.1):
+        self.health_checker = health_checker
+        self.enabled = False
+        self.path = path
+        self.interval = interval
+        self.timeout = timeout
+        # Share of a new sample in the smoothed values
+        self.smoothing = smoothing
+        # Relative weight change that makes the weighted tables be rebuilt
+        self.weight_change = weight_change
+        self.connection_pool = None
+        self.task = None
+
+    def configure(self, config):
+        # Apply the 'load_balancer.telemetry' section of config.yaml
+        if not config:
+            return
+        self.enabled = config.get('enabled', self.enabled)
+        self.path = config.get('path', self.path)
+        self.interval = config.get('interval', self.interval)
+        self.timeout = config.get('timeout', self.timeout)
+        self.smoothing = config.get('smoothing', self.smoothing)
+        self.weight_change = config.get('weight_change', self.weight_change)
+
+    def start(self):
+        # In multi-process mode only the health check owner scrapes, the weights reach the others
+        # through the shared state
+        if self.enabled and self.task is None and self.health_checker.owns_health_checks():
+            self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.connection_pool is not None:
+            await self.connection_pool.close()
+            self.connection_pool = None
+
+    async def run(self):
+        while True:
+            await self.collect()
+            await asyncio.sleep(self.interval)
+
+    async def collect(self):
+        vps_list = list(self.health_checker.vps_list)
+        results = await asyncio.gather(*(self.scrape(vps) for vps in vps_list))
+        now = time.monotonic()
+        for vps, stats in zip(vps_list, results):
+            if stats is not None:
+                invalid = self.health_checker.get_backend(vps).observe(stats, self.smoothing, now)
+                if invalid:
+                    logger.warning(f"Ignoring invalid telemetry of {vps}: "
+                                   + ', '.join(f'{name}={stats[name]!r}' for name in invalid))
+        self.health_checker.refresh_weights(self.weight_change)
+
+    async def scrape(self, vps):
+        if self.connection_pool is None:
+            self.connection_pool = ConnectionPool(max_connections=0, timeout=self.timeout)
+        session = self.connection_pool.get_session()
+        try:
+            async with session.get(vps.rstrip('/') + self.path) as response:
+                if response.status != 200:
+                    return None
+                stats = await response.json(content_type=None)
+                return stats if isinstance(stats, dict) else None
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.debug(f"Telemetry of {vps} not available: {e}")
+            return None
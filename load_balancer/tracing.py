@@ -0,0 +1,146 @@
+import asyncio
+import collections
+import contextvars
+import io
+import random
+import time
+
+# Trace of the request being handled by the current task, None unless the request was sampled
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+def mark(stage):
+    # Ends a stage of the current request: the time since the previous mark is booked to it.
+    # A single context variable lookup when the request is not traced
+    trace = current_trace.get()
+    if trace is not None:
+        trace.mark(stage)
+
+
+def ensure_future_untraced(coroutine):
+    # Background work that may outlive the request (e.g. a cache revalidation) must not mark its trace
+    token = current_trace.set(None)
+    try:
+        return asyncio.ensure_future(coroutine)
+    finally:
+        current_trace.reset(token)
+
+
+class Trace:
+    __slots__ = ('name', 'start', 'last', 'stages', 'token')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = self.last = time.monotonic()
+        # (stage, seconds) in the order the stages ended, a stage may occur more than once (retries)
+        self.stages = []
+        self.token = None
+
+    def mark(self, stage):
+        now = time.monotonic()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def fork(self):
+        # Trace of one of several concurrent attempts (retries, hedges), it starts where this one stands
+        child = Trace(self.name)
+        child.start = child.last = self.last
+        return child
+
+    def join(self, child):
+        # Books the stages of the attempt that was waited for, concurrent losers are never joined
+        self.stages.extend(child.stages)
+        self.last = child.last
+
+    def get_duration(self):
+        return self.last - self.start
+
+    def to_dict(self):
+        return {'name': self.name, 'duration_ms': self.get_duration() * 1000,
+                'stages': [[stage, seconds * 1000] for stage, seconds in self.stages]}
+
+
+class Tracer:
+    # Per-stage timing of sampled requests, exported as load_balancer_stage_seconds histograms.
+    # The stages are marked along the request path: admission, select, pool_wait, connect, ttfb, body, record,
+    # and hedge for the wait before a hedged attempt
+    def __init__(self, metrics, sample_rate=0.0, slow_threshold=0, max_slow_traces=100):
+        self.metrics = metrics
+        self.sample_rate = sample_rate
+        # Traces of requests slower than slow_threshold seconds are kept for the admin server (0 - none)
+        self.slow_threshold = slow_threshold
+        self.slow_traces = collections.deque(maxlen=max_slow_traces)
+
+    def configure(self, config):
+        # Apply the 'load_balancer.tracing' section of config.yaml
+        if not config:
+            return
+        self.sample_rate = config.get('sample_rate', self.sample_rate)
+        self.slow_threshold = config.get('slow_threshold', self.slow_threshold)
+        max_slow_traces = config.get('max_slow_traces', self.slow_traces.maxlen)
+        if max_slow_traces != self.slow_traces.maxlen:
+            self.slow_traces = collections.deque(self.slow_traces, maxlen=max_slow_traces)
+
+    def start(self, name):
+        # Returns the trace to hand back to finish(), None if the request is not sampled
+        if self.sample_rate <= 0 or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return None
+        trace = Trace(name)
+        trace.token = current_trace.set(trace)
+        return trace
+
+    def finish(self, trace):
+        if trace is None:
+            return
+        trace.mark('other')
+        current_trace.reset(trace.token)
+        for stage, seconds in trace.stages:
+            self.metrics.record_stage(stage, seconds)
+        self.metrics.record_stage('total', trace.get_duration())
+        if self.slow_threshold and trace.get_duration() >= self.slow_threshold:
+            self.slow_traces.append(trace.to_dict())
+
+    def get_trace_config(self):
+        # aiohttp hooks splitting the time to response headers into waiting for a pooled socket,
+        # connecting and the rest (ttfb)
+        import aiohttp
+
+        async def on_queued_end(session, context, params):
+            mark('pool_wait')
+
+        async def on_connection_create_end(session, context, params):
+            mark('connect')
+
+        async def on_connection_reuseconn(session, context, params):
+            mark('pool_wait')
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_queued_end.append(on_queued_end)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+
+class Profiler:
+    # cProfile of the event loop thread for a number of seconds, every coroutine step run meanwhile is counted
+    def __init__(self):
+        self.profile = None
+
+    def is_running(self):
+        return self.profile is not None
+
+    async def run(self, seconds, sort='cumulative', limit=40):
+        import cProfile
+        import pstats
+        if self.profile is not None:
+            raise RuntimeError("A profile is already running")
+        profile = self.profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+            self.profile = None
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats(sort).print_stats(limit)
+        return output.getvalue()
@@ -0,0 +1,471 @@
+import asyncio
+import collections
+import http
+import ssl
+import time
+from urllib.parse import urlsplit
+import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+from load_balancer.tracing import mark
+
+
+class HTTP1Transport:
+    # aiohttp's keep-alive pool, every request in flight holds a socket of its own
+    protocol = 'http1'
+
+    def __init__(self, connection_pool):
+        self.connection_pool = connection_pool
+
+    async def request(self, method, url, headers=None, data=None, proxy=False):
+        # Returns once the response headers have arrived, the caller reads the body and releases the response.
+        # proxy - the response is relayed: the body is left compressed and redirects are not followed
+        if proxy:
+            session = self.connection_pool.get_proxy_session()
+            return await session.request(method, url, headers=headers, data=data, allow_redirects=False)
+        return await self.connection_pool.get_session().request(method, url, headers=headers, data=data)
+
+    async def close(self):
+        # The sockets belong to the connection pool, closed with it
+        pass
+
+
+class HTTP2Response:
+    # The subset of aiohttp.ClientResponse used by RequestHandler and ProxyServer
+    def __init__(self, connection, stream_id, timeout):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.timeout = timeout
+        self.status = None
+        self.reason = ''
+        self.headers = None
+        self.content_length = None
+        self.content = self
+        self.headers_received = asyncio.get_running_loop().create_future()
+        # (data, flow controlled length) pairs, the flow control window is only reopened once a chunk is consumed
+        self.chunks = collections.deque()
+        self.data_received = asyncio.Event()
+        self.ended = False
+        self.error = None
+        self.released = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+    def on_headers(self, headers):
+        if self.headers_received.done():
+            return
+        response_headers = CIMultiDict()
+        for name, value in headers:
+            name, value = name.decode(), value.decode('latin-1')
+            if name == ':status':
+                self.status = int(value)
+            elif not name.startswith(':'):
+                response_headers.add(name, value)
+        self.headers = CIMultiDictProxy(response_headers)
+        try:
+            self.reason = http.HTTPStatus(self.status).phrase
+        except ValueError:
+            self.reason = ''
+        content_length = self.headers.get('Content-Length')
+        self.content_length = int(content_length) if content_length and content_length.isdigit() else None
+        self.headers_received.set_result(self)
+
+    def on_data(self, data, flow_controlled_length):
+        self.chunks.append((data, flow_controlled_length))
+        self.data_received.set()
+
+    def on_end(self):
+        self.ended = True
+        self.data_received.set()
+
+    def fail(self, error):
+        if not self.headers_received.done():
+            self.headers_received.set_exception(error)
+        elif not self.ended:
+            self.error = error
+            self.data_received.set()
+
+    async def iter_any(self):
+        while True:
+            if self.chunks:
+                data, flow_controlled_length = self.chunks.popleft()
+                self.connection.acknowledge(self.stream_id, flow_controlled_length)
+                yield data
+            elif self.ended:
+                return
+            elif self.error is not None:
+                raise self.error
+            else:
+                self.data_received.clear()
+                await asyncio.wait_for(self.data_received.wait(), self.timeout)
+
+    async def read(self):
+        return b''.join([chunk async for chunk in self.iter_any()])
+
+    async def text(self, encoding='utf-8'):
+        return (await self.read()).decode(encoding, errors='replace')
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.connection.finish_stream(self.stream_id, reset=not self.ended)
+
+
+class HTTP2Connection:
+    # One socket to a VPS carrying up to max_streams concurrent requests
+    def __init__(self, transport, vps):
+        self.transport = transport
+        self.vps = vps
+        url = urlsplit(vps)
+        self.scheme = url.scheme or 'http'
+        self.host = url.hostname
+        self.port = url.port or (443 if self.scheme == 'https' else 80)
+        self.authority = url.netloc
+        self.reader = None
+        self.writer = None
+        self.h2 = None
+        self.streams = {}
+        # Streams handed out by HTTP2Transport.acquire, reserved before their HEADERS frame is sent
+        self.reserved = 0
+        self.closed = False
+        self.going_away = False
+        self.read_task = None
+        self.window_updated = asyncio.Event()
+        self.settings_received = asyncio.Event()
+        self.idle_timer = None
+
+    async def connect(self):
+        import h2.config
+        import h2.connection
+        import h2.settings
+        ssl_context = None
+        if self.scheme == 'https':
+            ssl_context = ssl.create_default_context()
+            ssl_context.set_alpn_protocols(['h2'])
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=ssl_context), self.transport.timeout)
+        if ssl_context is not None:
+            ssl_object = self.writer.get_extra_info('ssl_object')
+            if ssl_object.selected_alpn_protocol() != 'h2':
+                self.writer.close()
+                raise aiohttp.ClientConnectionError(f"{self.vps} does not speak HTTP/2")
+        self.h2 = h2.connection.H2Connection(h2.config.H2Configuration(client_side=True, header_encoding=None))
+        self.h2.local_settings = h2.settings.Settings(client=True, initial_values={
+            h2.settings.SettingCodes.ENABLE_PUSH: 0,
+            h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: self.transport.window_size,
+        })
+        self.h2.initiate_connection()
+        if self.transport.window_size > 65535:
+            self.h2.increment_flow_control_window(self.transport.window_size - 65535)
+        self.flush()
+        self.read_task = asyncio.ensure_future(self.read_loop())
+        # The stream limit of the VPS is only known from its first SETTINGS frame
+        try:
+            await asyncio.wait_for(self.settings_received.wait(), self.transport.timeout)
+        except asyncio.TimeoutError:
+            self.close()
+            raise
+        if self.closed:
+            raise aiohttp.ServerDisconnectedError(f"{self.vps} closed the HTTP/2 connection")
+
+    @property
+    def max_streams(self):
+        return min(self.transport.max_streams, self.h2.remote_settings.max_concurrent_streams)
+
+    @property
+    def active_streams(self):
+        return len(self.streams) + self.reserved
+
+    def has_capacity(self):
+        return not self.closed and not self.going_away and self.active_streams < self.max_streams
+
+    def flush(self):
+        data = self.h2.data_to_send()
+        if data and not self.closed:
+            self.writer.write(data)
+
+    async def read_loop(self):
+        import h2.exceptions
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    raise aiohttp.ServerDisconnectedError()
+                for event in self.h2.receive_data(data):
+                    self.handle_event(event)
+                self.flush()
+        except asyncio.CancelledError:
+            self.close(aiohttp.ServerDisconnectedError("Connection closed"))
+            raise
+        except (OSError, aiohttp.ClientError, h2.exceptions.ProtocolError) as e:
+            if not isinstance(e, aiohttp.ClientError):
+                e = aiohttp.ClientConnectionError(f"HTTP/2 connection to {self.vps} failed: {e}")
+            self.close(e)
+
+    def handle_event(self, event):
+        import h2.events
+        if isinstance(event, h2.events.ResponseReceived):
+            response = self.streams.get(event.stream_id)
+            if response is not None:
+                response.on_headers(event.headers)
+        elif isinstance(event, h2.events.DataReceived):
+            response = self.streams.get(event.stream_id)
+            if response is not None:
+                response.on_data(event.data, event.flow_controlled_length)
+            else:
+                self.acknowledge(event.stream_id, event.flow_controlled_length)
+        elif isinstance(event, h2.events.StreamEnded):
+            response = self.streams.get(event.stream_id)
+            if response is not None:
+                response.on_end()
+        elif isinstance(event, h2.events.StreamReset):
+            response = self.streams.get(event.stream_id)
+            if response is not None:
+                response.fail(aiohttp.ClientPayloadError(f"Stream reset by {self.vps}, "
+                                                         f"error code {event.error_code}"))
+        elif isinstance(event, h2.events.WindowUpdated):
+            self.window_updated.set()
+        elif isinstance(event, h2.events.RemoteSettingsChanged):
+            # The VPS announces how many streams it accepts, more waiting requests may fit now
+            self.transport.publish_stream_limit(self.vps, self.max_streams)
+            self.settings_received.set()
+            self.window_updated.set()
+            self.transport.notify(self.vps)
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            # GOAWAY: streams above last_stream_id were not processed and can safely be retried elsewhere
+            self.going_away = True
+            for stream_id, response in list(self.streams.items()):
+                if event.last_stream_id is None or stream_id > event.last_stream_id:
+                    response.fail(aiohttp.ServerDisconnectedError("Connection going away"))
+            self.transport.notify(self.vps)
+            if not self.streams:
+                self.close()
+
+    async def request(self, method, path, headers, data):
+        # Called with a stream reserved by HTTP2Transport.acquire
+        import h2.exceptions
+        self.reserved -= 1
+        if self.closed or self.going_away:
+            self.transport.notify(self.vps)
+            raise aiohttp.ServerDisconnectedError("Connection going away")
+        stream_id = self.h2.get_next_available_stream_id()
+        request_headers = [(':method', method), (':scheme', self.scheme), (':authority', self.authority),
+                           (':path', path)]
+        for name, value in (headers or {}).items():
+            name = name.lower()
+            if name not in self.transport.connection_headers:
+                request_headers.append((name, value))
+        response = HTTP2Response(self, stream_id, self.transport.timeout)
+        self.streams[stream_id] = response
+        try:
+            try:
+                self.h2.send_headers(stream_id, request_headers, end_stream=data is None)
+                self.flush()
+                if data is not None:
+                    await self.send_body(stream_id, data)
+            except h2.exceptions.ProtocolError as e:
+                raise aiohttp.ClientConnectionError(f"HTTP/2 request to {self.vps} failed: {e}")
+            return await asyncio.wait_for(response.headers_received, self.transport.timeout)
+        except BaseException:
+            response.release()
+            raise
+
+    async def send_body(self, stream_id, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            await self.send_data(stream_id, bytes(data))
+        elif isinstance(data, str):
+            await self.send_data(stream_id, data.encode())
+        else:
+            # aiohttp StreamReader of the client request, or any async iterable of bytes
+            chunks = data.iter_any() if hasattr(data, 'iter_any') else data
+            async for chunk in chunks:
+                await self.send_data(stream_id, chunk)
+        self.h2.end_stream(stream_id)
+        self.flush()
+
+    async def send_data(self, stream_id, data):
+        # Never more than the VPS is ready to take: the flow control windows of the stream and the connection
+        view = memoryview(data)
+        while view:
+            if self.closed:
+                raise aiohttp.ServerDisconnectedError()
+            window = min(self.h2.local_flow_control_window(stream_id), self.h2.max_outbound_frame_size)
+            if window <= 0:
+                self.window_updated.clear()
+                await asyncio.wait_for(self.window_updated.wait(), self.transport.timeout)
+                continue
+            self.h2.send_data(stream_id, view[:window].tobytes())
+            view = view[window:]
+            self.flush()
+            await self.writer.drain()
+
+    def acknowledge(self, stream_id, flow_controlled_length):
+        if not self.closed and flow_controlled_length:
+            self.h2.acknowledge_received_data(flow_controlled_length, stream_id)
+            self.flush()
+
+    def finish_stream(self, stream_id, reset=False):
+        import h2.errors
+        import h2.exceptions
+        if self.streams.pop(stream_id, None) is None:
+            return
+        if reset and not self.closed:
+            try:
+                self.h2.reset_stream(stream_id, h2.errors.ErrorCodes.CANCEL)
+                self.flush()
+            except h2.exceptions.StreamClosedError:
+                pass
+        if self.going_away and not self.streams:
+            self.close()
+        elif not self.closed and not self.active_streams:
+            self.schedule_idle_close()
+        self.transport.notify(self.vps)
+
+    def schedule_idle_close(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        loop = asyncio.get_running_loop()
+        self.idle_timer = loop.call_later(self.transport.keepalive_timeout, self.close_if_idle)
+
+    def close_if_idle(self):
+        self.idle_timer = None
+        if not self.active_streams:
+            self.close()
+
+    def close(self, error=None):
+        if self.closed:
+            return
+        if self.h2 is not None and error is None:
+            try:
+                self.h2.close_connection()
+                self.flush()
+            except Exception:
+                pass
+        self.closed = True
+        self.settings_received.set()
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        error = error or aiohttp.ServerDisconnectedError("Connection closed")
+        for response in list(self.streams.values()):
+            response.fail(error)
+        if self.writer is not None:
+            self.writer.close()
+        if self.read_task is not None and self.read_task is not asyncio.current_task():
+            self.read_task.cancel()
+        self.transport.notify(self.vps)
+
+
+class HTTP2Transport:
+    # HTTP/2 to the VPSes: h2c with prior knowledge for http:// URLs, ALPN negotiated h2 for https://.
+    # Requests are multiplexed as streams over at most connections_per_vps sockets per VPS, a request
+    # that finds every stream taken waits for one instead of opening another socket
+    protocol = 'http2'
+    connection_headers = frozenset(['connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade',
+                                    'host', 'te', 'http2-settings'])
+
+    def __init__(self, connection_pool, health_checker=None, connections_per_vps=2, max_streams=100,
+                 window_size=1024 * 1024):
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            raise ImportError("HTTP/2 upstreams need the h2 package: pip install h2")
+        self.connection_pool = connection_pool
+        # Told the stream capacity of every VPS, least_connections and the concurrency limits use it
+        self.health_checker = health_checker
+        self.connections_per_vps = connections_per_vps
+        self.max_streams = max_streams
+        # Initial flow control window of each stream, how much a VPS may send ahead of the client reading it
+        self.window_size = window_size
+        self.connections = {}
+        self.connecting = {}
+        self.waiters = {}
+
+    @property
+    def timeout(self):
+        return self.connection_pool.timeout
+
+    @property
+    def keepalive_timeout(self):
+        return self.connection_pool.keepalive_timeout
+
+    async def request(self, method, url, headers=None, data=None, proxy=False):
+        # Redirects are never followed. The request headers are sent as is, so the body only comes
+        # compressed if the client asked for it
+        parts = urlsplit(url)
+        vps = f'{parts.scheme}://{parts.netloc}'
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        connection = await self.acquire(vps)
+        mark('pool_wait')
+        return await connection.request(method, path, headers, data)
+
+    async def acquire(self, vps):
+        # A stream on the busiest connection that still has room, so idle sockets time out; a new
+        # connection only when all of them are full
+        deadline = time.monotonic() + self.timeout
+        while True:
+            connections = [connection for connection in self.connections.get(vps, ()) if not connection.closed]
+            self.connections[vps] = connections
+            available = [connection for connection in connections if connection.has_capacity()]
+            if available:
+                connection = max(available, key=lambda connection: connection.active_streams)
+                connection.reserved += 1
+                return connection
+            if len(connections) + self.connecting.get(vps, 0) < self.connections_per_vps:
+                return await self.connect(vps)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.setdefault(vps, collections.deque()).append(waiter)
+            try:
+                await asyncio.wait_for(waiter, remaining)
+            finally:
+                if not waiter.done():
+                    waiter.cancel()
+
+    async def connect(self, vps):
+        self.connecting[vps] = self.connecting.get(vps, 0) + 1
+        connection = HTTP2Connection(self, vps)
+        try:
+            await connection.connect()
+        except (OSError, asyncio.TimeoutError) as e:
+            raise aiohttp.ClientConnectionError(f"Cannot connect to {vps}: {e}")
+        finally:
+            self.connecting[vps] -= 1
+            # The requests waiting for this slot try again: the new connection, or a connect of their own
+            self.notify(vps)
+        connection.reserved += 1
+        self.connections.setdefault(vps, []).append(connection)
+        mark('connect')
+        return connection
+
+    def notify(self, vps):
+        # A stream or a connection slot was freed, the waiting requests try again
+        waiters = self.waiters.pop(vps, None)
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def publish_stream_limit(self, vps, max_streams):
+        if self.health_checker is not None:
+            self.health_checker.set_stream_limit(vps, max_streams * self.connections_per_vps)
+
+    def get_connection_count(self, vps=None):
+        vps_list = self.connections if vps is None else [vps]
+        return sum(1 for vps in vps_list for connection in self.connections.get(vps, ()) if not connection.closed)
+
+    async def close(self):
+        for connections in self.connections.values():
+            for connection in connections:
+                connection.close()
+        tasks = [connection.read_task for connections in self.connections.values() for connection in connections
+                 if connection.read_task is not None]
+        self.connections = {}
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,9 +1,54 @@
+from load_balancer.backend import Backend
+
+
 class VPSList:
+    # One VPS per line, optionally followed by its attributes, blank lines and '#' comments are skipped:
+    #   http://vps1.example.com weight=2 zone=eu-west-1a max_connections=200 health_path=/healthz tags=ssd,canary
     def load_from_file(self, filename):
-        vps_list = []
+        return [backend.url for backend in self.load_backends(filename)]
+
+    def load_backends(self, filename):
+        backends = []
 
         with open(filename, 'r') as file:
-            vps_list = [line.strip() for line in file]
+            for line_number, line in enumerate(file, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                url, *fields = line.split()
+                attributes = {}
+                for field in fields:
+                    name, separator, value = field.partition('=')
+                    if not separator:
+                        raise ValueError(f"{filename}:{line_number}: expected name=value, got {field!r}")
+                    attributes[name] = value.split(',') if name == 'tags' else value
+                backends.append(self.make_backend(url, attributes, f"{filename}:{line_number}"))
+
+        return backends
 
-        return vps_list
+    def load_from_config(self, entries):
+        # 'load_balancer.backends' section of config.yaml: a list of URLs or of mappings with a 'url' key
+        backends = []
+        for entry in entries:
+            if isinstance(entry, str):
+                backends.append(Backend(entry))
+                continue
+            attributes = dict(entry)
+            url = attributes.pop('url', None)
+            if not url:
+                raise ValueError(f"Backend without url in config: {entry!r}")
+            backends.append(self.make_backend(url, attributes, url))
+        return backends
 
+    def make_backend(self, url, attributes, location):
+        unknown = set(attributes) - set(Backend.attributes)
+        if unknown:
+            raise ValueError(f"{location}: unknown backend attributes {', '.join(sorted(unknown))}")
+        try:
+            if 'weight' in attributes:
+                attributes['weight'] = float(attributes['weight'])
+            if 'max_connections' in attributes:
+                attributes['max_connections'] = int(attributes['max_connections'])
+        except ValueError as e:
+            raise ValueError(f"{location}: {e}")
+        return Backend(url, **attributes)
@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import os
+import signal
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigWatcher:
+    # Polls the modification times of config.yaml and the VPS list file and reloads on change or SIGHUP.
+    # Polling keeps it dependency-free and works on every platform and filesystem
+    def __init__(self, load_balancer, interval=1.0):
+        self.load_balancer = load_balancer
+        self.interval = interval
+        self.task = None
+        self.signal_installed = False
+
+    def configure(self, config):
+        # Apply the 'load_balancer.reload' section of config.yaml
+        if not config:
+            return
+        self.interval = config.get('interval', self.interval)
+
+    def get_watched_files(self):
+        files = [self.load_balancer.configuration.config_file]
+        if self.load_balancer.vps_list_file is not None:
+            files.append(self.load_balancer.vps_list_file)
+        return files
+
+    def get_modified_times(self):
+        modified_times = []
+        for filename in self.get_watched_files():
+            try:
+                modified_times.append(os.stat(filename).st_mtime_ns)
+            except OSError:
+                modified_times.append(None)
+        return modified_times
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        if not self.signal_installed:
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self.request_reload)
+                self.signal_installed = True
+            except (NotImplementedError, RuntimeError, AttributeError):
+                # No SIGHUP on this platform, or not running in the main thread
+                pass
+
+    async def stop(self):
+        if self.signal_installed:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+            self.signal_installed = False
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def request_reload(self):
+        asyncio.ensure_future(self.reload())
+
+    async def reload(self):
+        try:
+            await self.load_balancer.reload()
+            logger.info("Configuration and VPS list reloaded")
+        except Exception as e:
+            # A broken file must not take the balancer down, the previous state stays active
+            logger.error(f"Reload failed, keeping the current configuration: {e}")
+
+    async def run(self):
+        modified_times = self.get_modified_times()
+        while True:
+            await asyncio.sleep(self.interval)
+            current_modified_times = self.get_modified_times()
+            if current_modified_times != modified_times:
+                modified_times = current_modified_times
+                await self.reload()
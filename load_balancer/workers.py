@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+from multiprocessing import shared_memory
+
+logger = logging.getLogger(__name__)
+
+
+class SharedBackendState:
+    # Layout of the int32 array: health[n], weight[n], then one row of connection counts per worker.
+    # Every cell has a single writer (the health-checking worker or the owning worker), so no locks are needed
+    def __init__(self, vps_list, workers, name=None):
+        self.vps_list = list(vps_list)
+        self.indexes = {vps: i for i, vps in enumerate(self.vps_list)}
+        self.workers = workers
+        size = len(self.vps_list)
+        cells = size * (2 + workers)
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=max(cells, 1) * 4)
+            self.owner = True
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.cells = self.memory.buf.cast('i')
+        if self.owner:
+            for i in range(size):
+                self.cells[i] = 1
+                self.cells[size + i] = -1
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def __contains__(self, vps):
+        return vps in self.indexes
+
+    def is_healthy(self, vps):
+        return self.cells[self.indexes[vps]] == 1
+
+    def set_health(self, vps, is_up):
+        self.cells[self.indexes[vps]] = 1 if is_up else 0
+
+    def get_weight(self, vps):
+        # -1 when no worker has published a weight yet
+        return self.cells[len(self.vps_list) + self.indexes[vps]]
+
+    def set_weight(self, vps, weight):
+        self.cells[len(self.vps_list) + self.indexes[vps]] = weight
+
+    def set_connections(self, worker_index, vps, connections):
+        self.cells[len(self.vps_list) * (2 + worker_index) + self.indexes[vps]] = connections
+
+    def get_connections(self, vps, exclude_worker=None):
+        size = len(self.vps_list)
+        index = self.indexes[vps]
+        return sum(self.cells[size * (2 + worker) + index]
+                   for worker in range(self.workers) if worker != exclude_worker)
+
+    def close(self):
+        self.cells.release()
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def run_worker(worker_index, workers, shared_memory_name, shared_vps_list, metrics_directory, vps_list_file,
+               balancing_algorithm):
+    from load_balancer.balancer import LoadBalancer
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    # Ctrl+C reaches the whole process group, the parent alone decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop)
+    load_balancer = LoadBalancer(balancing_algorithm=balancing_algorithm)
+    # The parent exports the metrics of all workers, each one hands it its own totals
+    load_balancer.metrics.export_to(os.path.join(metrics_directory, f'worker-{worker_index}.pickle'))
+    load_balancer.load_vps_list(vps_list_file)
+    # Indexed by the parent's list, backends the worker learns about later are simply not shared
+    shared_state = SharedBackendState(shared_vps_list, workers, shared_memory_name)
+    load_balancer.health_checker.attach_shared_state(shared_state, worker_index)
+    # Every worker binds its own socket, the kernel spreads incoming connections between them
+    load_balancer.proxy_server.reuse_port = True
+    load_balancer.tcp_proxy.reuse_port = True
+    try:
+        asyncio.run(load_balancer.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shared_state.close()
+
+
+def run_workers(workers, vps_list_file='vps_list.txt', balancing_algorithm='round_robin'):
+    # Pre-fork mode: the parent owns the shared segment, exports the merged metrics and supervises the workers
+    from load_balancer.balancer import LoadBalancer
+
+    load_balancer = LoadBalancer()
+    # Read like LoadBalancer.load_vps_list does, config.yaml backends included, and handed to the workers
+    vps_list = load_balancer.read_vps_list(vps_list_file)
+    shared_state = SharedBackendState(vps_list, workers)
+    metrics_directory = tempfile.mkdtemp(prefix='load_balancer-metrics-')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run_worker, name=f'load_balancer-worker-{i}',
+                                 args=(i, workers, shared_state.name, vps_list, metrics_directory, vps_list_file,
+                                       balancing_algorithm))
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+    logger.info(f"Started {workers} workers")
+    # Bound once the workers are forked, so they do not inherit the exporter's socket
+    load_balancer.configuration.load()
+    load_balancer.metrics.configure((load_balancer.configuration.get('load_balancer') or {}).get('metrics'))
+    load_balancer.metrics.setup_workers(metrics_directory)
+
+    def terminate(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        terminate(signal.SIGINT, None)
+        for process in processes:
+            process.join()
+    finally:
+        shared_state.close()
+        shutil.rmtree(metrics_directory, ignore_errors=True)
@@ -0,0 +1,61 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ZoneRouter:
+    # Keeps traffic in the local zone and spills over to the other zones only when the local one
+    # has too few healthy backends or is running out of capacity
+    def __init__(self, zone=None, min_healthy_percent=50, spillover_threshold=0.8, default_capacity=100):
+        # Zone of this load balancer, None disables zone-aware routing
+        self.zone = zone
+        # Zone the rotation was last computed for
+        self.applied_zone = None
+        self.min_healthy_percent = min_healthy_percent
+        # Share of the local capacity in use at which the other zones are added to the rotation
+        self.spillover_threshold = spillover_threshold
+        # Capacity of a local backend without max_connections
+        self.default_capacity = default_capacity
+        self.spilling_over = False
+        # Too few healthy local backends, the spillover then does not depend on the load
+        self.short_of_backends = False
+        self.local_connections = 0
+        self.local_capacity = 0
+
+    def configure(self, config):
+        # Apply the 'load_balancer.zone_routing' section of config.yaml
+        if not config:
+            return
+        self.zone = config.get('zone', self.zone)
+        self.min_healthy_percent = config.get('min_healthy_percent', self.min_healthy_percent)
+        self.spillover_threshold = config.get('spillover_threshold', self.spillover_threshold)
+        self.default_capacity = config.get('default_capacity', self.default_capacity)
+
+    def is_local(self, backend):
+        return backend is not None and backend.zone == self.zone
+
+    def allows(self, backend):
+        return self.zone is None or self.spilling_over or self.is_local(backend)
+
+    def is_overloaded(self):
+        # Leaves the spillover state only at 90% of the threshold, so it does not flap around it
+        threshold = self.spillover_threshold * (0.9 if self.spilling_over else 1.0)
+        return self.local_connections >= self.local_capacity * threshold
+
+    def update(self, local_count, healthy_backends, local_connections):
+        # healthy_backends: local backends passing health checks and not ejected.
+        # Returns True when the spillover state changed
+        self.local_capacity = sum(backend.max_connections or self.default_capacity for backend in healthy_backends)
+        self.local_connections = local_connections
+        self.short_of_backends = (not healthy_backends
+                                  or len(healthy_backends) * 100 < local_count * self.min_healthy_percent)
+        spilling_over = self.short_of_backends or self.is_overloaded()
+        if spilling_over == self.spilling_over:
+            return False
+        self.spilling_over = spilling_over
+        if spilling_over:
+            logger.warning(f"Zone {self.zone}: {len(healthy_backends)}/{local_count} backends healthy, "
+                           f"{local_connections}/{self.local_capacity} connections, spilling over to other zones")
+        else:
+            logger.info(f"Zone {self.zone}: back to local backends only")
+        return True
@@ -1,13 +1,36 @@
+import argparse
 import asyncio
 from load_balancer.balancer import LoadBalancer
+from load_balancer.workers import run_workers
 
 
-async def main():
-    load_balancer = LoadBalancer()
-    load_balancer.load_vps_list('vps_list.txt')
+async def main(args):
+    load_balancer = LoadBalancer(balancing_algorithm=args.algorithm)
+    load_balancer.load_vps_list(args.vps_list)
 
-    await load_balancer.distribute_load_concurrently(10)
+    if args.serve:
+        await load_balancer.serve()
+        return
+
+    load_balancer.start()
+    try:
+        await load_balancer.distribute_load_concurrently(args.requests)
+    finally:
+        await load_balancer.close()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description='Load Balancer')
+    parser.add_argument('--serve', action='store_true', help='run as a reverse proxy on the configured port')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes in --serve mode')
+    parser.add_argument('--algorithm', default='round_robin', help='balancing algorithm')
+    parser.add_argument('--vps-list', default='vps_list.txt', help='file with one VPS URL (and its attributes) per line')
+    parser.add_argument('--requests', type=int, default=10, help='number of requests to distribute')
+    args = parser.parse_args()
+    if args.serve and args.workers > 1:
+        run_workers(args.workers, args.vps_list, args.algorithm)
+    else:
+        try:
+            asyncio.run(main(args))
+        except KeyboardInterrupt:
+            pass
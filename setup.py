@@ -45,4 +45,7 @@ setup(
         'yarl',
 
     ],
+    extras_require={
+        'http2': ['h2'],
+    },
 )
@@ -0,0 +1,43 @@
+import pytest
+from aiohttp import web
+from load_balancer.balancer import LoadBalancer
+
+
+@pytest.fixture
+def start_backend():
+    # await start_backend(handler) -> (runner, url), handler serves every path and method on a free local port
+    async def start_backend(handler):
+        app = web.Application()
+        app.router.add_route('*', '/{path:.*}', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        return runner, f'http://127.0.0.1:{runner.addresses[0][1]}'
+
+    return start_backend
+
+
+@pytest.fixture
+def make_load_balancer():
+    # config - entries of the 'load_balancer' section of config.yaml, applied as if they had been loaded from it
+    def make_load_balancer(vps_list=(), balancing_algorithm='round_robin', **config):
+        load_balancer = LoadBalancer(balancing_algorithm)
+        load_balancer.configuration.config = {'load_balancer': config}
+        load_balancer.apply_configuration()
+        load_balancer.update_vps_list(list(vps_list))
+        return load_balancer
+
+    return make_load_balancer
+
+
+@pytest.fixture
+def start_proxy():
+    # await start_proxy(load_balancer) -> the free local port the proxy server listens on
+    async def start_proxy(load_balancer):
+        load_balancer.proxy_server.host = '127.0.0.1'
+        load_balancer.proxy_server.port = 0
+        await load_balancer.proxy_server.start()
+        return load_balancer.proxy_server.runner.addresses[0][1]
+
+    return start_proxy
@@ -0,0 +1,155 @@
+import asyncio
+import aiohttp
+import pytest
+from load_balancer.admission import AdaptiveLimit, AdmissionController, OverloadedError
+from load_balancer.balancer import LoadBalancer
+
+
+def test_gradient_limit_shrinks_when_latency_rises():
+    limit = AdaptiveLimit(initial=20, algorithm='gradient')
+    for _ in range(20):
+        limit.on_sample(0.01, True, 20)
+    grown = limit.limit
+    for _ in range(20):
+        limit.on_sample(0.1, True, 20)
+
+    assert grown > 20
+    assert limit.limit < grown
+
+
+def test_aimd_limit_backs_off_on_failure():
+    limit = AdaptiveLimit(initial=10, algorithm='aimd', backoff=0.5)
+    limit.on_sample(0.01, True, 10)
+    assert limit.limit == pytest.approx(10.1)
+
+    limit.on_sample(0.01, False, 10)
+    assert limit.limit == pytest.approx(5.05)
+
+    limit.on_sample(0.01, True, 1)
+    assert limit.limit == pytest.approx(5.05)
+
+
+def make_controller(limit=1, max_queue_size=10, queue_timeout=1.0):
+    controller = AdmissionController(max_queue_size=max_queue_size, queue_timeout=queue_timeout)
+    controller.enabled = True
+    controller.limit = AdaptiveLimit(initial=limit, min_limit=limit, max_limit=limit)
+    return controller
+
+
+def test_queued_requests_are_admitted_by_priority():
+    controller = make_controller()
+    admitted = []
+
+    async def request(name, priority):
+        admitted_at = await controller.acquire(priority)
+        admitted.append(name)
+        await asyncio.sleep(0)
+        controller.release(admitted_at, True)
+
+    async def scenario():
+        first = await controller.acquire()
+        tasks = [asyncio.ensure_future(request(name, priority))
+                 for name, priority in [('low', 'low'), ('normal', None), ('critical', 'critical')]]
+        await asyncio.sleep(0)
+        controller.release(first, True)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(scenario())
+
+    assert admitted == ['critical', 'normal', 'low']
+    assert controller.in_flight == 0
+
+
+def test_full_queue_sheds_the_lowest_priority():
+    controller = make_controller(max_queue_size=1)
+
+    async def scenario():
+        await controller.acquire()
+        low = asyncio.ensure_future(controller.acquire('low'))
+        await asyncio.sleep(0)
+        high = asyncio.ensure_future(controller.acquire('high'))
+        await asyncio.sleep(0)
+        with pytest.raises(OverloadedError):
+            await low
+        with pytest.raises(OverloadedError):
+            await controller.acquire('high')
+        high.cancel()
+
+    asyncio.run(scenario())
+
+    assert controller.shed_count == 2
+
+
+def test_queue_timeout_sheds_the_request():
+    controller = make_controller(queue_timeout=0.01)
+
+    async def scenario():
+        await controller.acquire()
+        with pytest.raises(OverloadedError):
+            await controller.acquire()
+
+    asyncio.run(scenario())
+
+    assert controller.queued == 0
+
+
+def test_vps_at_its_limit_is_skipped():
+    load_balancer = LoadBalancer(balancing_algorithm='least_connections')
+    load_balancer.health_checker.set_vps_list(['http://vps1', 'http://vps2'])
+    load_balancer.admission_controller.enabled = True
+    load_balancer.admission_controller.get_vps_limit('http://vps1').limit = 1
+    load_balancer.admission_controller.get_vps_limit('http://vps2').limit = 1
+    load_balancer.health_checker.increase_connection_count('http://vps1')
+
+    assert load_balancer.get_next_vps_excluding(None, []) == 'http://vps2'
+
+    load_balancer.health_checker.increase_connection_count('http://vps2')
+    with pytest.raises(OverloadedError):
+        load_balancer.get_next_vps_excluding(None, [])
+
+
+def test_distribute_load_concurrently_bounds_the_fan_out(mocker):
+    load_balancer = LoadBalancer(balancing_algorithm='least_connections')
+    load_balancer.health_checker.set_vps_list(['http://vps1', 'http://vps2'])
+    load_balancer.connection_pool.max_connections = 5
+    in_flight = []
+
+    async def send_request(vps):
+        in_flight.append(load_balancer.health_checker.total_connections)
+        await asyncio.sleep(0)
+        return 'ok'
+
+    mocker.patch.object(load_balancer.request_handler, 'send_request', side_effect=send_request)
+
+    asyncio.run(load_balancer.distribute_load_concurrently(50))
+
+    assert len(in_flight) == 50
+    assert max(in_flight) == 5
+
+
+def test_distribute_load_concurrently_without_a_connection_limit(mocker):
+    load_balancer = LoadBalancer()
+    load_balancer.health_checker.set_vps_list(['http://vps1', 'http://vps2'])
+    load_balancer.connection_pool.max_connections = 0
+    send_request = mocker.patch.object(load_balancer.request_handler, 'send_request', return_value='ok')
+
+    asyncio.run(load_balancer.distribute_load_concurrently(20))
+
+    assert send_request.call_count == 20
+
+
+def test_proxy_sheds_with_503_when_overloaded(start_proxy):
+    async def scenario():
+        load_balancer = LoadBalancer()
+        load_balancer.admission_controller.enabled = True
+        load_balancer.admission_controller.max_queue_size = 0
+        load_balancer.admission_controller.in_flight = load_balancer.admission_controller.limit.get()
+        port = await start_proxy(load_balancer)
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f'http://127.0.0.1:{port}/') as response:
+                    return response.status, response.headers.get('Retry-After')
+        finally:
+            await load_balancer.close()
+
+    assert asyncio.run(scenario()) == (503, '1')
@@ -0,0 +1,104 @@
+import asyncio
+import pytest
+from load_balancer.backend import Backend
+from load_balancer.balancer import LoadBalancer
+from load_balancer.health_checker import HealthChecker
+from load_balancer.vps_list import VPSList
+
+
+def test_vps_list_file_with_attributes(tmp_path):
+    path = tmp_path / 'vps_list.txt'
+    path.write_text('# inventory\n'
+                    'http://vps1 weight=2 zone=eu-1a max_connections=50 health_path=/healthz tags=ssd,canary\n'
+                    '\n'
+                    '  http://vps2  \n')
+
+    backends = VPSList().load_backends(str(path))
+
+    assert [backend.url for backend in backends] == ['http://vps1', 'http://vps2']
+    assert backends[0].weight == 2
+    assert backends[0].zone == 'eu-1a'
+    assert backends[0].max_connections == 50
+    assert backends[0].health_path == '/healthz'
+    assert backends[0].tags == {'ssd', 'canary'}
+    assert backends[1].zone is None
+    assert VPSList().load_from_file(str(path)) == ['http://vps1', 'http://vps2']
+
+
+def test_vps_list_rejects_unknown_attributes(tmp_path):
+    path = tmp_path / 'vps_list.txt'
+    path.write_text('http://vps1 colour=red\n')
+
+    with pytest.raises(ValueError, match='colour'):
+        VPSList().load_backends(str(path))
+
+
+def test_backends_from_config():
+    backends = VPSList().load_from_config(['http://vps1', {'url': 'http://vps2', 'zone': 'eu-1b', 'tags': ['a']}])
+
+    assert [(backend.url, backend.zone, backend.tags) for backend in backends] == [
+        ('http://vps1', None, frozenset()), ('http://vps2', 'eu-1b', {'a'})]
+
+
+def test_reloaded_inventory_keeps_telemetry():
+    health_checker = HealthChecker()
+    health_checker.set_vps_list([Backend('http://vps1', weight=1)])
+    health_checker.get_backend('http://vps1').observe({'cpu_usage': 50}, 1, 0)
+
+    health_checker.set_vps_list([Backend('http://vps1', weight=3)])
+
+    assert health_checker.get_weight('http://vps1') == 150
+
+
+def test_backend_max_connections_is_enforced():
+    load_balancer = LoadBalancer(balancing_algorithm='least_connections')
+    load_balancer.update_vps_list([Backend('http://vps1', max_connections=1), Backend('http://vps2')])
+    load_balancer.health_checker.increase_connection_count('http://vps1')
+
+    assert not load_balancer.has_capacity('http://vps1')
+    assert load_balancer.has_capacity('http://vps2')
+    assert load_balancer.vps_manager.vps_list == ['http://vps1', 'http://vps2']
+
+
+def make_zoned_health_checker():
+    health_checker = HealthChecker()
+    health_checker.zone_router.zone = 'a'
+    health_checker.set_vps_list([Backend('http://a1', zone='a', max_connections=2),
+                                 Backend('http://a2', zone='a', max_connections=2),
+                                 Backend('http://b1', zone='b')])
+    return health_checker
+
+
+def test_zone_routing_prefers_local_backends():
+    health_checker = make_zoned_health_checker()
+
+    assert health_checker.healthy_vps == {'http://a1', 'http://a2'}
+    assert set(health_checker.get_available_vps()) == {'http://a1', 'http://a2'}
+
+
+def test_zone_routing_spills_over_when_local_backends_are_down(mocker):
+    health_checker = make_zoned_health_checker()
+    mocker.patch.object(health_checker, 'handle_failure')
+    health_checker.zone_router.min_healthy_percent = 75
+    health_checker.fall = 1
+    health_checker.rise = 1
+
+    async def scenario():
+        health_checker.update_health('http://a1', False)
+        spilled = set(health_checker.healthy_vps)
+        health_checker.update_health('http://a1', True)
+        return spilled, set(health_checker.healthy_vps)
+
+    assert asyncio.run(scenario()) == ({'http://a2', 'http://b1'}, {'http://a1', 'http://a2'})
+
+
+def test_zone_routing_spills_over_by_capacity():
+    health_checker = make_zoned_health_checker()
+    health_checker.zone_router.spillover_threshold = 0.75
+
+    for vps in ('http://a1', 'http://a1', 'http://a2'):
+        health_checker.increase_connection_count(vps)
+    assert 'http://b1' in health_checker.healthy_vps
+
+    health_checker.decrease_connection_count('http://a1')
+    assert 'http://b1' not in health_checker.healthy_vps
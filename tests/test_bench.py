@@ -0,0 +1,20 @@
+from load_balancer import bench
+
+
+def test_bench_reports_every_requested_algorithm(capsys):
+    results = bench.main(['--algorithms', 'round_robin', 'least_connections', '--backends', '2',
+                          '--concurrency', '4', '--duration', '0.3', '--latency', '0.001', '--json'])
+
+    assert [result['algorithm'] for result in results] == ['round_robin', 'least_connections']
+    for result in results:
+        assert result['requests'] > 0
+        assert sum(result['distribution']) == result['requests']
+        assert result['p50_ms'] <= result['p95_ms'] <= result['p99_ms']
+    assert '"algorithm": "round_robin"' in capsys.readouterr().out
+
+
+def test_import_has_no_side_effects_and_defers_heavy_dependencies():
+    result = bench.measure_import_time('load_balancer.balancer', 1)
+
+    assert result['median_ms'] > 0
+    assert not {'yaml', 'dotenv', 'prometheus_client'} & set(result['heavy_dependencies'])
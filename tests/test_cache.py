@@ -0,0 +1,203 @@
+import asyncio
+import aiohttp
+from aiohttp import web
+from load_balancer.balancer import LoadBalancer
+from load_balancer.cache import ResponseCache, CachedResponse, parse_cache_control
+
+
+def make_response(body=b'ok', status=200, **headers):
+    return CachedResponse(status, {name.replace('_', '-'): value for name, value in headers.items()}, body)
+
+
+def test_parse_cache_control():
+    assert parse_cache_control('public, Max-Age=60, stale-while-revalidate="30"') == {
+        'public': None, 'max-age': '60', 'stale-while-revalidate': '30'}
+    assert parse_cache_control(None) == {}
+
+
+def test_freshness_follows_cache_control():
+    cache = ResponseCache()
+
+    assert cache.get_freshness(200, {'Cache-Control': 'max-age=60, stale-while-revalidate=30'}) == (60, 30)
+    assert cache.get_freshness(200, {'Cache-Control': 'max-age=60, s-maxage=10'}) == (10, 0)
+    assert cache.get_freshness(200, {'Cache-Control': 'no-cache', 'ETag': '"v1"'}) == (0, 0)
+    assert cache.get_freshness(200, {'Cache-Control': 'no-store, max-age=60'}) is None
+    assert cache.get_freshness(200, {'Cache-Control': 'private, max-age=60'}) is None
+    assert cache.get_freshness(200, {'Cache-Control': 'max-age=60', 'Vary': '*'}) is None
+    assert cache.get_freshness(500, {'Cache-Control': 'max-age=60'}) is None
+    assert cache.get_freshness(200, {}) is None
+
+
+def test_fresh_entry_is_served_until_it_expires():
+    cache = ResponseCache()
+    fetched = []
+
+    async def fetch(headers):
+        fetched.append(headers)
+        return make_response(Cache_Control='max-age=60')
+
+    async def scenario():
+        first = await cache.get('GET', '/a', {}, fetch)
+        second = await cache.get('GET', '/a', {}, fetch)
+        cache.lookup(('GET', '/a')).expires_at = 0
+        cache.lookup(('GET', '/a')).stale_until = 0
+        third = await cache.get('GET', '/a', {}, fetch)
+        return first[1], second[1], third[1]
+
+    assert asyncio.run(scenario()) == ('MISS', 'HIT', 'MISS')
+    assert len(fetched) == 2
+
+
+def test_lru_eviction_keeps_the_cache_within_max_size():
+    cache = ResponseCache(max_size=3200)
+    for name in ('a', 'b', 'c'):
+        cache.store('GET', name, {}, make_response(b'x' * 800, Cache_Control='max-age=60'))
+    cache.lookup(('GET', 'a'))
+    cache.store('GET', 'd', {}, make_response(b'x' * 800, Cache_Control='max-age=60'))
+
+    assert list(cache.entries) == [('GET', 'c'), ('GET', 'a'), ('GET', 'd')]
+    assert cache.size <= 3200
+
+
+def test_vary_header_selects_the_variant():
+    cache = ResponseCache()
+    cache.store('GET', '/a', {'Accept-Encoding': 'gzip'},
+                make_response(b'gzip', Cache_Control='max-age=60', Vary='Accept-Encoding'))
+    cache.store('GET', '/a', {'Accept-Encoding': 'br'},
+                make_response(b'br', Cache_Control='max-age=60', Vary='Accept-Encoding'))
+
+    assert cache.lookup(cache.get_key('GET', '/a', {'Accept-Encoding': 'gzip'})).body == b'gzip'
+    assert cache.lookup(cache.get_key('GET', '/a', {'Accept-Encoding': 'br'})).body == b'br'
+    assert cache.lookup(cache.get_key('GET', '/a', {})) is None
+
+
+def test_concurrent_misses_share_one_fetch():
+    cache = ResponseCache()
+    fetched = []
+
+    async def fetch(headers):
+        fetched.append(headers)
+        await asyncio.sleep(0.01)
+        return make_response(Cache_Control='max-age=60')
+
+    async def scenario():
+        return await asyncio.gather(*(cache.get('GET', '/a', {}, fetch) for _ in range(10)))
+
+    results = asyncio.run(scenario())
+
+    assert len(fetched) == 1
+    assert sorted(status for _, status in results) == ['HIT'] * 9 + ['MISS']
+    assert all(response.body == b'ok' for response, _ in results)
+
+
+def test_concurrent_misses_only_share_their_own_variant():
+    cache = ResponseCache()
+    fetched = []
+
+    def make_fetch(encoding):
+        async def fetch(headers):
+            fetched.append(encoding)
+            await asyncio.sleep(0.01)
+            return make_response(encoding.encode(), Cache_Control='max-age=60', Vary='Accept-Encoding')
+        return fetch
+
+    async def scenario():
+        encodings = ['gzip', 'identity', 'gzip', 'identity']
+        return await asyncio.gather(*(cache.get('GET', '/a', {'Accept-Encoding': encoding}, make_fetch(encoding))
+                                      for encoding in encodings))
+
+    results = asyncio.run(scenario())
+
+    assert [response.body for response, _ in results] == [b'gzip', b'identity', b'gzip', b'identity']
+    assert sorted(fetched) == ['gzip', 'identity']
+
+
+def test_stale_entry_is_served_while_revalidating():
+    cache = ResponseCache()
+    fetched = []
+
+    async def fetch(headers):
+        fetched.append(headers)
+        return make_response(b'', 304, Cache_Control='max-age=60, stale-while-revalidate=30', ETag='"v1"')
+
+    async def scenario():
+        cache.store('GET', '/a', {}, make_response(Cache_Control='max-age=0, stale-while-revalidate=30',
+                                                   ETag='"v1"'))
+        stale, status = await cache.get('GET', '/a', {}, fetch)
+        await asyncio.gather(*cache.revalidations)
+        fresh, fresh_status = await cache.get('GET', '/a', {}, fetch)
+        return status, stale.body, fresh_status, fresh.body
+
+    assert asyncio.run(scenario()) == ('STALE', b'ok', 'HIT', b'ok')
+    assert fetched == [{'If-None-Match': '"v1"'}]
+
+
+def test_distribute_load_serves_repeated_requests_from_the_cache(mocker):
+    load_balancer = LoadBalancer()
+    load_balancer.health_checker.set_vps_list(['http://vps1', 'http://vps2'])
+    load_balancer.response_cache.enabled = True
+    fetch = mocker.patch.object(load_balancer.request_handler, 'fetch',
+                                return_value=make_response(Cache_Control='max-age=60'))
+
+    async def scenario():
+        await load_balancer.distribute_load()
+        await load_balancer.distribute_load()
+
+    asyncio.run(scenario())
+
+    assert fetch.call_count == 1
+
+
+def test_proxy_caches_responses_and_answers_conditional_requests(start_backend, make_load_balancer, start_proxy):
+    backend_requests = []
+
+    async def handler(request):
+        backend_requests.append(request.headers.get('If-None-Match'))
+        return web.Response(text='cached', headers={'Cache-Control': 'max-age=60', 'ETag': '"v1"'})
+
+    async def scenario():
+        backend, backend_url = await start_backend(handler)
+        load_balancer = make_load_balancer([backend_url], cache={'enabled': True})
+        url = f'http://127.0.0.1:{await start_proxy(load_balancer)}/page'
+        results = []
+        try:
+            async with aiohttp.ClientSession() as session:
+                for headers in ({}, {}, {'If-None-Match': '"v1"'}):
+                    async with session.get(url, headers=headers) as response:
+                        results.append((response.status, response.headers.get('X-Cache'), await response.text()))
+        finally:
+            await load_balancer.close()
+            await backend.cleanup()
+        return results, load_balancer.health_checker.total_connections
+
+    results, total_connections = asyncio.run(scenario())
+
+    assert results == [(200, 'MISS', 'cached'), (200, 'HIT', 'cached'), (304, 'HIT', '')]
+    assert backend_requests == [None]
+    assert total_connections == 0
+
+
+def test_unstorable_revalidation_releases_the_upstream(start_backend, make_load_balancer, start_proxy):
+    responses = [{'Cache-Control': 'max-age=0, stale-while-revalidate=30', 'ETag': '"v1"'},
+                 {'Cache-Control': 'no-store'}]
+
+    async def handler(request):
+        return web.Response(text='page', headers=responses.pop(0))
+
+    async def scenario():
+        backend, backend_url = await start_backend(handler)
+        load_balancer = make_load_balancer([backend_url], cache={'enabled': True})
+        url = f'http://127.0.0.1:{await start_proxy(load_balancer)}/page'
+        statuses = []
+        try:
+            async with aiohttp.ClientSession() as session:
+                for _ in range(2):
+                    async with session.get(url) as response:
+                        statuses.append(response.headers.get('X-Cache'))
+            await asyncio.gather(*load_balancer.response_cache.revalidations)
+            return statuses, load_balancer.health_checker.total_connections
+        finally:
+            await load_balancer.close()
+            await backend.cleanup()
+
+    assert asyncio.run(scenario()) == (['MISS', 'STALE'], 0)
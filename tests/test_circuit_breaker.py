@@ -0,0 +1,88 @@
+import asyncio
+from load_balancer.circuit_breaker import OutlierDetector, CircuitBreaker
+from load_balancer.health_checker import HealthChecker
+
+
+def test_consecutive_errors_open_the_circuit():
+    detector = OutlierDetector(consecutive_errors=3)
+    for _ in range(2):
+        assert not detector.record('a', False, pool_size=4, now=0)
+
+    assert detector.record('a', False, pool_size=4, now=0)
+    assert detector.is_ejected('a')
+    assert detector.get_ejection_time('a') == 30
+
+
+def test_error_rate_window_opens_the_circuit():
+    detector = OutlierDetector(consecutive_errors=100, error_rate=0.5, window=10, min_requests=10)
+    for i in range(10):
+        detector.record('a', i % 2 == 0, pool_size=4, now=i * 0.1)
+
+    assert detector.get_state('a') == CircuitBreaker.OPEN
+
+
+def test_old_errors_leave_the_window():
+    detector = OutlierDetector(consecutive_errors=100, error_rate=0.5, window=10, min_requests=4)
+    for is_success in (False, False, False, True):
+        detector.record('a', is_success, pool_size=4, now=0)
+    for is_success in (True, True, True, False):
+        detector.record('a', is_success, pool_size=4, now=20)
+
+    assert detector.get_state('a') == CircuitBreaker.CLOSED
+
+
+def test_ejection_is_capped_by_pool_percentage():
+    detector = OutlierDetector(consecutive_errors=1, max_ejection_percent=50)
+    detector.record('a', False, pool_size=2, now=0)
+    detector.record('b', False, pool_size=2, now=0)
+
+    assert detector.is_ejected('a')
+    assert not detector.is_ejected('b')
+
+
+def test_failed_trial_does_not_exceed_the_ejection_cap():
+    detector = OutlierDetector(consecutive_errors=1, max_ejection_percent=50)
+    detector.record('a', False, pool_size=2, now=0)
+    detector.half_open('a')
+    detector.record('b', False, pool_size=2, now=1)
+    detector.on_request('a')
+    detector.record('a', False, pool_size=2, now=2)
+
+    assert detector.get_state('a') == CircuitBreaker.HALF_OPEN
+    assert not detector.is_ejected('a')
+    assert detector.is_ejected('b')
+    assert detector.ejected_count == 1
+
+
+def test_half_open_readmits_after_successful_trial():
+    detector = OutlierDetector(consecutive_errors=1, half_open_requests=1)
+    detector.record('a', False, pool_size=4, now=0)
+    detector.half_open('a')
+
+    assert not detector.is_ejected('a')
+    assert detector.on_request('a')
+    assert detector.is_ejected('a')
+
+    detector.record('a', True, pool_size=4, now=1)
+
+    assert detector.get_state('a') == CircuitBreaker.CLOSED
+
+
+def test_health_checker_ejects_and_readmits_vps():
+    health_checker = HealthChecker()
+    health_checker.outlier_detector = OutlierDetector(consecutive_errors=2, ejection_time=0.01)
+    health_checker.set_vps_list(['a', 'b', 'c'])
+
+    async def scenario():
+        health_checker.record_result('a', False)
+        health_checker.record_result('a', False)
+        ejected = not health_checker.check_health('a')
+        await asyncio.sleep(0.05)
+        return ejected
+
+    assert asyncio.run(scenario())
+    assert health_checker.check_health('a')
+    health_checker.increase_connection_count('a')
+    assert not health_checker.check_health('a')
+    health_checker.record_result('a', True)
+    assert health_checker.check_health('a')
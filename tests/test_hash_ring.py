@@ -0,0 +1,60 @@
+from load_balancer.hash_ring import ConsistentHashRing, stable_hash
+from load_balancer.health_checker import HealthChecker
+
+
+def test_stable_hash_is_deterministic():
+    assert stable_hash('10.0.0.1') == stable_hash('10.0.0.1')
+    assert stable_hash('10.0.0.1') != stable_hash('10.0.0.2')
+
+
+def test_adding_vps_only_remaps_its_share():
+    vps_list = [f'http://vps{i}.example.com' for i in range(10)]
+    ring = ConsistentHashRing(vps_list)
+    clients = [f'10.0.{i // 256}.{i % 256}' for i in range(5000)]
+    before = {client: ring.get(client) for client in clients}
+
+    ring.add('http://vps10.example.com')
+    after = {client: ring.get(client) for client in clients}
+
+    moved = [client for client in clients if before[client] != after[client]]
+    assert all(after[client] == 'http://vps10.example.com' for client in moved)
+    assert len(moved) < len(clients) * 0.2
+
+    ring.remove('http://vps10.example.com')
+    assert {client: ring.get(client) for client in clients} == before
+
+
+def test_ring_built_at_once_matches_one_built_vps_by_vps():
+    vps_list = [f'http://vps{i}.example.com' for i in range(50)]
+    ring = ConsistentHashRing(vps_list, replicas=20)
+    incremental = ConsistentHashRing(replicas=20)
+    for vps in vps_list:
+        incremental.add(vps)
+
+    assert ring.points == incremental.points == sorted(ring.owners)
+    assert ring.owners == incremental.owners
+
+    ring.add_all(vps_list[:5] + ['http://new.example.com'])
+    incremental.add('http://new.example.com')
+
+    assert ring.points == incremental.points
+    assert len(ring) == 51
+
+
+def test_bounded_loads_spill_to_next_vps():
+    ring = ConsistentHashRing(['a', 'b', 'c'], load_factor=1.0)
+    owner = ring.get('client')
+
+    spilled = ring.get('client', loads={owner: 5}, total_load=5)
+
+    assert spilled != owner
+
+
+def test_ip_hashing_skips_unhealthy_vps():
+    health_checker = HealthChecker()
+    health_checker.set_vps_list(['a', 'b', 'c'])
+    owner = health_checker.get_ip_hashing_vps('10.0.0.1')
+
+    health_checker.healthy_vps.discard(owner)
+
+    assert health_checker.get_ip_hashing_vps('10.0.0.1') != owner
@@ -0,0 +1,38 @@
+import asyncio
+from load_balancer.health_checker import HealthChecker
+
+
+def test_check_health_uses_rise_and_fall_thresholds(mocker):
+    mock_handle_failure = mocker.patch('load_balancer.health_checker.HealthChecker.handle_failure')
+    health_checker = HealthChecker(rise=2, fall=2)
+    vps = 'http://vps1.example.com'
+    health_checker.set_vps_list([vps])
+
+    async def scenario():
+        assert health_checker.check_health(vps)
+        health_checker.update_health(vps, False)
+        assert health_checker.check_health(vps)
+        health_checker.update_health(vps, False)
+        assert not health_checker.check_health(vps)
+        health_checker.update_health(vps, True)
+        assert not health_checker.check_health(vps)
+        health_checker.update_health(vps, True)
+        assert health_checker.check_health(vps)
+        await asyncio.sleep(0)
+
+    asyncio.run(scenario())
+    mock_handle_failure.assert_called_once_with(vps)
+
+
+def test_tcp_probe_detects_closed_port():
+    async def scenario():
+        server = await asyncio.start_server(lambda reader, writer: writer.close(), '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        health_checker = HealthChecker(check_type='tcp', timeout=1)
+        is_up = await health_checker.probe(f'http://127.0.0.1:{port}')
+        server.close()
+        await server.wait_closed()
+        is_down = not await health_checker.probe(f'http://127.0.0.1:{port}')
+        return is_up, is_down
+
+    assert asyncio.run(scenario()) == (True, True)
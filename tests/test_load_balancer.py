@@ -1,3 +1,4 @@
+import asyncio
 import pytest
 from unittest.mock import patch
 from load_balancer.balancer import LoadBalancer
@@ -57,4 +58,53 @@ def test_get_next_vps_round_robin(vps_list, mocker):
     assert load_balancer.get_next_vps() == 'http://vps1.example.com'
     assert load_balancer.get_next_vps() == 'http://vps2.example.com'
     assert load_balancer.get_next_vps() == 'http://vps3.example.com'
-    assert load_balancer.get_next_vps() == 'http://vps1.example.com'
\ No newline at end of file
+    assert load_balancer.get_next_vps() == 'http://vps1.example.com'
+
+def test_send_request_reuses_pooled_connections():
+    from aiohttp import web
+    from load_balancer.balancer import RequestHandler
+    from load_balancer.connection_pool import ConnectionPool
+
+    async def scenario():
+        peers = set()
+
+        async def handler(request):
+            peers.add(request.transport.get_extra_info('peername'))
+            return web.Response(text='ok')
+
+        app = web.Application()
+        app.router.add_get('/', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        pool = ConnectionPool(max_connections=10)
+        request_handler = RequestHandler(pool)
+        try:
+            for _ in range(5):
+                assert await request_handler.send_request(f'http://127.0.0.1:{port}/') == 'ok'
+        finally:
+            await pool.close()
+            await runner.cleanup()
+        return peers
+
+    assert len(asyncio.run(scenario())) == 1
+
+
+def test_distribute_load_tracks_active_connections(vps_list, mocker):
+    load_balancer = LoadBalancer(balancing_algorithm='least_connections')
+    load_balancer.health_checker.set_vps_list(vps_list)
+    active_connections = []
+
+    async def send_request(vps):
+        active_connections.append(load_balancer.health_checker.get_active_connections(vps))
+        return 'ok'
+
+    mocker.patch.object(load_balancer.request_handler, 'send_request', side_effect=send_request)
+
+    asyncio.run(load_balancer.distribute_load())
+
+    assert active_connections == [1]
+    assert load_balancer.health_checker.total_connections == 0
@@ -0,0 +1,22 @@
+import logging
+from load_balancer.logger import Logger
+
+
+def test_logger_writes_through_background_queue(tmp_path):
+    logger = Logger(log_file=str(tmp_path / 'log.txt'), error_file=str(tmp_path / 'error.log'),
+                    success_sample_rate=0.0, console=False)
+    logger.start()
+    try:
+        logger.log_request_success('http://vps1.example.com')
+        logger.log_access('10.0.0.1', 'GET', '/', 'http://vps1.example.com', 200, 0.01, 10)
+        logger.log_access('10.0.0.1', 'GET', '/', 'http://vps2.example.com', 503, 0.01, 0)
+        logger.log_request_error('http://vps2.example.com', 'timeout')
+    finally:
+        logger.stop()
+
+    log = (tmp_path / 'log.txt').read_text()
+    errors = (tmp_path / 'error.log').read_text()
+    assert 'vps1' not in log
+    assert 'access client=10.0.0.1 method=GET path=/ vps=http://vps2.example.com status=503' in log
+    assert 'An error occurred on the VPS: http://vps2.example.com, error: timeout' in errors
+    assert logging.getLogger('load_balancer').handlers == []
@@ -0,0 +1,78 @@
+import socket
+import urllib.request
+from load_balancer.metrics import Metrics
+
+
+def test_record_request_is_flushed_per_vps():
+    metrics = Metrics()
+    metrics.record_request('http://vps1.example.com', 0.02, 200, bytes_in=100, bytes_out=10)
+    metrics.record_request('http://vps1.example.com', 0.3, 502)
+    metrics.record_request('http://vps2.example.com', 0.04, 200, bytes_in=50)
+
+    assert metrics.registry.get_sample_value('load_balancer_requests_total') == 0
+
+    metrics.flush()
+
+    sample = metrics.registry.get_sample_value
+    assert sample('load_balancer_requests_total') == 3
+    assert sample('vps_requests_total', {'vps': 'http://vps1.example.com', 'status': '200'}) == 1
+    assert sample('vps_requests_total', {'vps': 'http://vps1.example.com', 'status': '502'}) == 1
+    assert sample('vps_received_bytes_total', {'vps': 'http://vps1.example.com'}) == 100
+    assert sample('vps_sent_bytes_total', {'vps': 'http://vps1.example.com'}) == 10
+    assert sample('vps_response_time_seconds_count', {'vps': 'http://vps2.example.com'}) == 1
+    assert sample('vps_response_time_seconds_bucket', {'vps': 'http://vps1.example.com', 'le': '0.025'}) == 1
+    assert sample('load_balancer_response_time_seconds_count') == 3
+
+
+def test_flush_accumulates_totals_and_analyzes_window(mocker):
+    metrics = Metrics()
+    send_notification = mocker.patch.object(metrics, 'send_notification')
+    metrics.record_request('http://vps1.example.com', 2.0, 200)
+    metrics.flush()
+    metrics.record_request('http://vps1.example.com', 2.0, 200)
+    metrics.flush()
+    metrics.analyze_metrics()
+
+    assert metrics.registry.get_sample_value('vps_requests_total',
+                                             {'vps': 'http://vps1.example.com', 'status': '200'}) == 2
+    send_notification.assert_any_call("Average response time exceeded!")
+
+
+def test_exporter_binds_once_on_configured_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    metrics = Metrics()
+    metrics.configure({'address': '127.0.0.1', 'port': port})
+    metrics.setup()
+    metrics.setup()
+    # Bound already, a later reload does not move it
+    metrics.configure({'port': port + 1})
+
+    assert metrics.exporter_started
+    assert metrics.port == port
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+        assert b'load_balancer_requests_total' in response.read()
+
+
+def test_parent_exports_the_totals_of_all_workers(tmp_path):
+    workers = [Metrics() for _ in range(2)]
+    for worker_index, metrics in enumerate(workers):
+        metrics.export_to(str(tmp_path / f'worker-{worker_index}.pickle'))
+        metrics.setup()
+        assert not metrics.exporter_started
+    workers[0].record_request('http://vps1.example.com', 0.02, 200, bytes_in=100)
+    workers[1].record_request('http://vps1.example.com', 0.3, 200, bytes_in=50)
+    workers[1].record_request('http://vps2.example.com', 0.04, 502)
+    for metrics in workers:
+        metrics.flush()
+    parent = Metrics()
+    parent.enabled = False
+    parent.setup_workers(str(tmp_path))
+
+    sample = parent.registry.get_sample_value
+    assert sample('load_balancer_requests_total') == 3
+    assert sample('vps_requests_total', {'vps': 'http://vps1.example.com', 'status': '200'}) == 2
+    assert sample('vps_requests_total', {'vps': 'http://vps2.example.com', 'status': '502'}) == 1
+    assert sample('vps_received_bytes_total', {'vps': 'http://vps1.example.com'}) == 150
+    assert sample('load_balancer_response_time_seconds_count') == 3
@@ -0,0 +1,55 @@
+import asyncio
+import aiohttp
+from aiohttp import web
+from load_balancer.balancer import LoadBalancer
+
+
+def test_proxy_streams_request_and_response_bodies(start_backend, make_load_balancer, start_proxy):
+    async def echo(request):
+        body = await request.read()
+        return web.Response(body=body, headers={'X-Seen-For': request.headers['X-Forwarded-For'],
+                                                'X-Seen-Path': request.path_qs})
+
+    async def scenario():
+        backend, backend_url = await start_backend(echo)
+        load_balancer = make_load_balancer([backend_url])
+        port = await start_proxy(load_balancer)
+        try:
+            async with aiohttp.ClientSession() as session:
+                payload = b'x' * (1 << 20)
+                async with session.post(f'http://127.0.0.1:{port}/echo?a=1', data=payload,
+                                        headers={'X-Forwarded-For': '203.0.113.7'}) as response:
+                    return (response.status, await response.read() == payload,
+                            response.headers['X-Seen-For'], response.headers['X-Seen-Path'])
+        finally:
+            await load_balancer.close()
+            await backend.cleanup()
+
+    status, same_body, seen_for, seen_path = asyncio.run(scenario())
+
+    assert status == 200
+    assert same_body
+    assert seen_for == '203.0.113.7, 127.0.0.1'
+    assert seen_path == '/echo?a=1'
+
+
+def test_proxy_returns_503_without_backends(start_proxy):
+    async def scenario():
+        load_balancer = LoadBalancer()
+        port = await start_proxy(load_balancer)
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f'http://127.0.0.1:{port}/') as response:
+                    return response.status
+        finally:
+            await load_balancer.close()
+
+    assert asyncio.run(scenario()) == 503
+
+
+def test_get_client_ip_prefers_forwarded_for(mocker):
+    load_balancer = LoadBalancer()
+    request = mocker.Mock(headers={'X-Forwarded-For': '203.0.113.7, 10.0.0.1'}, remote='10.0.0.2')
+
+    assert load_balancer.request_handler.get_client_ip(request) == '203.0.113.7'
+    assert load_balancer.request_handler.get_client_ip(mocker.Mock(headers={}, remote='10.0.0.2')) == '10.0.0.2'
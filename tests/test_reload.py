@@ -0,0 +1,77 @@
+import asyncio
+import shutil
+import pytest
+import yaml
+from load_balancer.configuration import Configuration
+
+
+@pytest.fixture
+def load_balancer(tmp_path, mocker, make_load_balancer):
+    # Loaded from a copy of tests/config.yaml and a VPS list file, the way reload() reads them again
+    mocker.patch('load_balancer.balancer.Metrics.setup')
+    shutil.copy('tests/config.yaml', tmp_path / 'config.yaml')
+    (tmp_path / 'vps_list.txt').write_text('http://vps1.example.com\nhttp://vps2.example.com\n')
+    load_balancer = make_load_balancer()
+    load_balancer.configuration = Configuration(str(tmp_path / 'config.yaml'))
+    load_balancer.load_vps_list(str(tmp_path / 'vps_list.txt'))
+    return load_balancer
+
+
+def test_reload_swaps_vps_list_and_keeps_state_of_unchanged_vps(tmp_path, load_balancer):
+    health_checker = load_balancer.health_checker
+    health_checker.healthy_vps.discard('http://vps2.example.com')
+    health_checker.record_response_time('http://vps2.example.com', 0.5)
+    routing = health_checker.routing
+    (tmp_path / 'vps_list.txt').write_text('http://vps2.example.com\nhttp://vps3.example.com\n\n')
+
+    asyncio.run(load_balancer.reload())
+
+    assert health_checker.routing is not routing
+    assert health_checker.vps_list == ('http://vps2.example.com', 'http://vps3.example.com')
+    assert not health_checker.check_health('http://vps2.example.com')
+    assert health_checker.check_health('http://vps3.example.com')
+    # Kept, only decayed by the few milliseconds the reload took
+    assert health_checker.get_response_time('http://vps2.example.com') == pytest.approx(500, rel=0.01)
+    assert 'http://vps1.example.com' not in health_checker.hash_ring.nodes
+    assert load_balancer.vps_manager.vps_list == ['http://vps2.example.com', 'http://vps3.example.com']
+
+
+def test_watcher_reloads_on_file_change(tmp_path, load_balancer):
+    load_balancer.watcher.interval = 0.01
+
+    async def scenario():
+        load_balancer.watcher.start()
+        try:
+            await asyncio.sleep(0.05)
+            (tmp_path / 'vps_list.txt').write_text('http://vps4.example.com\n')
+            for _ in range(100):
+                if load_balancer.health_checker.vps_list == ('http://vps4.example.com',):
+                    break
+                await asyncio.sleep(0.01)
+        finally:
+            await load_balancer.watcher.stop()
+
+    asyncio.run(scenario())
+
+    assert load_balancer.health_checker.vps_list == ('http://vps4.example.com',)
+
+
+@pytest.mark.parametrize('section, option, value', [('slow_start', 'min_weight', 0),
+                                                    ('upstream', 'protocol', 'spdy')])
+def test_failed_reload_keeps_the_running_configuration(tmp_path, load_balancer, section, option, value):
+    configuration = load_balancer.configuration
+    timeout = load_balancer.connection_pool.timeout
+    config = yaml.safe_load((tmp_path / 'config.yaml').read_text())
+    config['load_balancer']['timeout'] = 99
+    config['load_balancer'][section][option] = value
+    (tmp_path / 'config.yaml').write_text(yaml.safe_dump(config))
+    (tmp_path / 'vps_list.txt').write_text('http://vps3.example.com\n')
+
+    with pytest.raises(ValueError):
+        asyncio.run(load_balancer.reload())
+
+    assert load_balancer.configuration is configuration
+    assert load_balancer.connection_pool.timeout == timeout
+    assert load_balancer.health_checker.slow_start.min_weight == 0.1
+    assert load_balancer.request_handler.transport.protocol == 'http1'
+    assert load_balancer.health_checker.vps_list == ('http://vps1.example.com', 'http://vps2.example.com')
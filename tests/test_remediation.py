@@ -0,0 +1,101 @@
+import asyncio
+import sys
+from load_balancer.health_checker import HealthChecker
+
+vps = 'http://vps1.example.com'
+
+
+def make_health_checker(script, **options):
+    health_checker = HealthChecker(rise=2, fall=1)
+    health_checker.set_vps_list([vps])
+    failure_handler = health_checker.failure_handler
+    failure_handler.configure(dict(command=[sys.executable, '-c', script], **options))
+    return health_checker, failure_handler
+
+
+def test_failure_script_runs_once_per_vps_and_cools_down(tmp_path):
+    log = tmp_path / 'calls'
+    script = f"import sys; open({str(log)!r}, 'a').write(sys.argv[1] + '\\n')"
+    health_checker, failure_handler = make_health_checker(script, cooldown=60)
+
+    async def scenario():
+        health_checker.update_health(vps, False)
+        # Already queued, a flapping VPS does not start a second script
+        assert not failure_handler.submit(vps)
+        await asyncio.gather(*failure_handler.jobs.values())
+        assert not failure_handler.submit(vps)
+        await failure_handler.stop()
+
+    asyncio.run(scenario())
+    assert log.read_text() == vps + '\n'
+    assert failure_handler.results[vps] is True
+
+
+def test_failure_script_is_killed_after_timeout():
+    health_checker, failure_handler = make_health_checker('import time; time.sleep(30)', timeout=0.2)
+
+    async def scenario():
+        health_checker.update_health(vps, False)
+        return await asyncio.wait_for(failure_handler.jobs[vps], 5)
+
+    assert asyncio.run(scenario()) is False
+    assert vps in health_checker.down_vps
+
+
+def test_failure_scripts_respect_concurrency_limit():
+    vps_list = [f'http://vps{i}.example.com' for i in range(4)]
+    health_checker = HealthChecker(fall=1)
+    health_checker.set_vps_list(vps_list)
+    failure_handler = health_checker.failure_handler
+    failure_handler.configure({'command': [sys.executable, '-c', 'import time; time.sleep(0.1)'],
+                               'max_concurrent': 2})
+    execute = failure_handler.execute
+    running = [0, 0]
+
+    async def tracked(vps):
+        running[0] += 1
+        running[1] = max(running)
+        try:
+            return await execute(vps)
+        finally:
+            running[0] -= 1
+
+    failure_handler.execute = tracked
+
+    async def scenario():
+        for vps in vps_list:
+            health_checker.update_health(vps, False)
+        await asyncio.gather(*failure_handler.jobs.values())
+
+    asyncio.run(scenario())
+    assert running[1] == 2
+    assert all(failure_handler.results[vps] for vps in vps_list)
+
+
+def test_successful_failure_script_readmits_vps_after_one_probe(mocker):
+    health_checker, failure_handler = make_health_checker('pass')
+    probe = mocker.patch.object(health_checker, 'probe', return_value=True)
+
+    async def scenario():
+        health_checker.update_health(vps, False)
+        assert not health_checker.check_health(vps)
+        await asyncio.gather(*failure_handler.jobs.values())
+
+    asyncio.run(scenario())
+    probe.assert_called_once_with(vps)
+    assert health_checker.check_health(vps)
+
+
+def test_missing_failure_script_leaves_vps_down(mocker):
+    health_checker, failure_handler = make_health_checker('')
+    failure_handler.command = ['/nonexistent/handle_vps_failure.sh']
+    probe = mocker.patch.object(health_checker, 'probe')
+
+    async def scenario():
+        health_checker.update_health(vps, False)
+        await asyncio.gather(*failure_handler.jobs.values())
+
+    asyncio.run(scenario())
+    probe.assert_not_called()
+    assert failure_handler.results[vps] is False
+    assert not health_checker.check_health(vps)
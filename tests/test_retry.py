@@ -0,0 +1,161 @@
+import asyncio
+import aiohttp
+import pytest
+import requests
+from aiohttp import web
+from load_balancer.balancer import LoadBalancer
+from load_balancer.latency import LatencyQuantile
+from load_balancer.retry import RetryPolicy, ClientStatusError
+
+
+def test_latency_quantile():
+    quantile = LatencyQuantile(0.95, size=100, min_samples=10)
+    assert quantile.get() is None
+    for i in range(100):
+        quantile.observe(i / 1000)
+
+    assert quantile.get() == 0.095
+
+
+def test_failed_request_is_retried_on_another_vps(mocker):
+    load_balancer = LoadBalancer(balancing_algorithm='least_connections')
+    load_balancer.health_checker.set_vps_list(['http://vps1', 'http://vps2'])
+    load_balancer.health_checker.record_response_time('http://vps2', 1.0)
+    sent_to = []
+
+    async def send_request(vps):
+        sent_to.append(vps)
+        if vps == 'http://vps1':
+            raise requests.exceptions.RequestException("connection refused")
+        return 'ok'
+
+    mocker.patch.object(load_balancer.request_handler, 'send_request', side_effect=send_request)
+
+    asyncio.run(load_balancer.distribute_load())
+
+    assert sent_to == ['http://vps1', 'http://vps2']
+    assert load_balancer.health_checker.total_connections == 0
+
+
+def test_client_error_is_final(mocker):
+    load_balancer = LoadBalancer(balancing_algorithm='least_connections')
+    load_balancer.health_checker.set_vps_list(['http://vps1', 'http://vps2'])
+    load_balancer.health_checker.record_response_time('http://vps2', 1.0)
+    record_result = mocker.spy(load_balancer.health_checker, 'record_result')
+    sent_to = []
+
+    async def send_request(vps):
+        sent_to.append(vps)
+        raise ClientStatusError("not found", 404)
+
+    mocker.patch.object(load_balancer.request_handler, 'send_request', side_effect=send_request)
+
+    asyncio.run(load_balancer.distribute_load())
+
+    assert sent_to == ['http://vps1']
+    record_result.assert_called_once_with('http://vps1', True)
+    timeout = load_balancer.connection_pool.timeout
+    assert load_balancer.health_checker.get_response_time('http://vps1') < timeout * 1000
+
+
+def test_non_retryable_request_is_sent_once():
+    policy = RetryPolicy(retries=3)
+    attempts = []
+
+    async def attempt(vps):
+        attempts.append(vps)
+        raise requests.exceptions.RequestException("connection refused")
+
+    with pytest.raises(requests.exceptions.RequestException):
+        asyncio.run(policy.execute(lambda tried: f'vps{len(tried)}', attempt, retryable=False))
+
+    assert attempts == ['vps0']
+    assert not policy.is_retryable('POST')
+
+
+def test_retryable_status_falls_back_to_the_last_response():
+    policy = RetryPolicy(retries=1)
+    released = []
+
+    async def attempt(vps):
+        return vps, 503
+
+    result = asyncio.run(policy.execute(lambda tried: f'vps{len(tried)}', attempt,
+                                        should_retry=lambda result: result[1] == 503, release=released.append))
+
+    assert result == ('vps0', 503)
+    assert released == [('vps1', 503)]
+
+
+def test_client_error_releases_the_responses_kept_so_far():
+    policy = RetryPolicy(retries=1)
+    released = []
+
+    async def attempt(vps):
+        if vps == 'vps1':
+            raise ClientStatusError("not found", 404)
+        return vps, 503
+
+    with pytest.raises(ClientStatusError):
+        asyncio.run(policy.execute(lambda tried: f'vps{len(tried)}', attempt,
+                                   should_retry=lambda result: result[1] == 503, release=released.append))
+
+    assert released == [('vps0', 503)]
+
+
+def test_hedged_request_takes_the_first_answer():
+    policy = RetryPolicy(hedge=True)
+    for _ in range(50):
+        policy.observe(0.01)
+    cancelled = []
+
+    async def attempt(vps):
+        try:
+            await asyncio.sleep(1.0 if vps == 'slow' else 0.01)
+        except asyncio.CancelledError:
+            cancelled.append(vps)
+            raise
+        return vps
+
+    async def scenario():
+        result = await policy.execute(lambda tried: 'fast' if tried else 'slow', attempt)
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(scenario()) == 'fast'
+    assert cancelled == ['slow']
+
+
+def test_deadline_cancels_outstanding_attempts():
+    policy = RetryPolicy(deadline=0.05)
+
+    async def attempt(vps):
+        await asyncio.sleep(1.0)
+
+    with pytest.raises(requests.exceptions.Timeout):
+        asyncio.run(policy.execute(lambda tried: 'vps', attempt))
+
+
+def test_proxy_retries_5xx_on_another_vps(start_backend, make_load_balancer, start_proxy):
+    async def unavailable(request):
+        return web.Response(status=503)
+
+    async def ok(request):
+        return web.Response(text='ok')
+
+    async def scenario():
+        bad_backend, bad_url = await start_backend(unavailable)
+        good_backend, good_url = await start_backend(ok)
+        load_balancer = make_load_balancer([bad_url, good_url], 'least_connections')
+        load_balancer.health_checker.record_response_time(good_url, 1.0)
+        port = await start_proxy(load_balancer)
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f'http://127.0.0.1:{port}/') as response:
+                    return response.status, await response.text(), load_balancer.health_checker.total_connections
+        finally:
+            await load_balancer.close()
+            await bad_backend.cleanup()
+            await good_backend.cleanup()
+
+    assert asyncio.run(scenario()) == (200, 'ok', 0)
@@ -0,0 +1,169 @@
+import random
+import pytest
+from collections import Counter
+from load_balancer.selection import WeightedRoundRobin, AliasTable, LazyMinHeap
+from load_balancer.health_checker import HealthChecker
+from load_balancer.latency import PeakEWMA
+
+
+def test_weighted_round_robin_interleaves_picks():
+    weighted_round_robin = WeightedRoundRobin({'a': 5, 'b': 1, 'c': 1})
+
+    picks = [weighted_round_robin.next() for _ in range(70)]
+
+    assert picks[:7] == ['a', 'a', 'b', 'c', 'a', 'a', 'a']
+    assert Counter(picks) == {'a': 50, 'b': 10, 'c': 10}
+    assert [weighted_round_robin.next() for _ in range(6)] != ['a'] * 6
+
+
+def test_weighted_round_robin_updates_a_single_weight_in_place():
+    weighted_round_robin = WeightedRoundRobin({'a': 100, 'b': 100})
+    assert [weighted_round_robin.next() for _ in range(4)] == ['a', 'b', 'a', 'b']
+
+    weighted_round_robin.set_weight('b', 300)
+    assert Counter(weighted_round_robin.next() for _ in range(400)) == {'a': 100, 'b': 300}
+
+    weighted_round_robin.remove('a')
+    weighted_round_robin.set_weight('c', 100)
+    assert Counter(weighted_round_robin.next() for _ in range(400)) == {'b': 300, 'c': 100}
+    assert len(weighted_round_robin.heap) <= 2 * len(weighted_round_robin) + 64
+
+
+def test_alias_table_follows_weights():
+    random.seed(42)
+    alias_table = AliasTable({'a': 1, 'b': 3, 'c': 6})
+
+    counts = Counter(alias_table.next() for _ in range(20000))
+
+    assert abs(counts['a'] / 20000 - 0.1) < 0.02
+    assert abs(counts['b'] / 20000 - 0.3) < 0.02
+    assert abs(counts['c'] / 20000 - 0.6) < 0.02
+
+
+def test_weighted_tables_are_rebuilt_on_membership_change(mocker):
+    health_checker = HealthChecker()
+    mocker.patch.object(health_checker, 'get_weight', return_value=1)
+    health_checker.set_vps_list(['a', 'b'])
+
+    assert {health_checker.get_next_weighted_vps() for _ in range(4)} == {'a', 'b'}
+    assert health_checker.get_weight.call_count == 2
+
+    health_checker.remove_vps('a')
+
+    assert {health_checker.get_random_weighted_vps() for _ in range(10)} == {'b'}
+    assert health_checker.get_weight.call_count == 3
+
+
+def test_lazy_min_heap_tracks_latest_scores():
+    heap = LazyMinHeap()
+    heap.update('a', 1)
+    heap.update('b', 2)
+    heap.update('a', 3)
+
+    assert heap.peek() == 'b'
+
+    heap.remove('b')
+
+    assert heap.peek() == 'a'
+    assert len(heap) == 1
+
+
+def test_least_connections_follows_connection_counts():
+    health_checker = HealthChecker()
+    health_checker.set_vps_list(['a', 'b', 'c'])
+    health_checker.increase_connection_count('a')
+    health_checker.increase_connection_count('c')
+
+    assert health_checker.get_least_connections_vps() == 'b'
+
+    health_checker.increase_connection_count('b')
+    health_checker.increase_connection_count('b')
+    health_checker.decrease_connection_count('a')
+
+    assert health_checker.get_least_connections_vps() == 'a'
+
+
+def test_p2c_prefers_less_loaded_vps():
+    health_checker = HealthChecker()
+    health_checker.set_vps_list(['a', 'b'])
+    for _ in range(3):
+        health_checker.increase_connection_count('a')
+
+    assert {health_checker.get_p2c_vps() for _ in range(10)} == {'b'}
+
+
+def test_round_robin_picks_from_the_cached_healthy_backends(mocker):
+    health_checker = HealthChecker()
+    health_checker.set_vps_list(['a', 'b', 'c'])
+    health_checker.get_next_available_vps()
+    check_health = mocker.spy(health_checker, 'check_health')
+
+    assert {health_checker.get_next_available_vps() for _ in range(50)} == {'a', 'b', 'c'}
+    assert check_health.call_count == 0
+
+    health_checker.down_vps.add('b')
+    health_checker.refresh_availability('b')
+
+    assert {health_checker.get_next_available_vps() for _ in range(50)} == {'a', 'c'}
+
+
+def test_peak_ewma_takes_spikes_and_decays_slowly():
+    ewma = PeakEWMA(decay=10.0, initial=0.1)
+    ewma.observe(1.0, now=ewma.timestamp)
+
+    assert ewma.value == 1.0
+
+    ewma.observe(0.1, now=ewma.timestamp + 10.0)
+
+    assert 0.1 < ewma.value < 1.0
+
+
+def test_peak_ewma_falls_back_to_the_initial_estimate_without_samples():
+    ewma = PeakEWMA(decay=10.0, initial=0.1)
+    ewma.observe(2.0, now=ewma.timestamp)
+
+    assert ewma.get(now=ewma.timestamp) == 2.0
+    assert 0.1 < ewma.get(now=ewma.timestamp + 10.0) < 1.0
+    assert ewma.get(now=ewma.timestamp + 100.0) == pytest.approx(0.1, abs=1e-3)
+
+
+def test_least_response_time_retries_a_vps_after_its_slow_response_decays(mocker):
+    clock = mocker.patch('load_balancer.latency.time.monotonic', return_value=1000.0)
+    health_checker = HealthChecker(response_time_decay=10.0)
+    health_checker.set_vps_list(['a', 'b'])
+    health_checker.record_response_time('a', 2.0)
+    health_checker.record_response_time('b', 0.2)
+
+    assert health_checker.get_least_response_time_vps() == 'b'
+
+    # b keeps getting traffic at 0.2s, a gets none
+    clock.return_value += 60
+    health_checker.record_response_time('b', 0.2)
+    health_checker.refresh_response_times()
+
+    assert health_checker.get_least_response_time_vps() == 'a'
+
+
+def test_recovered_vps_forgets_its_response_times(mocker):
+    mocker.patch('load_balancer.health_checker.HealthChecker.handle_failure')
+    health_checker = HealthChecker(rise=1, fall=1)
+    health_checker.set_vps_list(['a', 'b'])
+    health_checker.record_response_time('a', 2.0)
+    health_checker.update_health('a', False)
+    health_checker.update_health('a', True)
+
+    assert health_checker.get_response_time('a') == health_checker.default_response_time * 1000
+
+
+def test_least_response_time_uses_measured_latency():
+    health_checker = HealthChecker()
+    health_checker.set_vps_list(['a', 'b'])
+    health_checker.record_response_time('a', 0.5)
+    health_checker.record_response_time('b', 0.2)
+
+    assert health_checker.get_least_response_time_vps() == 'b'
+
+    for _ in range(3):
+        health_checker.increase_connection_count('b')
+
+    assert health_checker.get_least_response_time_vps() == 'a'
@@ -0,0 +1,111 @@
+import asyncio
+import aiohttp
+import pytest
+from aiohttp import web
+from load_balancer.sessions import SessionTable
+
+
+def test_session_table_evicts_least_recently_used():
+    table = SessionTable(max_entries=2, ttl=10)
+    table.set('a', 'http://vps1', now=0)
+    table.set('b', 'http://vps2', now=0)
+    assert table.get('a', now=1) == 'http://vps1'
+
+    table.set('c', 'http://vps1', now=1)
+
+    assert table.get('b', now=1) is None
+    assert len(table) == 2
+
+
+def test_session_table_expires_idle_sessions():
+    table = SessionTable(ttl=10)
+    table.set('a', 'http://vps1', now=0)
+    table.set('b', 'http://vps2', now=5)
+
+    assert table.get('a', now=9) == 'http://vps1'
+    assert table.get('b', now=16) is None
+    assert table.get('a', now=18) == 'http://vps1'
+
+
+@pytest.fixture
+def make_sticky_load_balancer(make_load_balancer):
+    def make_sticky_load_balancer(mode):
+        return make_load_balancer(['http://vps1', 'http://vps2', 'http://vps3'], 'least_connections',
+                                  sticky_sessions={'enabled': True, 'mode': mode})
+
+    return make_sticky_load_balancer
+
+
+def test_header_session_sticks_to_its_vps(make_sticky_load_balancer):
+    load_balancer = make_sticky_load_balancer('header')
+    vps = load_balancer.get_session_vps('user-1', None, [])
+    load_balancer.health_checker.increase_connection_count(vps)
+
+    assert load_balancer.get_session_vps('user-1', None, []) == vps
+    assert load_balancer.get_session_vps('user-2', None, []) != vps
+
+
+def test_session_moves_when_its_vps_is_unhealthy(make_sticky_load_balancer):
+    load_balancer = make_sticky_load_balancer('header')
+    vps = load_balancer.get_session_vps('user-1', None, [])
+    load_balancer.health_checker.down_vps.add(vps)
+    load_balancer.health_checker.refresh_availability(vps)
+
+    new_vps = load_balancer.get_session_vps('user-1', None, [])
+
+    assert new_vps != vps
+    assert load_balancer.sticky_sessions.lookup('user-1', load_balancer.health_checker.routing) == new_vps
+
+
+def test_cookie_names_the_vps(make_sticky_load_balancer):
+    load_balancer = make_sticky_load_balancer('cookie')
+    sticky_sessions = load_balancer.sticky_sessions
+    token = sticky_sessions.get_token('http://vps3')
+
+    assert load_balancer.get_session_vps(token, None, []) == 'http://vps3'
+    assert sticky_sessions.bind(token, 'http://vps3') is None
+    assert sticky_sessions.bind(token, 'http://vps1').startswith(f"lb_vps={sticky_sessions.get_token('http://vps1')};")
+    assert 'vps3' not in token
+
+
+@pytest.mark.parametrize('cache_enabled', [False, True])
+def test_proxy_sets_the_cookie_and_honours_it(cache_enabled, start_backend, make_load_balancer, start_proxy):
+    def make_handler(name):
+        async def handler(request):
+            if request.path == '/cached':
+                return web.Response(text=name, headers={'Cache-Control': 'max-age=60'})
+            return web.Response(text=name)
+        return handler
+
+    async def scenario():
+        backends, urls = zip(*[await start_backend(make_handler(name)) for name in ('one', 'two')])
+        load_balancer = make_load_balancer(urls, sticky_sessions={'enabled': True},
+                                           cache={'enabled': cache_enabled})
+        url = f'http://127.0.0.1:{await start_proxy(load_balancer)}/'
+        try:
+            async with aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True)) as session:
+                answers = []
+                # With the cache on, the session starts on a stored response, then continues on streamed ones
+                for path in ['cached'] + [''] * 9:
+                    async with session.get(url + path) as response:
+                        answers.append(await response.text())
+                return answers, len(session.cookie_jar), load_balancer.health_checker.total_connections
+        finally:
+            await load_balancer.close()
+            for runner in backends:
+                await runner.cleanup()
+
+    answers, cookies, total_connections = asyncio.run(scenario())
+
+    assert len(set(answers)) == 1
+    assert cookies == 1
+    assert total_connections == 0
+
+
+def test_session_table_keeps_fixed_size_keys(make_sticky_load_balancer):
+    load_balancer = make_sticky_load_balancer('header')
+    session_id = 'x' * 8000
+    vps = load_balancer.get_session_vps(session_id, None, [])
+
+    assert load_balancer.sticky_sessions.lookup(session_id, load_balancer.health_checker.routing) == vps
+    assert all(isinstance(key, int) for key in load_balancer.sticky_sessions.table.entries)
@@ -0,0 +1,141 @@
+import collections
+import pytest
+from load_balancer.balancer import LoadBalancer
+from load_balancer.slow_start import SlowStart
+
+VPS_LIST = ['http://vps1.example.com', 'http://vps2.example.com']
+NEW_VPS = 'http://vps3.example.com'
+SLOW_START = {'window': 10, 'min_weight': 0.1, 'interval': 1}
+
+
+@pytest.fixture
+def clock(mocker):
+    clock = mocker.patch('load_balancer.slow_start.time.monotonic')
+    clock.return_value = 1000.0
+    return clock
+
+
+def test_ramp_curves():
+    linear = SlowStart(window=10, min_weight=0.1)
+    exponential = SlowStart(window=10, min_weight=0.1, curve='exponential')
+
+    assert [round(linear.get_ramp_factor(t), 3) for t in (0, 5, 10, 20)] == [0.1, 0.55, 1.0, 1.0]
+    assert [round(exponential.get_ramp_factor(t), 3) for t in (0, 5, 10)] == [0.1, 0.316, 1.0]
+
+
+def test_factors_are_refreshed_once_per_interval_until_the_window_is_over():
+    slow_start = SlowStart(window=10, min_weight=0.1, interval=1)
+    slow_start.begin(NEW_VPS, now=0)
+
+    assert slow_start.update(now=0.5) == []
+    assert slow_start.update(now=5) == [NEW_VPS]
+    assert slow_start.get_factor(NEW_VPS) == pytest.approx(0.55)
+    assert slow_start.update(now=10) == [NEW_VPS]
+    assert NEW_VPS not in slow_start and slow_start.get_factor(NEW_VPS) == 1.0
+
+
+def test_initial_backends_and_disabled_slow_start_get_full_weight(make_load_balancer):
+    load_balancer = make_load_balancer(VPS_LIST, 'least_connections', slow_start=SLOW_START)
+    assert not load_balancer.health_checker.slow_start
+
+    disabled = LoadBalancer('least_connections')
+    disabled.health_checker.set_vps_list(VPS_LIST)
+    disabled.add_vps(NEW_VPS)
+    assert not disabled.health_checker.slow_start
+
+
+def test_least_connections_ramps_up_a_new_backend(clock, make_load_balancer):
+    load_balancer = make_load_balancer(VPS_LIST, 'least_connections', slow_start=SLOW_START)
+    health_checker = load_balancer.health_checker
+    load_balancer.add_vps(NEW_VPS)
+
+    def pick(count):
+        picks = collections.Counter()
+        for _ in range(count):
+            vps = load_balancer.get_next_vps()
+            health_checker.increase_connection_count(vps)
+            picks[vps] += 1
+        return picks
+
+    # With factor 0.1 the idle new VPS counts as 9 requests in flight
+    assert pick(18)[NEW_VPS] == 0
+    assert pick(3)[NEW_VPS] == 1
+
+    clock.return_value += 10
+    assert pick(30)[NEW_VPS] > 10
+    assert NEW_VPS not in health_checker.slow_start
+
+
+def test_weighted_algorithms_ramp_up_a_recovered_backend(clock, mocker, make_load_balancer):
+    mocker.patch('load_balancer.health_checker.HealthChecker.handle_failure')
+    load_balancer = make_load_balancer(VPS_LIST, 'weighted_round_robin', slow_start=SLOW_START)
+    health_checker = load_balancer.health_checker
+    vps = VPS_LIST[1]
+    for is_up in (False, False, False, True, True):
+        health_checker.update_health(vps, is_up)
+
+    picks = collections.Counter(load_balancer.get_next_vps() for _ in range(110))
+    assert picks == {VPS_LIST[0]: 100, vps: 10}
+
+    # The schedule carries on across weight changes, a window may end one pick early or late
+    clock.return_value += 5
+    picks = collections.Counter(load_balancer.get_next_vps() for _ in range(155))
+    assert abs(picks[vps] - 55) <= 1
+
+    clock.return_value += 5
+    picks = collections.Counter(load_balancer.get_next_vps() for _ in range(100))
+    assert abs(picks[vps] - 50) <= 1
+
+
+def test_slow_start_tick_updates_only_the_ramping_weight(clock, make_load_balancer, mocker):
+    load_balancer = make_load_balancer(VPS_LIST, 'weighted_round_robin', slow_start=SLOW_START)
+    health_checker = load_balancer.health_checker
+    load_balancer.add_vps(NEW_VPS)
+    load_balancer.get_next_vps()
+    update_selection_tables = mocker.spy(health_checker, 'update_selection_tables')
+
+    clock.return_value += 5
+    load_balancer.get_next_vps()
+
+    assert not health_checker.weights_stale
+    assert update_selection_tables.call_count == 0
+    assert health_checker.weights[NEW_VPS] == 55
+    assert health_checker.weighted_round_robin.entries[NEW_VPS][0] == 55
+
+
+def test_round_robin_sends_a_share_of_the_factor(clock, make_load_balancer):
+    load_balancer = make_load_balancer(VPS_LIST, 'round_robin', slow_start=SLOW_START)
+    load_balancer.add_vps(NEW_VPS)
+
+    picks = collections.Counter(load_balancer.get_next_vps() for _ in range(2100))
+
+    assert 40 < picks[NEW_VPS] < 160
+
+
+def test_ip_hashing_moves_a_growing_stable_share_of_clients(clock, make_load_balancer):
+    load_balancer = make_load_balancer(VPS_LIST, 'ip_hashing', slow_start=SLOW_START)
+    clients = [f'10.0.{i // 256}.{i % 256}' for i in range(1000)]
+    load_balancer.add_vps(NEW_VPS)
+
+    def new_vps_clients():
+        return {client for client in clients if load_balancer.get_next_vps(client) == NEW_VPS}
+
+    early = new_vps_clients()
+    clock.return_value += 5
+    later = new_vps_clients()
+    clock.return_value += 5
+    final = new_vps_clients()
+
+    assert early < later < final
+    assert len(early) < len(final) * 0.2
+
+
+def test_min_weight_must_be_a_positive_fraction():
+    slow_start = SlowStart()
+    for min_weight in (0, -0.5, 1.5):
+        with pytest.raises(ValueError):
+            slow_start.configure({'window': 10, 'min_weight': min_weight})
+    with pytest.raises(ValueError):
+        slow_start.configure({'curve': 'quadratic'})
+
+    assert (slow_start.window, slow_start.min_weight) == (0, 0.1)
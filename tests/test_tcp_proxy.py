@@ -0,0 +1,125 @@
+import asyncio
+import socket
+from load_balancer.balancer import LoadBalancer
+
+
+async def start_echo_backend(name):
+    # Answers every connection with its name, then echoes until the client half-closes
+    async def handle(reader, writer):
+        writer.write(name)
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, f'tcp://127.0.0.1:{server.sockets[0].getsockname()[1]}'
+
+
+async def start_tcp_proxy(load_balancer):
+    load_balancer.tcp_proxy.host = '127.0.0.1'
+    load_balancer.tcp_proxy.port = 0
+    await load_balancer.tcp_proxy.start()
+    return load_balancer.tcp_proxy.socket.getsockname()[1]
+
+
+async def exchange(port, payload):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    name = await reader.readexactly(2)
+    writer.write(payload)
+    writer.write_eof()
+    echoed = await reader.read()
+    writer.close()
+    return name, echoed
+
+
+def test_tcp_connections_are_relayed_weighted_round_robin():
+    async def scenario():
+        backends = [await start_echo_backend(name) for name in (b'b1', b'b2')]
+        # round_robin picks at random, the smooth weighted one alternates between equal weights
+        load_balancer = LoadBalancer(balancing_algorithm='weighted_round_robin')
+        load_balancer.health_checker.set_vps_list([url for _, url in backends])
+        load_balancer.update_vps_list([url for _, url in backends])
+        port = await start_tcp_proxy(load_balancer)
+        payload = bytes(range(256)) * 4096
+        try:
+            return [await exchange(port, payload) for _ in range(4)], payload, load_balancer
+        finally:
+            await load_balancer.close()
+            for server, _ in backends:
+                server.close()
+                await server.wait_closed()
+
+    results, payload, load_balancer = asyncio.run(scenario())
+
+    assert sorted(name for name, _ in results) == [b'b1', b'b1', b'b2', b'b2']
+    assert all(echoed == payload for _, echoed in results)
+    assert load_balancer.health_checker.total_connections == 0
+    load_balancer.metrics.flush()
+    totals = load_balancer.metrics.vps_metrics.totals
+    assert sum(stats.bytes_out for stats in totals.values()) == 4 * len(payload)
+
+
+def test_refused_vps_is_skipped():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        closed_port = sock.getsockname()[1]
+
+    async def scenario():
+        server, url = await start_echo_backend(b'ok')
+        load_balancer = LoadBalancer(balancing_algorithm='least_connections')
+        load_balancer.health_checker.set_vps_list([f'tcp://127.0.0.1:{closed_port}', url])
+        # The refused VPS comes first for least_connections, ties go to the first added
+        port = await start_tcp_proxy(load_balancer)
+        try:
+            return [await exchange(port, b'ping') for _ in range(3)]
+        finally:
+            await load_balancer.close()
+            server.close()
+            await server.wait_closed()
+
+    assert asyncio.run(scenario()) == [(b'ok', b'ping')] * 3
+
+
+def test_connection_is_closed_without_vps():
+    async def scenario():
+        load_balancer = LoadBalancer()
+        port = await start_tcp_proxy(load_balancer)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            data = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return data
+        finally:
+            await load_balancer.close()
+
+    assert asyncio.run(scenario()) == b''
+
+
+def test_bytes_of_a_cancelled_connection_are_recorded():
+    async def scenario():
+        server, url = await start_echo_backend(b'ok')
+        load_balancer = LoadBalancer()
+        load_balancer.health_checker.set_vps_list([url])
+        port = await start_tcp_proxy(load_balancer)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'ping')
+            echoed = await reader.readexactly(6)
+            # Both directions are still open when the proxy shuts down
+            await load_balancer.close()
+            writer.close()
+            return echoed, load_balancer
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    echoed, load_balancer = asyncio.run(scenario())
+
+    assert echoed == b'okping'
+    load_balancer.metrics.flush()
+    totals = load_balancer.metrics.vps_metrics.totals
+    assert [(stats.bytes_out, stats.bytes_in) for stats in totals.values()] == [(4, 6)]
@@ -0,0 +1,114 @@
+import asyncio
+from aiohttp import web
+from load_balancer.backend import Backend
+from load_balancer.health_checker import HealthChecker
+from load_balancer.telemetry import TelemetryCollector
+
+
+def test_backend_smooths_the_reported_stats():
+    backend = Backend('http://vps1')
+    backend.observe({'cpu_usage': 40, 'memory_usage': 20}, 0.5, 1.0)
+    backend.observe({'cpu_usage': 80, 'latency': 0.01}, 0.5, 2.0)
+
+    assert backend.cpu_usage == 60
+    assert backend.memory_usage == 20
+    assert backend.latency == 0.01
+    assert backend.get_headroom() == 0.4
+
+
+def test_backend_ignores_invalid_stats():
+    backend = Backend('http://vps1')
+    backend.observe({'cpu_usage': 40, 'memory_usage': 20, 'latency': 0.01}, 0.5, 1.0)
+    invalid = backend.observe({'cpu_usage': 'n/a', 'memory_usage': float('nan'), 'latency': [1]}, 0.5, 2.0)
+
+    assert invalid == ['cpu_usage', 'memory_usage', 'latency']
+    assert (backend.cpu_usage, backend.memory_usage, backend.latency) == (40, 20, 0.01)
+    assert backend.observe({'cpu_usage': 140, 'memory_usage': -5, 'latency': 1e308}, 0.5, 3.0) == \
+        ['cpu_usage', 'memory_usage', 'latency']
+
+
+def test_weight_follows_load_and_latency():
+    health_checker = HealthChecker()
+    health_checker.set_vps_list(['http://vps1', 'http://vps2', 'http://vps3'])
+    health_checker.get_backend('http://vps1').observe({'cpu_usage': 20, 'latency': 0.01}, 1, 0)
+    health_checker.get_backend('http://vps2').observe({'cpu_usage': 20, 'latency': 0.02}, 1, 0)
+    health_checker.refresh_weights()
+
+    assert health_checker.get_weight('http://vps1') == 80
+    assert health_checker.get_weight('http://vps2') == 40
+    assert health_checker.get_weight('http://vps3') == 100
+
+
+def test_weighted_tables_are_rebuilt_only_on_material_change():
+    health_checker = HealthChecker()
+    health_checker.set_vps_list(['http://vps1', 'http://vps2'])
+    backend = health_checker.get_backend('http://vps1')
+    backend.observe({'cpu_usage': 50}, 1, 0)
+    health_checker.get_next_weighted_vps()
+    assert health_checker.weights == {'http://vps1': 50, 'http://vps2': 100}
+
+    backend.observe({'cpu_usage': 53}, 1, 0)
+    health_checker.refresh_weights(0.1)
+    assert not health_checker.weights_stale
+
+    backend.observe({'cpu_usage': 80}, 1, 0)
+    health_checker.refresh_weights(0.1)
+    assert health_checker.weights_stale
+
+
+def test_saturated_fleet_is_balanced_evenly():
+    health_checker = HealthChecker()
+    health_checker.set_vps_list(['http://vps1', 'http://vps2'])
+    for vps in health_checker.vps_list:
+        health_checker.get_backend(vps).observe({'cpu_usage': 100}, 1, 0)
+
+    assert health_checker.get_weight('http://vps1') == 0
+    assert {health_checker.get_next_weighted_vps() for _ in range(2)} == {'http://vps1', 'http://vps2'}
+
+
+def test_collector_scrapes_the_stats_endpoint():
+    async def stats(request):
+        return web.json_response({'cpu_usage': 75, 'memory_usage': 30})
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/stats', stats)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        vps = f'http://127.0.0.1:{runner.addresses[0][1]}'
+        health_checker = HealthChecker()
+        health_checker.set_vps_list([vps, 'http://127.0.0.1:1'])
+        collector = TelemetryCollector(health_checker, timeout=1)
+        try:
+            await collector.collect()
+        finally:
+            await collector.stop()
+            await runner.cleanup()
+        return health_checker.get_weight(vps), health_checker.get_weight('http://127.0.0.1:1')
+
+    assert asyncio.run(scenario()) == (25, 100)
+
+
+def test_collector_survives_malformed_stats():
+    async def stats(request):
+        return web.Response(text='{"cpu_usage": "n/a", "memory_usage": NaN, "latency": [0.1]}')
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/stats', stats)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        vps = f'http://127.0.0.1:{runner.addresses[0][1]}'
+        health_checker = HealthChecker()
+        health_checker.set_vps_list([vps])
+        collector = TelemetryCollector(health_checker, timeout=1)
+        try:
+            await collector.collect()
+        finally:
+            await collector.stop()
+            await runner.cleanup()
+        return health_checker.get_weight(vps)
+
+    assert asyncio.run(scenario()) == 100
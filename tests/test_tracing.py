@@ -0,0 +1,207 @@
+import asyncio
+import aiohttp
+import pytest
+import requests
+from aiohttp import web
+from load_balancer.balancer import LoadBalancer
+from load_balancer.cache import ResponseCache, CachedResponse
+from load_balancer.configuration import Configuration
+from load_balancer.retry import RetryPolicy
+from load_balancer.tracing import Profiler, Trace, current_trace, mark
+
+
+async def ok(request):
+    return web.Response(text='ok')
+
+
+@pytest.fixture
+def make_traced_load_balancer(make_load_balancer):
+    def make_traced_load_balancer(vps, sample_rate):
+        return make_load_balancer([vps], tracing={'sample_rate': sample_rate, 'slow_threshold': 1e-9})
+
+    return make_traced_load_balancer
+
+
+def test_sampled_requests_are_timed_per_stage(start_backend, make_traced_load_balancer):
+    async def scenario():
+        backend, vps = await start_backend(ok)
+        load_balancer = make_traced_load_balancer(vps, 1.0)
+        try:
+            for _ in range(3):
+                await load_balancer.distribute_load()
+            assert current_trace.get() is None
+        finally:
+            await load_balancer.close()
+            await backend.cleanup()
+        return load_balancer
+
+    load_balancer = asyncio.run(scenario())
+
+    summary = load_balancer.metrics.get_stage_summary()
+    for stage in ('admission', 'select', 'connect', 'pool_wait', 'ttfb', 'body', 'record', 'total'):
+        assert stage in summary
+    assert summary['total']['count'] == 3
+    assert summary['connect']['count'] == 1
+    sample = load_balancer.metrics.registry.get_sample_value
+    assert sample('load_balancer_stage_seconds_count', {'stage': 'ttfb'}) == 3
+    trace = load_balancer.tracer.slow_traces[0]
+    assert [stage for stage, _ in trace['stages']][:2] == ['admission', 'select']
+
+
+def test_unsampled_requests_are_not_timed(start_backend, make_traced_load_balancer):
+    async def scenario():
+        backend, vps = await start_backend(ok)
+        load_balancer = make_traced_load_balancer(vps, 0)
+        try:
+            await load_balancer.distribute_load()
+        finally:
+            await load_balancer.close()
+            await backend.cleanup()
+        return load_balancer
+
+    load_balancer = asyncio.run(scenario())
+
+    assert load_balancer.metrics.get_stage_summary() == {}
+    assert not load_balancer.tracer.slow_traces
+
+
+def test_connection_hooks_are_installed_with_sampling_off(tmp_path, mocker):
+    mocker.patch('load_balancer.balancer.Metrics.setup')
+    (tmp_path / 'vps_list.txt').write_text('http://vps1.example.com\n')
+    load_balancer = LoadBalancer()
+    load_balancer.configuration = Configuration('tests/config.yaml')
+    load_balancer.load_vps_list(str(tmp_path / 'vps_list.txt'))
+
+    assert load_balancer.tracer.sample_rate == 0
+    assert len(load_balancer.connection_pool.trace_configs) == 1
+
+
+def test_profiler_reports_the_functions_run_meanwhile():
+    def busy_function():
+        return sum(range(10000))
+
+    async def scenario():
+        profiler = Profiler()
+
+        async def work():
+            for _ in range(20):
+                busy_function()
+                await asyncio.sleep(0.005)
+
+        task = asyncio.ensure_future(work())
+        profile = asyncio.ensure_future(profiler.run(0.2, 'tottime', 1000))
+        await asyncio.sleep(0)
+        with pytest.raises(RuntimeError):
+            await profiler.run(0.1)
+        await task
+        return await profile
+
+    assert 'busy_function' in asyncio.run(scenario())
+
+
+def test_admin_server_serves_profiles_and_stages():
+    async def scenario():
+        load_balancer = LoadBalancer()
+        load_balancer.admin_server.configure({'enabled': True, 'port': 0, 'max_profile_seconds': 1})
+        await load_balancer.admin_server.start()
+        port = load_balancer.admin_server.runner.addresses[0][1]
+        load_balancer.metrics.record_stage('select', 0.002)
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f'http://127.0.0.1:{port}/profile?seconds=0.05') as response:
+                    profile = response.status, 'function calls' in await response.text()
+                async with session.get(f'http://127.0.0.1:{port}/profile?seconds=5') as response:
+                    too_long = response.status
+                async with session.get(f'http://127.0.0.1:{port}/stages') as response:
+                    stages = await response.json()
+        finally:
+            await load_balancer.close()
+        return profile, too_long, stages
+
+    profile, too_long, stages = asyncio.run(scenario())
+
+    assert profile == (200, True)
+    assert too_long == 400
+    assert stages['stages']['select'] == {'count': 1, 'mean_ms': pytest.approx(2.0)}
+
+
+def run_traced(coroutine_function):
+    async def scenario():
+        trace = Trace('test')
+        token = current_trace.set(trace)
+        try:
+            await coroutine_function()
+        finally:
+            current_trace.reset(token)
+        return trace
+
+    return asyncio.run(scenario())
+
+
+def test_only_the_winning_hedge_is_booked():
+    policy = RetryPolicy(hedge=True)
+    for _ in range(50):
+        policy.observe(0.01)
+
+    def pick_vps(tried):
+        mark('select')
+        return 'fast' if tried else 'slow'
+
+    async def attempt(vps):
+        await asyncio.sleep(0.005)
+        mark('connect')
+        await asyncio.sleep(1.0 if vps == 'slow' else 0.01)
+        mark('ttfb')
+        return vps
+
+    trace = run_traced(lambda: policy.execute(pick_vps, attempt))
+
+    assert [stage for stage, _ in trace.stages] == ['hedge', 'select', 'connect', 'ttfb']
+    assert sum(seconds for _, seconds in trace.stages) == pytest.approx(trace.get_duration())
+
+
+def test_sequential_retries_are_booked_in_order():
+    policy = RetryPolicy()
+
+    def pick_vps(tried):
+        mark('select')
+        return 'good' if tried else 'bad'
+
+    async def attempt(vps):
+        await asyncio.sleep(0.001)
+        mark('ttfb')
+        if vps == 'bad':
+            raise requests.exceptions.RequestException('refused')
+        return vps
+
+    trace = run_traced(lambda: policy.execute(pick_vps, attempt))
+
+    assert [stage for stage, _ in trace.stages] == ['select', 'ttfb', 'select', 'ttfb']
+
+
+def test_background_revalidation_does_not_mark_the_request_trace():
+    cache = ResponseCache()
+    cache.store('GET', '/a', {}, CachedResponse(200, {'Cache-Control': 'max-age=0, stale-while-revalidate=30',
+                                                     'ETag': '"v1"'}, b'ok'))
+    fetched = []
+
+    async def fetch(headers):
+        await asyncio.sleep(0.01)
+        mark('ttfb')
+        fetched.append(headers)
+        return CachedResponse(304, {'Cache-Control': 'max-age=60'})
+
+    async def scenario():
+        trace = Trace('test')
+        token = current_trace.set(trace)
+        try:
+            _, cache_status = await cache.get('GET', '/a', {}, fetch)
+        finally:
+            current_trace.reset(token)
+        await asyncio.gather(*cache.revalidations)
+        return cache_status, trace
+
+    cache_status, trace = asyncio.run(scenario())
+
+    assert cache_status == 'STALE' and len(fetched) == 1
+    assert trace.stages == []
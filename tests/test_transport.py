@@ -0,0 +1,223 @@
+import asyncio
+import aiohttp
+import pytest
+from load_balancer.health_checker import HealthChecker
+
+h2 = pytest.importorskip('h2')
+import h2.config  # noqa: E402
+import h2.connection  # noqa: E402
+import h2.events  # noqa: E402
+import h2.settings  # noqa: E402
+
+
+class H2CBackend:
+    # Minimal h2c server: echoes the request body, answers after delay seconds
+    def __init__(self, max_concurrent_streams=100, delay=0.0):
+        self.max_concurrent_streams = max_concurrent_streams
+        self.delay = delay
+        self.connections = 0
+        self.active_streams = 0
+        self.max_active_streams = 0
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return f'http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}'
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        connection = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False,
+                                                                          header_encoding='utf-8'))
+        connection.local_settings = h2.settings.Settings(client=False, initial_values={
+            h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: self.max_concurrent_streams})
+        connection.initiate_connection()
+        writer.write(connection.data_to_send())
+        requests = {}
+        window_updated = asyncio.Event()
+        tasks = set()
+
+        async def respond(stream_id, headers, body):
+            await asyncio.sleep(self.delay)
+            headers = dict(headers)
+            connection.send_headers(stream_id, [(':status', '200'), ('content-length', str(len(body))),
+                                                ('x-path', headers[':path']), ('x-method', headers[':method'])])
+            view = memoryview(body)
+            while view:
+                window = min(connection.local_flow_control_window(stream_id), connection.max_outbound_frame_size)
+                if window <= 0:
+                    window_updated.clear()
+                    await window_updated.wait()
+                    continue
+                connection.send_data(stream_id, view[:window].tobytes())
+                view = view[window:]
+                writer.write(connection.data_to_send())
+            connection.end_stream(stream_id)
+            writer.write(connection.data_to_send())
+            self.active_streams -= 1
+
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                for event in connection.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        self.active_streams += 1
+                        self.max_active_streams = max(self.max_active_streams, self.active_streams)
+                        requests[event.stream_id] = (event.headers, bytearray())
+                    elif isinstance(event, h2.events.DataReceived):
+                        requests[event.stream_id][1].extend(event.data)
+                        connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        headers, body = requests.pop(event.stream_id)
+                        task = asyncio.ensure_future(respond(event.stream_id, headers, bytes(body)))
+                        tasks.add(task)
+                        task.add_done_callback(tasks.discard)
+                    elif isinstance(event, h2.events.WindowUpdated):
+                        window_updated.set()
+                writer.write(connection.data_to_send())
+        except (ConnectionError, h2.exceptions.ProtocolError):
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            writer.close()
+
+
+@pytest.fixture
+def make_http2_load_balancer(make_load_balancer):
+    def make_http2_load_balancer(vps, **upstream):
+        return make_load_balancer([vps], 'least_connections', upstream=dict(protocol='http2', **upstream))
+
+    return make_http2_load_balancer
+
+
+def test_concurrent_requests_are_multiplexed_over_few_connections(make_http2_load_balancer):
+    backend = H2CBackend(delay=0.05)
+
+    async def scenario():
+        vps = await backend.start()
+        load_balancer = make_http2_load_balancer(vps, connections_per_vps=2)
+        try:
+            answers = await asyncio.gather(*(load_balancer.request_handler.send_request(vps + f'/{i}')
+                                             for i in range(50)))
+            return answers, load_balancer.request_handler.transport.get_connection_count(vps)
+        finally:
+            await load_balancer.close()
+            await backend.stop()
+
+    answers, connection_count = asyncio.run(scenario())
+
+    assert answers == [''] * 50
+    assert backend.connections <= 2 and connection_count <= 2
+    assert backend.max_active_streams > 2
+
+
+def test_stream_limit_of_the_vps_is_respected_and_reported(make_http2_load_balancer):
+    backend = H2CBackend(max_concurrent_streams=3, delay=0.05)
+
+    async def scenario():
+        vps = await backend.start()
+        load_balancer = make_http2_load_balancer(vps, connections_per_vps=1)
+        try:
+            await load_balancer.request_handler.send_request(vps)
+            stream_limit = load_balancer.health_checker.stream_limits.get(vps)
+            await asyncio.gather(*(load_balancer.request_handler.send_request(vps) for _ in range(10)))
+            return stream_limit
+        finally:
+            await load_balancer.close()
+            await backend.stop()
+
+    assert asyncio.run(scenario()) == 3
+    assert backend.connections == 1
+    assert backend.max_active_streams == 3
+
+
+def test_proxy_relays_large_bodies_over_http2_flow_control(make_http2_load_balancer, start_proxy):
+    backend = H2CBackend()
+
+    async def scenario():
+        vps = await backend.start()
+        load_balancer = make_http2_load_balancer(vps)
+        port = await start_proxy(load_balancer)
+        payload = bytes(range(256)) * 4096
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.post(f'http://127.0.0.1:{port}/echo?a=1', data=payload) as response:
+                    return (response.status, await response.read() == payload, response.headers['X-Path'],
+                            response.headers['X-Method'])
+        finally:
+            await load_balancer.close()
+            await backend.stop()
+
+    assert asyncio.run(scenario()) == (200, True, '/echo?a=1', 'POST')
+
+
+def test_unreachable_http2_vps_raises_request_exception(make_http2_load_balancer):
+    import requests
+
+    async def scenario():
+        load_balancer = make_http2_load_balancer('http://127.0.0.1:1')
+        try:
+            await load_balancer.request_handler.send_request('http://127.0.0.1:1')
+        finally:
+            await load_balancer.close()
+
+    with pytest.raises(requests.exceptions.RequestException):
+        asyncio.run(scenario())
+
+
+def test_failed_connect_wakes_the_requests_waiting_for_its_slot(make_http2_load_balancer):
+    async def scenario():
+        load_balancer = make_http2_load_balancer('http://127.0.0.1:1', connections_per_vps=1)
+        load_balancer.connection_pool.timeout = 5
+        transport = load_balancer.request_handler.transport
+        start = asyncio.get_running_loop().time()
+        try:
+            results = await asyncio.gather(*(transport.acquire('http://127.0.0.1:1') for _ in range(2)),
+                                           return_exceptions=True)
+        finally:
+            await load_balancer.close()
+        return results, asyncio.get_running_loop().time() - start
+
+    results, elapsed = asyncio.run(scenario())
+
+    # The waiting request retries the connect at once instead of sleeping until the timeout
+    assert all(isinstance(result, aiohttp.ClientConnectionError) for result in results)
+    assert elapsed < 1
+
+
+def test_least_connections_compares_the_share_of_streams_in_use():
+    health_checker = HealthChecker()
+    health_checker.set_vps_list(['http://small', 'http://large'])
+    health_checker.set_stream_limit('http://small', 10)
+    health_checker.set_stream_limit('http://large', 100)
+    for _ in range(3):
+        health_checker.increase_connection_count('http://small')
+    for _ in range(20):
+        health_checker.increase_connection_count('http://large')
+
+    assert health_checker.get_least_connections_vps() == 'http://large'
+
+
+def test_vps_without_a_reported_stream_limit_is_scored_by_the_configured_one(make_http2_load_balancer):
+    load_balancer = make_http2_load_balancer('http://reported', connections_per_vps=2, max_streams=10)
+    health_checker = load_balancer.health_checker
+    health_checker.add_vps('http://new')
+    health_checker.set_stream_limit('http://reported', 100)
+    for _ in range(30):
+        health_checker.increase_connection_count('http://reported')
+    for _ in range(5):
+        health_checker.increase_connection_count('http://new')
+
+    # 30 of 100 streams in use against 5 of the assumed 2 * 10
+    assert health_checker.get_connections_score('http://new') == 0.25
+    assert health_checker.get_least_connections_vps() == 'http://new'
+
+    load_balancer.request_handler.configure({'protocol': 'http1'})
+
+    assert health_checker.default_stream_limit is None
@@ -0,0 +1,82 @@
+from load_balancer.balancer import LoadBalancer
+from load_balancer.configuration import Configuration
+from load_balancer.health_checker import HealthChecker
+from load_balancer.workers import SharedBackendState
+
+
+def test_shared_state_is_visible_through_another_mapping():
+    owner = SharedBackendState(['a', 'b'], workers=2)
+    attached = SharedBackendState(['a', 'b'], workers=2, name=owner.name)
+    try:
+        owner.set_health('b', False)
+        owner.set_weight('a', 3)
+        owner.set_connections(0, 'a', 2)
+        attached.set_connections(1, 'a', 5)
+
+        assert attached.is_healthy('a')
+        assert not attached.is_healthy('b')
+        assert attached.get_weight('a') == 3
+        assert attached.get_weight('b') == -1
+        assert owner.get_connections('a') == 7
+        assert owner.get_connections('a', exclude_worker=1) == 2
+    finally:
+        attached.close()
+        owner.close()
+
+
+def test_workers_follow_shared_health_and_connections(mocker):
+    mocker.patch('load_balancer.health_checker.HealthChecker.handle_failure')
+    owner = SharedBackendState(['a', 'b'], workers=2)
+    first, second = HealthChecker(fall=1), HealthChecker()
+    for worker_index, health_checker in enumerate((first, second)):
+        health_checker.set_vps_list(['a', 'b'])
+        health_checker.attach_shared_state(owner, worker_index)
+    try:
+        for _ in range(3):
+            first.increase_connection_count('a')
+        second.sync_shared_state()
+
+        assert second.get_active_connections('a') == 3
+        assert second.get_least_connections_vps() == 'b'
+
+        first.shared_state.set_health('b', False)
+        second.sync_shared_state()
+
+        assert not second.check_health('b')
+        assert second.get_least_connections_vps() == 'a'
+    finally:
+        owner.close()
+
+
+def test_shared_state_covers_the_backends_of_the_config(tmp_path, mocker):
+    mocker.patch('load_balancer.balancer.Metrics.setup')
+    mocker.patch('load_balancer.health_checker.HealthChecker.handle_failure')
+    backends = [f'http://vps{i}.example.com' for i in range(4)]
+    config = tmp_path / 'config.yaml'
+    config.write_text(open('tests/config.yaml').read() + '  backends:\n' +
+                      ''.join(f'    - {url}\n' for url in backends))
+    (tmp_path / 'vps_list.txt').write_text('http://file.example.com\n')
+    parent = LoadBalancer()
+    parent.configuration = Configuration(str(config))
+    vps_list = parent.read_vps_list(str(tmp_path / 'vps_list.txt'))
+    assert vps_list == backends
+
+    owner = SharedBackendState(vps_list, workers=2)
+    load_balancers = []
+    for worker_index in range(2):
+        load_balancer = LoadBalancer()
+        load_balancer.configuration = Configuration(str(config))
+        load_balancer.load_vps_list(str(tmp_path / 'vps_list.txt'))
+        load_balancer.health_checker.fall = 1
+        load_balancer.health_checker.attach_shared_state(SharedBackendState(vps_list, 2, owner.name), worker_index)
+        load_balancers.append(load_balancer)
+    first, second = (load_balancer.health_checker for load_balancer in load_balancers)
+    try:
+        first.update_health(backends[3], False)
+        second.sync_shared_state()
+
+        assert not second.check_health(backends[3])
+    finally:
+        for health_checker in (first, second):
+            health_checker.shared_state.close()
+        owner.close()